@@ -0,0 +1,53 @@
+"""
+bench_load.py
+=============
+Runs a synthetic upload workload against a set on an in-memory filesystem
+and on a temporary directory, and prints throughput and latency
+percentiles for uploads and for downloading them back.
+
+    PYTHONPATH=. python benchmarks/bench_load.py
+"""
+import shutil
+import tempfile
+from flask import Flask, request
+from flask_flup import Flup, UploadSet
+from flask_flup import testing
+from flask_flup.filesystem import MemoryFilesystem
+
+
+def make_app(dest, filesystem=None):
+    app = Flask(__name__)
+    app.config.update(UPLOADED_FILES_DEST=dest,
+                      UPLOADS_FILESYSTEM=filesystem)
+    files = UploadSet('files')
+    Flup(app, [files])
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        return files.url(files.save(request.files['file']))
+
+    return app
+
+
+def main():
+    workload = testing.Workload(2000, testing.lognormal(16 * 1024,
+                                                        maximum=4 << 20),
+                                collisions=0.2)
+    dest = tempfile.mkdtemp()
+    try:
+        for label, app in (('memory', make_app('/uploads',
+                                               MemoryFilesystem())),
+                           ('disk', make_app(dest))):
+            for concurrency in (1, 8):
+                uploads, downloads = testing.run(
+                    app, '/upload', workload, concurrency,
+                    fetch=lambda res: res.data.decode('utf-8'))
+                print('{}, {:d} threads'.format(label, concurrency))
+                print(uploads)
+                print(downloads)
+    finally:
+        shutil.rmtree(dest)
+
+
+if __name__ == '__main__':
+    main()
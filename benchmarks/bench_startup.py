@@ -0,0 +1,35 @@
+"""
+bench_startup.py
+================
+Times `Flup.init_app` for growing numbers of upload sets. Configuration is
+resolved lazily, so startup should stay flat as the number of sets grows.
+
+    PYTHONPATH=. python benchmarks/bench_startup.py
+"""
+import time
+from flask import Flask
+from flask_flup import Flup, UploadSet
+
+
+def time_init(sets, runs=20):
+    best = None
+    for _ in range(runs):
+        app = Flask(__name__)
+        app.config['UPLOADS_DEFAULT_DEST'] = '/var/uploads'
+        flup = Flup(upload_sets=sets)
+        start = time.perf_counter()
+        flup.init_app(app)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    for count in (10, 100, 1000, 10000):
+        sets = [UploadSet('tenant{:d}'.format(n)) for n in range(count)]
+        print('{:>6d} sets: {:8.3f} ms'.format(count,
+                                               time_init(sets) * 1000))
+
+
+if __name__ == '__main__':
+    main()
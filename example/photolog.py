@@ -11,8 +11,8 @@ from flask import (Flask, request, url_for, redirect, render_template, flash,
                    session, g)
 from flaskext.couchdb import (CouchDBManager, Document, TextField,
                               DateTimeField, ViewField)
-from flaskext.uploads import (UploadSet, configure_uploads, IMAGES,
-                              UploadNotAllowed)
+from flask_flup import Flup, UploadSet, IMAGES
+from flask_flup.flup import UploadNotAllowed
 
 # defaults
 
@@ -39,7 +39,7 @@ app.config.from_envvar('PHOTOLOG_SETTINGS', silent=True)
 # uploads
 
 uploaded_photos = UploadSet('photos', IMAGES)
-configure_uploads(app, uploaded_photos)
+Flup(app, [uploaded_photos])
 
 
 # documents
@@ -101,13 +101,16 @@ def new():
             flash("You must fill in all the fields")
         else:
             try:
-                filename = uploaded_photos.save(photo)
+                staged = uploaded_photos.stage(photo)
             except UploadNotAllowed:
                 flash("The upload was not allowed")
             else:
-                post = Post(title=title, caption=caption, filename=filename)
-                post.id = unique_id()
-                post.store()
+                # the photo is only published once the post is stored
+                with staged:
+                    post = Post(title=title, caption=caption,
+                                filename=staged.name)
+                    post.id = unique_id()
+                    post.store()
                 flash("Post successful")
                 return to_index()
     return render_template('new.html')
@@ -1,4 +1,4 @@
 __version__ = "0.0.2"
 
-from .flup import (Flup, UploadSet, TEXT, DOCUMENTS, IMAGES, AUDIO, DATA,
-        SCRIPTS, ARCHIVES, EXECUTABLES, DEFAULTS, All, AllExcept)
+from .flup import (Flup, UploadSet, DynamicUploadSet, TEXT, DOCUMENTS, IMAGES,
+        AUDIO, DATA, SCRIPTS, ARCHIVES, EXECUTABLES, DEFAULTS, All, AllExcept)
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+flup.bulk
+=========
+Copying many files into, out of and between upload sets, for the
+``flask flup import``, ``export``, ``migrate`` and ``verify`` commands.
+
+Files are listed with `os.scandir` and copied by a pool of worker threads.
+Files copied into a set go through `UploadSet.save`, so they get the set's
+name normalization, extension policy and conflict resolution, and
+everything else the set does when saving. Each file is hashed while it is
+copied, and checked against its copy by size, or by digest, once written.
+
+Every file handled is recorded in a checkpoint, an SQLite index in the
+target's state directory. Running the same copy again skips what is done,
+so an interrupted run picks up where it stopped, and ``verify`` can check
+the copies again later. Files are recorded as started before they are
+handed to the workers, and outcomes are written in batches, so a run that
+stops may have copied files it has not recorded. Before copying a started
+file again, the next run looks for a copy with the same contents under the
+names the target would have given it, so that saving to a set does not
+leave a second copy under a new name.
+
+Like tiering and replication, this works on local directories only.
+"""
+import collections
+import errno
+import hashlib
+import io
+import itertools
+import logging
+import mimetypes
+import os
+import posixpath
+import queue
+import shutil
+import threading
+import uuid
+
+from werkzeug import secure_filename, FileStorage
+
+from . import integrity, metadata
+from .flup import (STATE_DIR, UploadNotAllowed, lowercase_ext, open_upload,
+                   remove_upload, state_path)
+from .sqlite import SQLiteIndex
+
+COPIED = 'copied'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+STARTED = 'started'
+
+#: Checkpoint records written per transaction.
+FLUSH_EVERY = 500
+
+#: Source names looked up in the checkpoint per query.
+LOOKUP_EVERY = 500
+
+#: The outcome of copying the file `source`: the `name` it was copied as,
+#: and its `size` and sha256 `digest`, or why it was skipped or failed.
+Copy = collections.namedtuple('Copy', ['source', 'name', 'size', 'digest',
+                                       'status', 'reason'])
+
+
+class VerificationError(Exception):
+    """
+    A copy differs from what was read from its source.
+    """
+
+
+def walk(root):
+    """
+    The paths of the files under `root`, relative to it and separated by
+    ``/``, leaving out flup's state directories. Links to directories are
+    not followed.
+    """
+    stack = ['']
+    while stack:
+        prefix = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, prefix)))
+        except FileNotFoundError:
+            continue
+        for entry in sorted(entries, key=lambda e: e.name):
+            name = posixpath.join(prefix, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != STATE_DIR:
+                    stack.append(name)
+            elif entry.is_file():
+                yield name
+
+
+class Directory(object):
+    """
+    A plain directory tree, copied from or exported to.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.key = 'directory:' + self.root
+        self.state_dir = state_path(self.root)
+
+    def __str__(self):
+        return self.root
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def walk(self):
+        return walk(self.root)
+
+    def open(self, name):
+        return io.open(self.path(name), 'rb')
+
+    def write(self, name, stream, size):
+        """
+        Write `stream` to `name`, replacing any file already there.
+        """
+        path = self.path(name)
+        directory, basename = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        partial = os.path.join(directory, '.{}.{}.part'.format(
+            basename, uuid.uuid4().hex))
+        try:
+            with io.open(partial, 'wb') as f:
+                shutil.copyfileobj(stream, f)
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise
+        return name
+
+    def remove(self, name):
+        os.unlink(self.path(name))
+
+    def find(self, name, size, digest):
+        # writing again replaces any earlier copy
+        return None
+
+    def finish(self):
+        pass
+
+
+class SetEndpoint(object):
+    """
+    The files of an upload set. Files read from it are decrypted, and
+    files written to it are saved with `UploadSet.save`.
+    """
+    def __init__(self, uset):
+        self.uset = uset
+
+    @property
+    def config(self):
+        return self.uset.config
+
+    @property
+    def key(self):
+        return 'set:{}:{}'.format(self.uset.name, self.config.destination)
+
+    @property
+    def state_dir(self):
+        return state_path(self.config.destination)
+
+    def __str__(self):
+        return self.uset.name
+
+    def walk(self):
+        """
+        The saved files, leaving out the hidden partial copies of tiering
+        and replication; saved names never start with a dot.
+        """
+        config = self.config
+        for directory in (config.destination, config.cold_destination):
+            if directory is not None:
+                for name in walk(directory):
+                    if not posixpath.basename(name).startswith('.'):
+                        yield name
+
+    def open(self, name):
+        return open_upload(self.config, self.uset.path(name))
+
+    def folder(self, name):
+        folder = posixpath.dirname(name)
+        return '/'.join(filter(None, (secure_filename(part)
+                                      for part in folder.split('/'))))
+
+    def write(self, name, stream, size):
+        basename = posixpath.basename(name)
+        storage = FileStorage(stream, filename=basename,
+                              content_type=mimetypes.guess_type(basename)[0],
+                              content_length=size)
+        return str(self.uset.save(storage, folder=self.folder(name) or None))
+
+    def find(self, name, size, digest):
+        """
+        The name the file `name` was saved as by an earlier run, found by
+        its `size` and sha256 `digest` among the names saving it would
+        have picked, or None.
+        """
+        basename = lowercase_ext(secure_filename(posixpath.basename(name)))
+        stem, dot, ext = basename.rpartition('.')
+        candidate, count = basename, 0
+        while True:
+            saved = posixpath.join(self.folder(name), candidate)
+            try:
+                check(self, saved, size, digest)
+                return saved
+            except VerificationError:
+                pass
+            except (IOError, OSError) as e:
+                if e.errno == errno.ENOENT:
+                    return None
+                raise
+            if not dot:
+                return None
+            count += 1
+            candidate = '{}_{:d}.{}'.format(stem, count, ext)
+
+    def remove(self, name):
+        remove_upload(self.config, name)
+
+    def finish(self):
+        if self.config.metadata:
+            metadata.metadata_index(self.state_dir).flush()
+
+
+class Checkpoint(SQLiteIndex):
+    """
+    What has been copied from one source to one target.
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS copies ('
+              'source TEXT PRIMARY KEY, name TEXT, size INTEGER, '
+              'digest TEXT, status TEXT NOT NULL, reason TEXT)',)
+
+    def statuses(self, sources):
+        """
+        The recorded status of those of `sources` handled before, keyed by
+        source.
+        """
+        return dict(self.connection.execute(
+            'SELECT source, status FROM copies WHERE source IN ({})'.format(
+                ', '.join('?' * len(sources))), list(sources)))
+
+    def record(self, copies):
+        with self.connection as db:
+            db.executemany('INSERT OR REPLACE INTO copies VALUES '
+                           '(?, ?, ?, ?, ?, ?)', copies)
+
+    def copies(self, status=COPIED):
+        """
+        The `Copy` records with `status`.
+        """
+        cursor = self.connection.execute(
+            'SELECT * FROM copies WHERE status = ? ORDER BY source',
+            (status,))
+        for row in cursor:
+            yield Copy(*row)
+
+    def clear(self):
+        with self.connection as db:
+            db.execute('DELETE FROM copies')
+
+
+def open_checkpoint(source, target):
+    """
+    The `Checkpoint` of copying `source` to `target`, kept with `target`.
+    """
+    key = hashlib.sha1('{}\n{}'.format(source.key, target.key)
+                       .encode('utf-8')).hexdigest()[:16]
+    return Checkpoint(os.path.join(target.state_dir, 'bulk',
+                                   key + '.db'))
+
+
+class HashingReader(object):
+    """
+    Hashes and counts what is read through it.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+
+def check(target, name, size, digest=None):
+    """
+    Raise `VerificationError` unless the file `name` of `target` has
+    `size` bytes and, if given, the sha256 `digest`.
+    """
+    with target.open(name) as f:
+        if digest is not None:
+            found = integrity.stream_digests(f, ('sha256',))['sha256']
+            if found != digest:
+                raise VerificationError("{}: sha256 is {}, expected {}"
+                                        .format(name, found, digest))
+        found = f.seek(0, io.SEEK_END)
+    if found != size:
+        raise VerificationError("{}: {:d} bytes, expected {:d}"
+                                .format(name, found, size))
+
+
+def copy_file(source, target, name, verify='size', delete=False,
+              started=False):
+    """
+    Copy the file `name` of `source` to `target`, check the copy, and
+    remove the original if `delete` is set.
+
+    :param verify:  ``'size'``, ``'digest'`` or None
+    :param started: Whether a run that stopped may have copied it already
+    :returns: A `Copy`.
+    """
+    saved = None
+    try:
+        if started:
+            with source.open(name) as f:
+                digest = integrity.stream_digests(f, ('sha256',))['sha256']
+                size = f.seek(0, io.SEEK_END)
+            found = target.find(name, size, digest)
+            if found is not None:
+                if delete:
+                    source.remove(name)
+                return Copy(name, found, size, digest, COPIED, None)
+        with source.open(name) as f:
+            size = f.seek(0, io.SEEK_END)
+            f.seek(0)
+            reader = HashingReader(f)
+            saved = target.write(name, reader, size)
+        digest = reader.hash.hexdigest()
+        if reader.size != size:
+            raise VerificationError("{} changed while it was copied"
+                                    .format(name))
+        if verify is not None:
+            check(target, saved, size, digest if verify == 'digest' else None)
+        if delete:
+            source.remove(name)
+    except UploadNotAllowed as e:
+        return Copy(name, None, None, None, SKIPPED, str(e) or 'not allowed')
+    except Exception as e:
+        if saved is not None:
+            try:
+                target.remove(saved)
+            except OSError:
+                pass
+        logging.getLogger(__name__).warning("copying %s failed: %s",
+                                            name, e)
+        return Copy(name, saved, None, None, FAILED, str(e))
+    return Copy(name, saved, size, digest, COPIED, None)
+
+
+def check_copy(target, copy, digest=False):
+    """
+    Check the copy recorded as `copy` again.
+
+    :returns: `copy`, failed if the copy is missing or differs.
+    """
+    try:
+        check(target, copy.name, copy.size, copy.digest if digest else None)
+    except (IOError, OSError, VerificationError) as e:
+        return copy._replace(status=FAILED, reason=str(e))
+    return copy
+
+
+def pool(app, workers, items, func):
+    """
+    Call `func` on each of `items` from `workers` threads, each inside an
+    application context of `app`, and yield the results as they come. At
+    most a few items per worker are taken from `items` ahead of time, so
+    it can be an iterator over millions of files.
+    """
+    tasks = queue.Queue(workers * 4)
+    results = queue.Queue()
+    stop = object()
+
+    def work():
+        with app.app_context():
+            for item in iter(tasks.get, stop):
+                try:
+                    results.put(func(item))
+                except Exception:
+                    logging.getLogger(__name__).exception("%s failed", item)
+                    results.put(None)
+
+    threads = [threading.Thread(target=work, name='flup-bulk-{:d}'.format(n))
+               for n in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    pending = 0
+    try:
+        for item in items:
+            tasks.put(item)
+            pending += 1
+            while True:
+                try:
+                    result = results.get_nowait()
+                except queue.Empty:
+                    break
+                pending -= 1
+                yield result
+    finally:
+        for thread in threads:
+            tasks.put(stop)
+    while pending:
+        pending -= 1
+        yield results.get()
+    for thread in threads:
+        thread.join()
+
+
+def run(app, source, target, workers=8, verify='size', delete=False,
+        restart=False, checkpoint=None):
+    """
+    Copy every file of `source` to `target` with `copy_file`, skipping the
+    files a previous run finished.
+
+    :param checkpoint: A `Checkpoint` to use rather than the default one
+    :param restart:    Forget what previous runs did
+    :returns: The number of files copied, skipped by the target's rules,
+              failed, and done by a previous run.
+    """
+    if checkpoint is None:
+        checkpoint = open_checkpoint(source, target)
+    if restart:
+        checkpoint.clear()
+    counts = collections.Counter(dict.fromkeys(
+        (COPIED, SKIPPED, FAILED, 'resumed'), 0))
+
+    def todo():
+        # look names up a batch at a time, rather than loading everything
+        # a previous run did
+        names = source.walk()
+        while True:
+            batch = list(itertools.islice(names, LOOKUP_EVERY))
+            if not batch:
+                return
+            statuses = checkpoint.statuses(batch)
+            pending = [name for name in batch
+                       if statuses.get(name) not in (COPIED, SKIPPED)]
+            counts['resumed'] += len(batch) - len(pending)
+            checkpoint.record([Copy(name, None, None, None, STARTED, None)
+                               for name in pending])
+            for name in pending:
+                yield name, statuses.get(name) == STARTED
+
+    buffered = []
+    try:
+        for copy in pool(app, workers, todo(), lambda item: copy_file(
+                source, target, item[0], verify, delete, item[1])):
+            if copy is None:
+                counts[FAILED] += 1
+                continue
+            counts[copy.status] += 1
+            buffered.append(copy)
+            if len(buffered) >= FLUSH_EVERY:
+                checkpoint.record(buffered)
+                buffered = []
+    finally:
+        checkpoint.record(buffered)
+        target.finish()
+    return dict(counts)
+
+
+def verify(app, source, target, workers=8, digest=False):
+    """
+    Check every copy recorded in the checkpoint of copying `source` to
+    `target` against `target`, by size and optionally by digest.
+
+    :returns: The failed `Copy` records, each with the reason.
+    """
+    records = open_checkpoint(source, target)
+    return [copy for copy in pool(app, workers, records.copies(),
+                                  lambda copy: check_copy(target, copy,
+                                                          digest))
+            if copy is not None and copy.status == FAILED]
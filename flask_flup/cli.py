@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+flup.cli
+========
+The ``flask flup`` command group, added to applications that set up `Flup`
+on Flask versions with a command line interface.
+"""
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from . import bulk
+from .flup import DynamicUploadSet
+
+
+@click.group()
+def flup():
+    """Manage upload sets."""
+
+
+@flup.command()
+@click.option('--batch-size', default=500, show_default=True,
+              help='Files deleted per index query.')
+@with_appcontext
+def sweep(batch_size):
+    """Delete uploads whose time to live has passed."""
+    swept = current_app.extensions['flup'].sweep_expired(batch_size)
+    for destination, names in sorted(swept.items()):
+        click.echo('{}: {:d} expired'.format(destination, len(names)))
+
+
+@flup.command()
+@click.option('--batch-size', default=100, show_default=True,
+              help='Files moved per index query.')
+@with_appcontext
+def tier(batch_size):
+    """Move uploads that have gone cold to their cold destination."""
+    moved = current_app.extensions['flup'].migrate_cold(batch_size)
+    for destination, names in sorted(moved.items()):
+        click.echo('{}: {:d} moved'.format(destination, len(names)))
+
+
+@flup.command()
+@click.option('--retry', is_flag=True,
+              help='Queue the copies that failed too often again.')
+@with_appcontext
+def replication(retry):
+    """Show how far replicas are behind."""
+    if retry:
+        retried = current_app.extensions['flup'].retry_replication()
+        for destination, count in sorted(retried.items()):
+            click.echo('{}: {:d} retried'.format(destination, count))
+    lag = current_app.extensions['flup'].replication_lag()
+    for destination, stats in sorted(lag.items()):
+        click.echo('{}: {:d} pending, {:d} failed, {:.1f}s behind'.format(
+            destination, stats['pending'], stats['failed'], stats['lag']))
+
+
+def upload_set(name):
+    uset = current_app.extensions['flup'].sets.get(name)
+    if uset is None or isinstance(uset, DynamicUploadSet):
+        raise click.BadParameter("no upload set {!r} with a static "
+                                 "configuration".format(name))
+    return bulk.SetEndpoint(uset)
+
+
+def endpoint(value):
+    """
+    The upload set called `value` if there is one, otherwise the directory.
+    """
+    if value in current_app.extensions['flup'].sets:
+        return upload_set(value)
+    if not os.path.isdir(value):
+        raise click.BadParameter("{!r} is neither an upload set nor a "
+                                 "directory".format(value))
+    return bulk.Directory(value)
+
+
+def copy_options(command):
+    for option in reversed([
+            click.option('--workers', default=8, show_default=True,
+                         help='Files copied at once.'),
+            click.option('--verify', default='size', show_default=True,
+                         type=click.Choice(['size', 'digest', 'none']),
+                         help='How each copy is checked.'),
+            click.option('--restart', is_flag=True,
+                         help='Ignore what earlier runs copied.')]):
+        command = option(command)
+    return command
+
+
+def run_copy(source, target, workers, verify, restart, delete=False):
+    counts = bulk.run(current_app._get_current_object(), source, target,
+                      workers, None if verify == 'none' else verify, delete,
+                      restart)
+    click.echo('{} -> {}: {:d} copied, {:d} skipped, {:d} failed, {:d} '
+               'already done'.format(source, target, counts[bulk.COPIED],
+                                     counts[bulk.SKIPPED],
+                                     counts[bulk.FAILED], counts['resumed']))
+    if counts[bulk.FAILED]:
+        raise SystemExit(1)
+
+
+@flup.command('import')
+@click.argument('source', type=click.Path(exists=True, file_okay=False))
+@click.argument('setname')
+@copy_options
+@with_appcontext
+def import_(source, setname, workers, verify, restart):
+    """Save the files under a directory to an upload set."""
+    run_copy(bulk.Directory(source), upload_set(setname), workers, verify,
+             restart)
+
+
+@flup.command()
+@click.argument('setname')
+@click.argument('target', type=click.Path(file_okay=False))
+@copy_options
+@with_appcontext
+def export(setname, target, workers, verify, restart):
+    """Copy the files of an upload set to a directory."""
+    run_copy(upload_set(setname), bulk.Directory(target), workers, verify,
+             restart)
+
+
+@flup.command()
+@click.argument('source')
+@click.argument('target')
+@copy_options
+@click.option('--delete', is_flag=True,
+              help='Remove each file from SOURCE once it is copied.')
+@with_appcontext
+def migrate(source, target, workers, verify, restart, delete):
+    """Move the files of one upload set to another."""
+    run_copy(upload_set(source), upload_set(target), workers, verify,
+             restart, delete)
+
+
+@flup.command()
+@click.argument('source')
+@click.argument('target')
+@click.option('--workers', default=8, show_default=True,
+              help='Files checked at once.')
+@click.option('--digest', is_flag=True,
+              help='Compare digests rather than sizes.')
+@with_appcontext
+def verify(source, target, workers, digest):
+    """Check the files copied from SOURCE to TARGET again."""
+    failed = bulk.verify(current_app._get_current_object(), endpoint(source),
+                         endpoint(target), workers, digest)
+    for copy in failed:
+        click.echo('{}: {}'.format(copy.source, copy.reason), err=True)
+    click.echo('{:d} copies differ'.format(len(failed)))
+    if failed:
+        raise SystemExit(1)
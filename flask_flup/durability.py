@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+flup.durability
+===============
+Durable saves for sets with ``UPLOADED_<SET>_DURABLE``: `UploadSet.save`
+only returns once the file and the directory entry naming it are on disk,
+and so is the mark that finishes its write journal entry, so that recovery
+after a power loss does not take the file for a half-written one.
+
+Rather than every save calling fsync on its own, concurrent saves in a
+process join a group commit. The first save to arrive leads the group: it
+waits up to ``UPLOADS_FSYNC_MAX_WAIT`` seconds, or until
+``UPLOADS_FSYNC_MAX_BATCH`` files have joined, then fsyncs every file and
+every directory of the group once and wakes the others. The number of
+fsyncs per second then stays roughly constant as concurrency grows.
+"""
+import os
+import threading
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Batch(object):
+    def __init__(self):
+        self.files = set()
+        self.directories = set()
+        self.led = False
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommit(object):
+    """
+    Batches the fsyncs of concurrent saves.
+
+    :param max_wait:  Seconds the leader of a group waits for others
+    :param max_batch: Files that close a group early
+    """
+    def __init__(self, max_wait=0.005, max_batch=64, fsync=fsync_path):
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.batch = Batch()
+        self.batches = 0
+        self.synced = 0
+
+    def sync(self, *paths, directories=()):
+        """
+        Return once the files at `paths`, and the directories they are in,
+        are on disk. Directories a save created are passed along with its
+        file, so that their entries in their parents are synced too.
+
+        :param directories: Directories whose entries must be on disk,
+                            such as one a file was removed from
+        """
+        with self.lock:
+            batch = self.batch
+            batch.files.update(paths)
+            batch.directories.update(os.path.dirname(os.path.abspath(p))
+                                     for p in paths)
+            batch.directories.update(directories)
+            leader = not batch.led
+            batch.led = True
+            if len(batch.files) >= self.max_batch:
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self.lock:
+                self.batch = Batch()
+            try:
+                # data first, then the entries that name it
+                for path in sorted(batch.files):
+                    self.fsync(path)
+                for path in sorted(batch.directories - batch.files):
+                    self.fsync(path)
+            except BaseException as e:
+                batch.error = e
+            with self.lock:
+                self.batches += 1
+                self.synced += len(batch.files)
+            batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
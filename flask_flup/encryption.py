@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+flup.encryption
+===============
+Encryption at rest for sets with an ``UPLOADED_<SET>_ENCRYPTION_KEY``. Each
+file is encrypted with its own AES-GCM key, which is stored in the file's
+header wrapped by the set's master key. The contents follow in chunks of
+`CHUNK_SIZE` bytes, each sealed separately, so files are encrypted as they
+are written and any byte range can be decrypted without reading what comes
+before it.
+
+Each chunk's nonce is the file's nonce prefix, the chunk's index and a flag
+marking the last chunk, so chunks cannot be reordered, and a file cannot be
+truncated at a chunk boundary without failing to decrypt.
+
+Needs the ``cryptography`` package.
+"""
+import base64
+import binascii
+import io
+import os
+import struct
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # pragma: no cover
+    AESGCM = None
+
+MAGIC = b'FLUPAE1\n'
+CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+NONCE_SIZE = 12
+PREFIX_SIZE = 7
+
+#: magic, chunk size, wrapping nonce and wrapped file key, nonce prefix
+HEADER = struct.Struct('>8sI{:d}s{:d}s'.format(NONCE_SIZE + 32 + TAG_SIZE,
+                                              PREFIX_SIZE))
+
+
+class DecryptionError(ValueError):
+    """
+    Raised for files that are not in this format, were encrypted with
+    another master key, or have been tampered with.
+    """
+
+
+def master_key(value):
+    """
+    The master key configured as `value`: 16, 24 or 32 bytes, or those
+    bytes base64 encoded.
+    """
+    if AESGCM is None:
+        raise RuntimeError("encryption at rest needs the cryptography "
+                           "package")
+    if not isinstance(value, bytes) or len(value) not in (16, 24, 32):
+        try:
+            value = base64.b64decode(value)
+        except (TypeError, ValueError, binascii.Error):
+            raise ValueError("encryption key is not valid base64")
+    if len(value) not in (16, 24, 32):
+        raise ValueError("encryption key must be 16, 24 or 32 bytes")
+    return value
+
+
+def chunk_nonce(prefix, index, last):
+    return prefix + struct.pack('>IB', index, int(last))
+
+
+class EncryptingWriter(object):
+    """
+    Writes what is written to it to `fileobj` encrypted with a new file
+    key, wrapped by `master`.
+    """
+    def __init__(self, fileobj, master, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        self.chunk_size = chunk_size
+        self.prefix = os.urandom(PREFIX_SIZE)
+        key = AESGCM.generate_key(bit_length=256)
+        self.aead = AESGCM(key)
+        nonce = os.urandom(NONCE_SIZE)
+        wrapped = AESGCM(master).encrypt(nonce, key,
+                                         struct.pack('>I', chunk_size))
+        fileobj.write(HEADER.pack(MAGIC, chunk_size, nonce + wrapped,
+                                  self.prefix))
+        self.buffer = bytearray()
+        self.index = 0
+        self.finished = False
+
+    def write(self, data):
+        self.buffer += data
+        # the last full chunk is held back until we know it is the last
+        while len(self.buffer) > self.chunk_size:
+            self.seal(bytes(self.buffer[:self.chunk_size]), False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def seal(self, chunk, last):
+        self.fileobj.write(self.aead.encrypt(
+            chunk_nonce(self.prefix, self.index, last), chunk, None))
+        self.index += 1
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def finish(self):
+        """
+        Write the last chunk and flush, leaving `fileobj` open.
+        """
+        if not self.finished:
+            self.seal(bytes(self.buffer), True)
+            self.buffer = bytearray()
+            self.finished = True
+            self.fileobj.flush()
+
+    def close(self):
+        self.finish()
+        self.fileobj.close()
+
+
+class DecryptingReader(io.RawIOBase):
+    """
+    A seekable, read-only view of the plaintext of an encrypted file. Only
+    the chunk being read is held in memory.
+
+    :param fileobj: The encrypted file, open for reading in binary mode
+    :param master:  The master key its file key is wrapped with
+    """
+    def __init__(self, fileobj, master):
+        io.RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        fileobj.seek(0)
+        header = fileobj.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise DecryptionError("file too short")
+        magic, self.chunk_size, wrapped, self.prefix = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise DecryptionError("not an encrypted upload")
+        try:
+            key = AESGCM(master).decrypt(wrapped[:NONCE_SIZE],
+                                         wrapped[NONCE_SIZE:],
+                                         struct.pack('>I', self.chunk_size))
+        except InvalidTag:
+            raise DecryptionError("file key does not unwrap with this key")
+        self.aead = AESGCM(key)
+        frame = self.chunk_size + TAG_SIZE
+        stored = os.fstat(fileobj.fileno()).st_size - HEADER.size
+        self.chunks = max(1, -(-stored // frame))
+        self.size = stored - self.chunks * TAG_SIZE
+        if self.size < 0:
+            raise DecryptionError("file truncated")
+        self.position = 0
+        self.cached = (None, b'')
+
+    def chunk(self, index):
+        if self.cached[0] != index:
+            frame = self.chunk_size + TAG_SIZE
+            self.fileobj.seek(HEADER.size + index * frame)
+            sealed = self.fileobj.read(frame)
+            last = index == self.chunks - 1
+            try:
+                plain = self.aead.decrypt(
+                    chunk_nonce(self.prefix, index, last), sealed, None)
+            except InvalidTag:
+                raise DecryptionError("chunk {:d} does not authenticate"
+                                      .format(index))
+            self.cached = (index, plain)
+        return self.cached[1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        parts = []
+        while size > 0 and self.position < self.size:
+            index, offset = divmod(self.position, self.chunk_size)
+            data = self.chunk(index)[offset:offset + size]
+            parts.append(data)
+            self.position += len(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position {:d}".format(offset))
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.close()
+        io.RawIOBase.close(self)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+flup.filesystem
+===============
+The file operations behind saving, staging, conflict resolution, the write
+journal and the `_uploads` view, so that they can run against something
+other than the local disk. `Flup` uses the filesystem given as
+``UPLOADS_FILESYSTEM``: `LocalFilesystem` by default, or a
+`MemoryFilesystem`, which keeps everything in a dict and makes tests and
+load runs independent of disk speed.
+
+Only that core path goes through the filesystem. Features that keep
+indexes or sidecars of their own (digests, expiry, tiering, replication,
+encryption, scanning, metadata, durability) need a local one.
+"""
+import errno
+import io
+import mimetypes
+import os
+import posixpath
+import threading
+import time
+import zlib
+from itertools import chain
+
+from flask import current_app, request, send_from_directory
+from werkzeug.exceptions import NotFound
+
+
+class LocalFilesystem(object):
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def makedirs(self, path):
+        """
+        `os.makedirs` that tolerates another process creating the directory
+        first.
+        """
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+
+    def open(self, path, mode='rb'):
+        return io.open(path, mode)
+
+    def unlink(self, path):
+        os.unlink(path)
+
+    def rename(self, source, target):
+        os.rename(source, target)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def getmtime(self, path):
+        return os.path.getmtime(path)
+
+    def send(self, directory, filename, **options):
+        return send_from_directory(directory, filename, **options)
+
+
+class MemoryFile(io.BytesIO):
+    """
+    A file of a `MemoryFilesystem` open for writing. Its contents are
+    stored when it is closed.
+    """
+    def __init__(self, filesystem, path):
+        io.BytesIO.__init__(self)
+        self.filesystem = filesystem
+        self.name = path
+
+    def close(self):
+        if not self.closed:
+            self.filesystem.store(self.name, self.getvalue())
+        io.BytesIO.close(self)
+
+
+class MemoryFilesystem(object):
+    """
+    A filesystem held in memory. Paths are normalized, so ``/uploads/a``
+    and ``/uploads//a`` are the same file. Creating, renaming and removing
+    files are atomic, as on a local disk.
+    """
+    def __init__(self):
+        self.files = {}
+        self.mtimes = {}
+        self.directories = set(['/'])
+        self.lock = threading.Lock()
+
+    def normalize(self, path):
+        return posixpath.normpath(posixpath.join('/', path))
+
+    def error(self, code, path):
+        return OSError(code, os.strerror(code), path)
+
+    def exists(self, path):
+        path = self.normalize(path)
+        return path in self.files or path in self.directories
+
+    def isfile(self, path):
+        return self.normalize(path) in self.files
+
+    def makedirs(self, path):
+        path = self.normalize(path)
+        with self.lock:
+            while path not in self.directories:
+                if path in self.files:
+                    raise self.error(errno.ENOTDIR, path)
+                self.directories.add(path)
+                path = posixpath.dirname(path)
+
+    def check_parent(self, path):
+        if posixpath.dirname(path) not in self.directories:
+            raise self.error(errno.ENOENT, path)
+
+    def open(self, path, mode='rb'):
+        path = self.normalize(path)
+        binary = 'b' in mode
+        if 'r' in mode:
+            with self.lock:
+                if path not in self.files:
+                    raise self.error(errno.ENOENT, path)
+                f = io.BytesIO(self.files[path])
+        else:
+            with self.lock:
+                self.check_parent(path)
+                if 'x' in mode and path in self.files:
+                    raise self.error(errno.EEXIST, path)
+                if path in self.directories:
+                    raise self.error(errno.EISDIR, path)
+                self.files[path] = b''
+                self.mtimes[path] = time.time()
+            f = MemoryFile(self, path)
+        return f if binary else io.TextIOWrapper(f, encoding='utf-8')
+
+    def store(self, path, data):
+        with self.lock:
+            if path in self.files:
+                self.files[path] = data
+                self.mtimes[path] = time.time()
+
+    def unlink(self, path):
+        path = self.normalize(path)
+        with self.lock:
+            if self.files.pop(path, None) is None:
+                raise self.error(errno.ENOENT, path)
+            self.mtimes.pop(path, None)
+
+    def rename(self, source, target):
+        source, target = self.normalize(source), self.normalize(target)
+        with self.lock:
+            if source not in self.files:
+                raise self.error(errno.ENOENT, source)
+            self.check_parent(target)
+            self.files[target] = self.files.pop(source)
+            self.mtimes[target] = self.mtimes.pop(source)
+
+    def listdir(self, path):
+        path = self.normalize(path)
+        with self.lock:
+            if path not in self.directories:
+                raise self.error(errno.ENOENT, path)
+            return sorted(set(
+                posixpath.basename(p)
+                for p in chain(self.files, self.directories)
+                if p != path and posixpath.dirname(p) == path))
+
+    def getmtime(self, path):
+        path = self.normalize(path)
+        with self.lock:
+            if path not in self.mtimes:
+                raise self.error(errno.ENOENT, path)
+            return self.mtimes[path]
+
+    def read(self, path):
+        with self.open(path) as f:
+            return f.read()
+
+    def send(self, directory, filename, mimetype=None, add_etags=True,
+             conditional=True, **options):
+        """
+        Respond with a file, like `flask.send_from_directory`.
+        """
+        path = self.normalize(posixpath.join(directory, filename))
+        if not path.startswith(self.normalize(directory) + '/'):
+            raise NotFound()
+        with self.lock:
+            if path not in self.files:
+                raise NotFound()
+            data, mtime = self.files[path], self.mtimes[path]
+        response = current_app.response_class(
+            data, mimetype=mimetype or mimetypes.guess_type(filename)[0] or
+            'application/octet-stream')
+        response.last_modified = int(mtime)
+        response.cache_control.public = True
+        if add_etags:
+            response.set_etag('memory-{:.0f}-{:d}-{:d}'.format(
+                mtime, len(data), zlib.adler32(path.encode('utf-8'))))
+        if conditional:
+            response = response.make_conditional(
+                request, accept_ranges=True, complete_length=len(data))
+        return response
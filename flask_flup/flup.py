@@ -5,11 +5,30 @@ flup
 This module provides upload support for Flask. The basic pattern is to set up
 an `UploadSet` object and upload your files to it.
 """
+import errno
+import functools
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
 import os.path
 import posixpath
-from flask import current_app, Blueprint, send_from_directory, abort, url_for
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+from flask import (current_app, Blueprint, abort, url_for, request,
+                   has_app_context, has_request_context, jsonify, safe_join)
 from itertools import chain
 from werkzeug import secure_filename, FileStorage, LocalProxy
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import wrap_file
+from . import (durability, encryption, filesystem, ingest, integrity,
+               metadata, progress, quotas, replication, retention,
+               scanning, throttling, tiering)
 
 _flup = LocalProxy(lambda: current_app.extensions['flup'])
 
@@ -38,10 +57,44 @@ ALL = All()
 DEFAULTS = TEXT + DOCUMENTS + IMAGES + DATA
 
 
+STATE_DIR = '.flup'
+
+
 class UploadNotAllowed(Exception):
     pass
 
 
+class ReplicationTimeout(Exception):
+    """
+    Raised when a set's ``UPLOADED_<SET>_REPLICA_WAIT`` copies were not made
+    in time. The file itself was saved as `name` and is still being
+    replicated.
+    """
+    def __init__(self, name, copied, wanted):
+        Exception.__init__(self, "{} of {} replicas of {} copied".format(
+            copied, wanted, name))
+        self.name = name
+        self.copied = copied
+        self.wanted = wanted
+
+
+class UploadInfected(UploadNotAllowed):
+    """
+    Raised when the scanner finds malware in an upload. The file is kept in
+    the destination's quarantine area and not saved.
+    """
+    def __init__(self, signature):
+        UploadNotAllowed.__init__(self, "upload infected with {}".format(
+            signature))
+        self.signature = signature
+
+
+class DigestMismatch(UploadNotAllowed):
+    """
+    Raised when a saved file does not match the digest its client sent.
+    """
+
+
 def tuple_from(*iters):
     return tuple(itertools.chain(*iters))
 
@@ -64,21 +117,586 @@ def addslash(url):
     return url + '/'
 
 
+def state_path(destination, *parts):
+    """
+    The path of flup's bookkeeping files under `destination`. These live in
+    a hidden directory that uploaded names can never collide with, since
+    `secure_filename` strips leading dots.
+    """
+    return os.path.join(destination, STATE_DIR, *parts)
+
+
+def claim_path(destination, target):
+    """
+    The path of the claim a staged upload holds on the name `target` under
+    `destination` until it is committed. Claims live in the state
+    directory, so nothing is visible at `target` in the meantime.
+    """
+    name = os.path.relpath(target, destination).replace(os.sep, '/')
+    return state_path(destination, 'claims',
+                      hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+
+LOCAL = filesystem.LocalFilesystem()
+
+
+def current_filesystem():
+    """
+    The ``UPLOADS_FILESYSTEM`` of the current application, or the local
+    one outside an application context. See `filesystem`.
+    """
+    if has_app_context():
+        flup = current_app.extensions.get('flup')
+        if flup is not None:
+            return flup.filesystem
+    return LOCAL
+
+
+def makedirs(path):
+    """
+    `os.makedirs` that tolerates another process creating the directory
+    first.
+    """
+    current_filesystem().makedirs(path)
+
+
+def open_exclusive(path):
+    """
+    Create `path` for writing, failing with `FileExistsError` if it is
+    already there. The check and the create are one atomic step, also on
+    NFSv3 and later.
+    """
+    return current_filesystem().open(path, 'xb')
+
+
+def create_state_file(path, mode='xb'):
+    """
+    Exclusively create a bookkeeping file, making its directory on first
+    use.
+    """
+    fs = current_filesystem()
+    try:
+        return fs.open(path, mode)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    fs.makedirs(os.path.dirname(path))
+    return fs.open(path, mode)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WriteJournal(object):
+    """
+    Records writes in flight under a destination so that files left
+    half-written by a crashed worker can be removed at startup.
+
+    Every write gets its own small entry file, so workers on any number of
+    hosts sharing the destination never contend on the journal itself.
+
+    Removing an entry is not durable by itself, so an entry can come back
+    after a power loss. Durable saves therefore mark their entry finished
+    with `complete` and sync that before returning; recovery keeps the
+    files of finished entries.
+
+    :param destination: The upload set destination the journal belongs to
+    """
+    hostname = socket.gethostname()
+
+    #: The suffix of the entries of finished writes.
+    DONE = '.done'
+
+    #: Entries written by this process that are still in flight.
+    active = set()
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.directory = state_path(destination, 'journal')
+
+    def begin(self, target, claim=None, staged=None):
+        """
+        Record a write to `target`, or, for a staged upload, the `claim` it
+        holds on `target` and the path it is `staged` at.
+        """
+        entry = os.path.join(self.directory, uuid.uuid4().hex)
+        record = {'host': self.hostname, 'pid': os.getpid(),
+                  'path': os.path.relpath(target, self.destination)}
+        if claim is not None:
+            record['claim'] = os.path.relpath(claim, self.destination)
+        if staged is not None:
+            record['staged'] = os.path.relpath(staged, self.destination)
+        record = json.dumps(record)
+        with create_state_file(entry, 'x') as f:
+            f.write(record)
+        self.active.add(entry)
+        return entry
+
+    def complete(self, entry):
+        """
+        Mark the write of `entry` as finished. The mark is only durable
+        once the journal directory is synced.
+
+        :returns: The entry's new path, to pass to `end`.
+        """
+        done = entry + self.DONE
+        current_filesystem().rename(entry, done)
+        self.active.discard(entry)
+        return done
+
+    def end(self, entry):
+        self.active.discard(entry)
+        try:
+            current_filesystem().unlink(entry)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def entries(self):
+        try:
+            names = current_filesystem().listdir(self.directory)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        for name in names:
+            yield os.path.join(self.directory, name)
+
+    def is_stale(self, entry, record, max_age=None):
+        if entry in self.active:
+            return False
+        if record.get('host') == self.hostname:
+            pid = record.get('pid')
+            if pid == os.getpid() or not _pid_alive(pid):
+                return True
+        if max_age is not None:
+            try:
+                return time.time() - \
+                    current_filesystem().getmtime(entry) > max_age
+            except OSError:
+                return False
+        return False
+
+    def recover(self, max_age=None):
+        """
+        Remove the targets of interrupted writes and their entries. Entries
+        made by other hosts are only considered interrupted once they are
+        older than `max_age` seconds. A staged upload whose commit was
+        interrupted after its file was moved into place is kept, and only
+        its claim released; otherwise its staged file goes.
+
+        :returns: The paths of the removed partial files, relative to the
+                  destination.
+        """
+        fs = current_filesystem()
+        removed = []
+        for entry in self.entries():
+            try:
+                with fs.open(entry, 'r') as f:
+                    record = json.loads(f.read() or '{}')
+            except (IOError, OSError, ValueError):
+                record = {}
+            if entry.endswith(self.DONE):
+                self.end(entry)
+                continue
+            if not self.is_stale(entry, record, max_age):
+                continue
+            path = record.get('path')
+            staged = record.get('staged')
+            if staged is None:
+                names = [path]
+            elif path and fs.exists(os.path.join(self.destination, path)) \
+                    and not fs.exists(os.path.join(self.destination, staged)):
+                path, names = None, []
+            else:
+                path, names = staged, [staged]
+            for name in names + [record.get('claim')]:
+                if name:
+                    try:
+                        fs.unlink(os.path.join(self.destination, name))
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+            if path:
+                removed.append(path)
+            self.end(entry)
+        return removed
+
+
 class UploadConfiguration(object):
-    def __init__(self, destination, base_url=None, allow=(), deny=()):
+    def __init__(self, destination, base_url=None, allow=(), deny=(),
+                 max_size=None, digests=(), ttl=None, cold_destination=None,
+                 cold_after=tiering.COLD_AFTER, replicas=(), replica_wait=0,
+                 encryption_key=None, scan=None, scan_mode='sync',
+                 metadata=False, rate=None, burst=None, max_downloads=None,
+                 durable=False, quota=None):
         self.destination = destination
         self.base_url = base_url
         self.allow = allow
         self.deny = deny
+        self.max_size = max_size
+        self.digests = digests
+        self.ttl = ttl
+        self.cold_destination = cold_destination
+        self.cold_after = cold_after
+        self.replicas = replicas
+        self.replica_wait = replica_wait
+        self.encryption_key = encryption_key
+        self.scan = scan
+        self.scan_mode = scan_mode
+        self.metadata = metadata
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.max_downloads = max_downloads
+        self.durable = durable
+        self.quota = quota
 
     @property
     def tuple(self):
-        return (self.destination, self.base_url, self.allow, self.deny)
+        return (self.destination, self.base_url, self.allow, self.deny,
+                self.max_size, self.digests, self.ttl, self.cold_destination,
+                self.cold_after, self.replicas, self.replica_wait,
+                self.encryption_key, self.scan, self.scan_mode,
+                self.metadata, self.rate, self.burst, self.max_downloads,
+                self.durable, self.quota)
 
     def __eq__(self, other):
         return self.tuple == other.tuple
 
 
+class UploadConfigurations(dict):
+    """
+    The configurations of a `Flup` instance's sets with a static
+    configuration, keyed by set name. A set's configuration is only read
+    from the application config the first time it is looked up, so startup
+    cost does not grow with the number of sets. Listing the values or
+    items reads every set's; `resolved` gives those read so far.
+    """
+    def __init__(self, flup):
+        dict.__init__(self)
+        self.flup = flup
+
+    def __missing__(self, name):
+        config = self.flup.resolve_config(name)
+        self[name] = config
+        return config
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        uset = self.flup.sets.get(name)
+        return uset is not None and not isinstance(uset, DynamicUploadSet)
+
+    def keys(self):
+        return [name for name, uset in self.flup.sets.items()
+                if not isinstance(uset, DynamicUploadSet)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def resolved(self):
+        """
+        The configurations read so far.
+        """
+        return list(dict.values(self))
+
+
+class SavedName(str):
+    """
+    The name `UploadSet.save` returns. It is a plain string that also
+    carries the hex digests computed while saving, keyed by algorithm, and
+    what the upload said about itself.
+    """
+    folder = None
+    original = None
+    content_type = None
+    owner = None
+
+
+def saved_name(folder, basename, storage=None, owner=None):
+    if folder:
+        saved = SavedName(posixpath.join(folder, basename))
+        saved.folder = folder
+    else:
+        saved = SavedName(basename)
+    saved.digests = {}
+    if storage is not None:
+        saved.original = storage.filename
+        saved.content_type = storage.mimetype or None
+    saved.owner = owner
+    return saved
+
+
+class StagedUpload(object):
+    """
+    A file written by `UploadSet.stage` that is not published yet.
+
+    :param uset:    The set it was staged for
+    :param config:  The configuration of the set it was staged with
+    :param name:    The name it will have once committed, a `SavedName`
+    :param target:  The path of its claimed final location
+    :param path:    The path of the staged file
+    :param entry:   Its write journal entry
+    :param claim:   The path of its claim on `target`; see `claim_path`
+    :param created: The directories created for it, which durable commits
+                    sync
+    """
+    def __init__(self, uset, config, name, target, path, entry, claim,
+                 created=()):
+        self.uset = uset
+        self.config = config
+        self.destination = config.destination
+        self.name = name
+        self.target = target
+        self.path = path
+        self.entry = entry
+        self.claim = claim
+        self.created = created
+        self.state = 'staged'
+
+    def commit(self):
+        """
+        Move the file into place and return its name.
+        """
+        if self.state != 'staged':
+            raise RuntimeError("upload already {}".format(self.state))
+        journal = WriteJournal(self.destination)
+        current_filesystem().rename(self.path, self.target)
+        try:
+            if self.config.durable:
+                _flup.group_commit.sync(self.target, *self.created)
+            copies = self.uset.published(self.config, self.target, self.name)
+            current_filesystem().unlink(self.claim)
+            if self.config.durable:
+                self.entry = journal.complete(self.entry)
+                _flup.group_commit.sync(directories=[journal.directory])
+        except BaseException:
+            # as in save, a file that could not be published is removed
+            self.path = self.target
+            self.uset.unpublished(self.config, self.name)
+            self.rollback()
+            raise
+        journal.end(self.entry)
+        self.state = 'committed'
+        self.uset.await_replicas(self.config, self.name, copies)
+        return self.name
+
+    def rollback(self):
+        """
+        Delete the staged file and release its name.
+        """
+        if self.state != 'staged':
+            raise RuntimeError("upload already {}".format(self.state))
+        fs = current_filesystem()
+        for path in (self.path, self.claim):
+            try:
+                fs.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        WriteJournal(self.destination).end(self.entry)
+        self.state = 'rolled back'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.state == 'staged':
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+
+
+def sweep_staging(destination, max_age):
+    """
+    Delete staged and ingested files under `destination` older than
+    `max_age` seconds, left behind by requests that crashed or never
+    settled them, and release the names they had claimed.
+
+    :returns: How many files were deleted.
+    """
+    fs = current_filesystem()
+    cutoff = time.time() - max_age
+    removed = 0
+    for area in ('staging', 'ingest'):
+        directory = state_path(destination, area)
+        try:
+            names = fs.listdir(directory)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if fs.getmtime(path) < cutoff:
+                    fs.unlink(path)
+                    removed += 1
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+    WriteJournal(destination).recover(max_age)
+    return removed
+
+
+def open_upload(config, path):
+    """
+    Open the file at `path` in a set with configuration `config` for
+    reading its contents, decrypting them if the set is encrypted.
+    """
+    f = io.open(path, 'rb')
+    if config.encryption_key is None:
+        return f
+    return encryption.DecryptingReader(f, config.encryption_key)
+
+
+def scan_upload(config, name, timeout=30):
+    """
+    Scan the saved file `name` of a set with configuration `config`, for
+    sets scanning in ``'async'`` mode. An infected file is quarantined and
+    removed.
+
+    :returns: The matched signature, or None.
+    """
+    state_dir = state_path(config.destination)
+    verdicts = scanning.verdict_index(state_dir)
+    verdicts.renew(name)
+    path = os.path.join(config.destination, name)
+    digester = integrity.Digester(('sha256',))
+    try:
+        with open_upload(config, path) as f:
+            scan = scanning.ClamdStream(config.scan, timeout)
+            for chunk in iter(lambda: f.read(scanning.FRAME_SIZE), b''):
+                digester.update(chunk)
+                scan.update(chunk)
+            signature = scan.verdict()
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        verdicts.done(name)
+        return None
+    digest = digester.hexdigests()['sha256']
+    verdicts.record(digest, signature)
+    if signature is not None:
+        scanning.quarantine(path, state_dir, digest)
+        remove_upload(config, name)
+        logging.getLogger(__name__).warning(
+            "quarantined %s in %s: %s", name, config.destination, signature)
+    verdicts.done(name)
+    return signature
+
+
+def remove_upload(config, name):
+    """
+    Delete the saved file `name`, wherever it lives, and what was recorded
+    about it.
+    """
+    state_dir = state_path(config.destination)
+    directory = config.destination
+    if config.cold_destination is not None:
+        index = tiering.tier_index(state_dir)
+        if index.location(name) == tiering.COLD:
+            directory = config.cold_destination
+        index.remove(name)
+    os.unlink(os.path.join(directory, name))
+    integrity.remove_digests(state_dir, name)
+    if config.metadata:
+        metadata.metadata_index(state_dir).remove(name)
+    if config.quota is not None:
+        quotas.usage_index(state_dir).release(name)
+    for replica in config.replicas:
+        try:
+            os.unlink(os.path.join(replica, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def migrate_cold(config, batch_size=100, now=None):
+    if config.cold_destination is None:
+        return []
+    index = tiering.tier_index(state_path(config.destination))
+    return tiering.migrate(index, config.destination,
+                           config.cold_destination, config.cold_after,
+                           batch_size, now)
+
+
+def sweep_expired(config, batch_size=500, now=None):
+    """
+    Delete the files of a set with configuration `config` whose time to
+    live has passed. See `retention.sweep`.
+    """
+    index = retention.expiry_index(state_path(config.destination))
+    return retention.sweep(index, lambda name: remove_upload(config, name),
+                           batch_size, now)
+
+
+class TargetWriter(object):
+    """
+    The file object handed to `FileStorage.save`. Every chunk is shown to
+    each of `observers` (objects with an `update(data)` method) before it
+    is written, which lets the save pipeline enforce limits and collect
+    statistics in the same pass that writes the file.
+    """
+    def __init__(self, fileobj, observers=()):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.observers = list(observers)
+
+    def write(self, data):
+        for observer in self.observers:
+            observer.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        for observer in self.observers:
+            if hasattr(observer, 'close'):
+                observer.close()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SizeLimit(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise UploadNotAllowed("upload exceeds {:d} bytes"
+                                   .format(self.limit))
+
+
 class UploadSet:
     def __init__(self, name='files', extensions=DEFAULTS):
         if not name.isalnum():
@@ -105,11 +723,21 @@ class UploadSet:
             return base + filename
 
     def path(self, filename, folder=None):
+        config = self.config
         if folder:
-            target_folder = os.path.join(self.config.destination, folder)
-        else:
-            target_folder = self.config.destination
-        return os.path.join(target_folder, filename)
+            filename = posixpath.join(folder, filename)
+        return os.path.join(self.directory_of(config, filename), filename)
+
+    def directory_of(self, config, filename):
+        """
+        The destination `filename` lives in: the set's destination, or its
+        cold destination once the file has been moved there.
+        """
+        if config.cold_destination is not None:
+            index = tiering.tier_index(state_path(config.destination))
+            if index.location(filename) == tiering.COLD:
+                return config.cold_destination
+        return config.destination
 
     def file_allowed(self, storage, basename):
         return self.extension_allowed(extension(basename))
@@ -118,7 +746,195 @@ class UploadSet:
         return ((ext in self.config.allow) or
                 (ext in self.extensions and ext not in self.config.deny))
 
-    def save(self, storage, folder=None, name=None):
+    def save(self, storage, folder=None, name=None, owner=None):
+        """
+        Save `storage` to this set and return the name it was saved as.
+
+        :param folder: The subfolder to save it in
+        :param name:   The name to save it as, rather than its own
+        :param owner:  Who uploaded it, for sets that record metadata
+        """
+        config, folder, basename = self.prepare(storage, folder, name)
+        destination = config.destination
+        target_folder, created = self.target_folder(destination, folder)
+
+        basename, dst = self.create_target(target_folder, basename,
+                                           destination)
+        saved = saved_name(folder, basename, storage, owner)
+        journal = WriteJournal(destination)
+        entry = journal.begin(dst.name)
+        try:
+            saved.digests = self.write_file(storage, dst, config)
+            if config.durable:
+                _flup.group_commit.sync(dst.name, *created)
+            copies = self.published(config, dst.name, saved)
+            if config.durable:
+                # otherwise the entry can outlive a power loss, and recovery
+                # would remove a file reported as saved
+                entry = journal.complete(entry)
+                _flup.group_commit.sync(directories=[journal.directory])
+        except BaseException:
+            current_filesystem().unlink(dst.name)
+            self.unpublished(config, saved)
+            journal.end(entry)
+            raise
+        journal.end(entry)
+        self.await_replicas(config, saved, copies)
+        return saved
+
+    def stage(self, storage, folder=None, name=None, owner=None):
+        """
+        Write `storage` into the destination's staging area instead of its
+        final place. The final name is claimed straight away, so it can be
+        stored elsewhere (in a database, say) before the file is published
+        with `StagedUpload.commit`, a single rename, or thrown away with
+        `StagedUpload.rollback`. The claim is kept in the state directory
+        (see `claim_path`), so until the commit nothing is at the final
+        name for the `_uploads` view or another web server to serve.
+
+        Inside a request, uploads that are neither committed nor rolled
+        back when the request ends are settled according to
+        ``UPLOADS_STAGED_DEFAULT``: ``'rollback'`` (the default) or
+        ``'commit'``, which still rolls back if the request failed.
+
+        Arguments are as for `save`.
+
+        :returns: A `StagedUpload`, which also works as a context manager
+                  that commits unless its block raises.
+        """
+        config, folder, basename = self.prepare(storage, folder, name)
+        destination = config.destination
+        target_folder, created = self.target_folder(destination, folder)
+
+        basename, claim = self.create_target(target_folder, basename,
+                                             destination, claim=True)
+        claim.close()
+        target = os.path.join(target_folder, basename)
+        journal = WriteJournal(destination)
+        path = state_path(destination, 'staging', uuid.uuid4().hex)
+        entry = journal.begin(target, claim.name, path)
+        try:
+            dst = create_state_file(path)
+            try:
+                digests = self.write_file(storage, dst, config)
+            except BaseException:
+                current_filesystem().unlink(dst.name)
+                raise
+        except BaseException:
+            current_filesystem().unlink(claim.name)
+            journal.end(entry)
+            raise
+        saved = saved_name(folder, basename, storage, owner)
+        saved.digests = digests
+        staged = StagedUpload(self, config, saved, target, dst.name, entry,
+                              claim.name, created)
+        if has_request_context():
+            request.environ.setdefault('flup.staged', []).append(staged)
+        return staged
+
+    def published(self, config, path, saved):
+        """
+        Record what is known about a file that has just been put in place
+        at `path` under the name `saved`, and queue its replication.
+
+        :returns: The `replication.Replicas` of the file, or None.
+        """
+        state_dir = state_path(config.destination)
+        if config.quota is not None and not quotas.usage_index(
+                state_dir).charge(saved, os.path.getsize(path), config.quota):
+            raise UploadNotAllowed("quota of {:d} bytes exceeded"
+                                   .format(config.quota))
+        if saved.digests:
+            integrity.store_digests(path, state_dir, saved, saved.digests)
+        if config.ttl is not None:
+            retention.expiry_index(state_dir).add(saved,
+                                                  time.time() + config.ttl)
+        if config.cold_destination is not None:
+            tiering.tier_index(state_dir).add(saved)
+        if config.metadata:
+            self.record(config, path, saved)
+        if config.scan is not None and config.scan_mode == 'async' and \
+                not self.verdict(config, saved.digests.get('sha256'))[0]:
+            scanning.verdict_index(state_dir).queue(saved)
+            _flup.submit_scan(config, saved)
+        if config.replicas:
+            return _flup.replicator.submit(
+                replication.replication_log(state_dir), config.destination,
+                saved, config.replicas)
+
+    def unpublished(self, config, saved):
+        """
+        Give back the quota taken by `published` for a file that was
+        removed again because its save failed.
+        """
+        if config.quota is not None:
+            quotas.usage_index(state_path(config.destination)).release(saved)
+
+    def record(self, config, path, saved):
+        """
+        Add `saved` to the set's metadata index. Inside a request the
+        records are written together when it ends.
+        """
+        if config.encryption_key is None:
+            size = os.path.getsize(path)
+        else:
+            with open_upload(config, path) as f:
+                size = f.seek(0, io.SEEK_END)
+        index = metadata.metadata_index(state_path(config.destination))
+        index.add(metadata.Upload(saved, saved.original, saved.owner,
+                                  saved.folder, extension(saved),
+                                  saved.content_type, size,
+                                  saved.digests.get('sha256'), time.time()))
+        if has_request_context():
+            request.environ.setdefault('flup.metadata', set()).add(index)
+
+    def query(self, **filters):
+        """
+        Look up the files saved to this set. See
+        `metadata.MetadataIndex.query` for the filters.
+
+        :returns: A page of `metadata.Upload` records, newest first, and
+                  the cursor of the next page or None.
+        """
+        return metadata.metadata_index(
+            state_path(self.config.destination)).query(**filters)
+
+    def await_replicas(self, config, saved, copies):
+        """
+        Wait for ``UPLOADED_<SET>_REPLICA_WAIT`` copies of `saved`, for at
+        most ``UPLOADS_REPLICA_TIMEOUT`` seconds.
+        """
+        wanted = min(config.replica_wait, len(config.replicas))
+        if copies is None or wanted <= 0:
+            return
+        timeout = current_app.config.get('UPLOADS_REPLICA_TIMEOUT', 30)
+        if not copies.wait(wanted, timeout):
+            raise ReplicationTimeout(saved, copies.copied, wanted)
+
+    def migrate_cold(self, batch_size=100):
+        """
+        Move files of this set that have gone cold to its cold
+        destination. See `tiering.migrate`.
+
+        :returns: The names of the moved files.
+        """
+        return migrate_cold(self.config, batch_size)
+
+    def sweep_expired(self, batch_size=500):
+        """
+        Delete the files of this set whose time to live has passed.
+
+        :returns: The names of the deleted files.
+        """
+        return sweep_expired(self.config, batch_size)
+
+    def prepare(self, storage, folder, name):
+        """
+        Check that `storage` may be saved to this set.
+
+        :returns: The set's configuration and the folder and basename the
+                  file should be saved as.
+        """
         if not isinstance(storage, FileStorage):
             raise TypeError("storage must be a werkzeug.FileStorage")
 
@@ -133,35 +949,524 @@ class UploadSet:
             else:
                 basename = name
 
+        config = self.config
         if not self.file_allowed(storage, basename):
             raise UploadNotAllowed()
+        if config.max_size is not None and \
+                storage.content_length > config.max_size:
+            raise UploadNotAllowed("upload exceeds {:d} bytes"
+                                   .format(config.max_size))
+        if self.over_quota(config, storage.content_length):
+            raise UploadNotAllowed("quota of {:d} bytes exceeded"
+                                   .format(config.quota))
+        reason = getattr(storage.stream, 'reason', None)
+        if reason is not None:
+            raise UploadNotAllowed(reason)
+        return config, folder, basename
+
+    def over_quota(self, config, content_length):
+        """
+        Whether an upload of the declared `content_length` cannot fit in
+        the quota, so it can be refused before it is written. What was
+        actually written is charged by `published`.
+        """
+        if config.quota is None or not content_length:
+            return False
+        used = quotas.usage_index(state_path(config.destination)).used()
+        return used + content_length > config.quota
+
+    def target_folder(self, destination, folder):
+        """
+        Make sure the folder `folder` of `destination` exists.
 
+        :returns: Its path, and the paths of the directories this created,
+                  whose entries durable saves also sync.
+        """
         if folder:
-            target_folder = os.path.join(self.config.destination, folder)
+            target_folder = os.path.join(destination, folder)
         else:
-            target_folder = self.config.destination
-        if not os.path.exists(target_folder):
-            os.makedirs(target_folder)
-        if os.path.exists(os.path.join(target_folder, basename)):
-            basename = self.resolve_conflict(target_folder, basename)
+            target_folder = destination
+        fs = current_filesystem()
+        created = []
+        missing = target_folder
+        while not fs.exists(missing):
+            created.append(missing)
+            missing = os.path.dirname(missing)
+        if created:
+            fs.makedirs(target_folder)
+        return target_folder, created
 
-        target = os.path.join(target_folder, basename)
-        storage.save(target)
-        if folder:
-            return posixpath.join(folder, basename)
+    def write_file(self, storage, dst, config):
+        """
+        Fill the open file `dst` with the contents of `storage` and close
+        it. A part parsed by `ingest` into the same destination is moved
+        over `dst` rather than copied. Digests sent by the client are
+        checked against what was written.
+
+        :returns: The hex digests of the file, keyed by algorithm.
+        """
+        stream = storage.stream
+        try:
+            expected = integrity.expected_digests(storage.headers)
+        except ValueError as e:
+            raise DigestMismatch(str(e))
+        algorithms = set(config.digests).union(expected)
+        scan = None
+        if config.scan is not None or config.metadata:
+            algorithms.add('sha256')
+        if isinstance(stream, ingest.IngestFile) and \
+                stream.destination == config.destination:
+            dst.close()
+            if stream.published is not None:
+                raise ingest.AlreadyPublished(stream.published)
+            digests = stream.digests
+            missing = algorithms.difference(digests)
+            if missing:
+                stream.seek(0)
+                digests.update(integrity.stream_digests(stream, missing))
+            stream.publish(dst.name)
+            counter = self.progress_counter()
+            if counter is not None:
+                counter.update_size(stream.size)
+                counter.close()
         else:
-            return basename
+            if config.scan is not None and config.scan_mode == 'sync' and \
+                    not self.verdict(config, expected.get('sha256'))[0]:
+                scan = scanning.ClamdStream(
+                    config.scan,
+                    current_app.config.get('UPLOADS_SCAN_TIMEOUT', 30))
+            digests = self.write_target(storage, dst, config, algorithms,
+                                        scan)
+        for algorithm, value in expected.items():
+            if digests[algorithm] != value:
+                if scan is not None:
+                    scan.hangup()
+                raise DigestMismatch("{} digest of {} does not match"
+                                     .format(algorithm, storage.filename))
+        if config.scan is not None:
+            self.check_scan(config, dst.name, digests['sha256'], scan)
+        return digests
+
+    def verdict(self, config, digest):
+        """
+        The cached scan verdict for files with SHA-256 `digest`, as for
+        `scanning.VerdictIndex.cached`. Verdicts older than
+        ``UPLOADS_SCAN_CACHE_AGE`` seconds are not used.
+        """
+        if digest is None:
+            return False, None
+        return scanning.verdict_index(state_path(config.destination)).cached(
+            digest, current_app.config.get('UPLOADS_SCAN_CACHE_AGE', 86400))
+
+    def check_scan(self, config, path, digest, scan=None):
+        """
+        Get the verdict on the file just written to `path`: from the
+        cache, from `scan` if it was streamed while writing, or by sending
+        it now. Sets scanning in ``'async'`` mode leave uncached files to
+        `published`.
+
+        :raises UploadInfected: after quarantining the file.
+        """
+        known, signature = self.verdict(config, digest)
+        if scan is not None:
+            if known:
+                scan.hangup()
+            else:
+                signature = scan.verdict()
+        elif not known:
+            if config.scan_mode == 'async':
+                return
+            with open_upload(config, path) as f:
+                signature = scanning.scan_stream(
+                    config.scan, f,
+                    current_app.config.get('UPLOADS_SCAN_TIMEOUT', 30))
+        if not known:
+            scanning.verdict_index(state_path(config.destination)).record(
+                digest, signature)
+        if signature is not None:
+            scanning.quarantine(path, state_path(config.destination), digest)
+            raise UploadInfected(signature)
+
+    def write_target(self, storage, dst, config, algorithms, scan=None):
+        """
+        Copy `storage` into the open target file `dst`, encrypting it for
+        sets with an encryption key and streaming it to `scan`, a
+        `scanning.ClamdStream`, if given.
+
+        :returns: The hex digests of the written bytes for `algorithms`.
+        """
+        if config.encryption_key is not None:
+            dst = encryption.EncryptingWriter(dst, config.encryption_key)
+        digester = integrity.Digester(algorithms)
+        observers = self.observers(config) + [digester]
+        if scan is not None:
+            observers.append(scan)
+        try:
+            with TargetWriter(dst, observers) as writer:
+                storage.save(writer)
+        except BaseException:
+            if scan is not None:
+                scan.hangup()
+            raise
+        return digester.hexdigests()
+
+    def observers(self, config):
+        """
+        The observers every chunk of a saved file is passed through. See
+        `TargetWriter`.
+        """
+        observers = []
+        if config.max_size is not None:
+            observers.append(SizeLimit(config.max_size))
+        counter = self.progress_counter()
+        if counter is not None:
+            observers.append(counter)
+        return observers
+
+    def progress_counter(self):
+        """
+        The `progress.ProgressCounter` of the bytes written for the upload
+        the current request is tracking, or None.
+        """
+        if has_request_context() and 'flup.progress' in request.environ:
+            received = request.environ['flup.progress']
+            received.flush()
+            received.store.finish(received.upload_id, 'saving')
+            return progress.ProgressCounter(received.store,
+                                            received.upload_id, 'written')
+
+    def stream_factory(self, total_content_length, content_type,
+                       filename=None, content_length=None):
+        """
+        A werkzeug stream factory that writes accepted file parts into this
+        set's destination and discards refused ones unread. See `ingest`.
+        """
+        config = self.config
+        basename = lowercase_ext(secure_filename(filename or ''))
+        if not basename or not self.extension_allowed(extension(basename)):
+            return ingest.Discarded("extension not allowed")
+        if config.max_size is not None and content_length and \
+                content_length > config.max_size:
+            return ingest.Discarded("upload exceeds {:d} bytes"
+                                    .format(config.max_size))
+        if self.over_quota(config, content_length):
+            return ingest.Discarded("quota of {:d} bytes exceeded"
+                                    .format(config.quota))
+        algorithms = config.digests
+        if config.scan is not None or config.metadata:
+            algorithms = algorithms + ('sha256',)
+        return ingest.IngestFile(config.destination,
+                                 state_path(config.destination, 'ingest'),
+                                 config.max_size, algorithms,
+                                 config.encryption_key)
+
+    def ingest(self):
+        """
+        Parse the current request's files with `stream_factory`, so that
+        saving them to this set moves them into place instead of copying.
+        Call this before anything touches `request.form` or
+        `request.files`.
+        """
+        req = request._get_current_object()
+        req._get_file_stream = self.stream_factory
+        return req.files
+
+    def serve(self, filename):
+        """
+        Send `filename` from wherever it lives, or from one of the set's
+        replicas if it is missing there. Digests recorded at save time are
+        sent as a `Digest` header and used as the ETag.
+
+        Files of sets scanning in ``'async'`` mode are only sent once their
+        verdict is in; after waiting ``UPLOADS_SCAN_WAIT`` seconds for it
+        the response is a 503, as it is at once for files whose scan keeps
+        failing. Sets with a rate or a download cap are
+        served through `throttling`; see there for the workers pacing
+        needs.
+        """
+        config = self.config
+        if config.scan is not None and config.scan_mode == 'async':
+            self.await_verdict(config, filename)
+        if config.rate is None and config.max_downloads is None:
+            return self.serve_copy(config, filename)
+        return self.serve_throttled(config, filename)
+
+    def serve_throttled(self, config, filename):
+        store = _flup.throttle
+        slot = store.acquire(self.name, config.max_downloads)
+        if slot is None:
+            abort(current_app.response_class(
+                'Too many downloads', 503, {'Retry-After': '5'}))
+        try:
+            response = self.serve_copy(config, filename)
+        except BaseException:
+            store.release(self.name, slot)
+            raise
+        if response.status_code not in (200, 206):
+            store.release(self.name, slot)
+            return response
+        rate = config.rate
+        if rate is not None and \
+                current_app.config.get('UPLOADS_THROTTLE_ACCEL', False):
+            response.headers['X-Accel-Limit-Rate'] = str(int(rate))
+            rate = None
+        response.response = throttling.PacedResponse(
+            response.response, store, self.name, slot,
+            throttling.client_key(
+                request, current_app.config.get('UPLOADS_THROTTLE_KEY')),
+            rate, config.burst)
+        return response
+
+    def serve_copy(self, config, filename):
+        try:
+            return self.serve_primary(config, filename)
+        except NotFound:
+            for replica in config.replicas:
+                try:
+                    return self.send(config, replica, filename)
+                except NotFound:
+                    pass
+            raise
+
+    def await_verdict(self, config, filename):
+        verdicts = scanning.verdict_index(state_path(config.destination))
+        deadline = time.time() + current_app.config.get('UPLOADS_SCAN_WAIT',
+                                                        10)
+        while True:
+            state = verdicts.state(filename)
+            if state is None:
+                return
+            if state == scanning.FAILED or time.time() >= deadline:
+                abort(503)
+            time.sleep(0.05)
+
+    def serve_primary(self, config, filename):
+        if config.cold_destination is None:
+            return self.send(config, config.destination, filename)
+        index = tiering.tier_index(state_path(config.destination))
+        index.touch(filename)
+        tier = index.location(filename)
+        if tier == tiering.COLD:
+            return self.send(config, config.cold_destination, filename)
+        try:
+            return self.send(config, config.destination, filename)
+        except NotFound:
+            # moved to the cold destination since we looked
+            if index.location(filename) != tiering.COLD:
+                raise
+            return self.send(config, config.cold_destination, filename)
+
+    def send(self, config, directory, filename):
+        path = safe_join(directory, filename)
+        digests = integrity.load_digests(path, state_path(config.destination),
+                                         filename)
+        if config.encryption_key is not None:
+            return self.send_decrypted(config, path, digests)
+        fs = current_filesystem()
+        if not digests:
+            return fs.send(directory, filename)
+        response = fs.send(directory, filename, add_etags=False,
+                           conditional=False)
+        response.headers['Digest'] = integrity.digest_header(digests)
+        response.set_etag(digests.get('sha256') or
+                          sorted(digests.items())[0][1])
+        return response.make_conditional(request)
+
+    def send_decrypted(self, config, path, digests):
+        """
+        Stream the plaintext of the encrypted file at `path`, decrypting
+        only the chunks a (range) request covers.
+        """
+        if not os.path.isfile(path):
+            raise NotFound()
+        reader = encryption.DecryptingReader(io.open(path, 'rb'),
+                                             config.encryption_key)
+        response = current_app.response_class(
+            wrap_file(request.environ, reader),
+            mimetype=mimetypes.guess_type(path)[0] or
+            'application/octet-stream',
+            direct_passthrough=True)
+        mtime = os.path.getmtime(path)
+        response.content_length = reader.size
+        response.last_modified = int(mtime)
+        response.cache_control.public = True
+        if digests:
+            response.headers['Digest'] = integrity.digest_header(digests)
+            response.set_etag(digests.get('sha256') or
+                              sorted(digests.items())[0][1])
+        else:
+            response.set_etag('flup-{:.0f}-{:d}'.format(mtime, reader.size))
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=reader.size)
+
+    def create_target(self, target_folder, basename, destination=None,
+                      claim=False):
+        """
+        Claim a free name in `target_folder` and open it for writing. Names
+        are claimed by exclusive creation, so concurrent saves of the same
+        name, from any process or host, always end up with distinct files.
+
+        Names claimed by staged uploads under `destination` are skipped.
+        With `claim`, the name is claimed for a staged upload instead, and
+        its claim file is opened rather than the target. Either way the
+        name is taken and then checked for the other kind of claim, so when
+        a save and a stage race for a name at least one of them moves on.
+
+        :returns: The claimed basename and the open file.
+        """
+        fs = current_filesystem()
+        candidate = basename
+        if self.taken(target_folder, candidate, destination):
+            candidate = self.resolve_conflict(target_folder, basename,
+                                              destination)
+        while True:
+            target = os.path.join(target_folder, candidate)
+            try:
+                if claim:
+                    dst = create_state_file(claim_path(destination, target))
+                    other = target
+                else:
+                    dst = open_exclusive(target)
+                    other = None
+                    if destination is not None:
+                        other = claim_path(destination, target)
+                if other is not None and fs.exists(other):
+                    dst.close()
+                    fs.unlink(dst.name)
+                    raise FileExistsError(errno.EEXIST, 'claimed', target)
+            except FileExistsError:
+                candidate = self.resolve_conflict(target_folder, basename,
+                                                  destination)
+            else:
+                return candidate, dst
+
+    def taken(self, target_folder, basename, destination=None):
+        """
+        Whether `basename` is saved in `target_folder`, or claimed there by
+        a staged upload under `destination`.
+        """
+        fs = current_filesystem()
+        target = os.path.join(target_folder, basename)
+        return fs.exists(target) or (destination is not None and
+                                     fs.exists(claim_path(destination,
+                                                          target)))
+
+    def recover(self, max_age=None):
+        """
+        Clean up writes to this set that were interrupted by a crash. See
+        `WriteJournal.recover`.
+        """
+        return WriteJournal(self.config.destination).recover(max_age)
+
+    def sweep_staging(self, max_age=3600):
+        """
+        Remove stale staged uploads from this set. See `sweep_staging`.
+        """
+        return sweep_staging(self.config.destination, max_age)
 
-    def resolve_conflict(self, target_folder, basename):
+    def resolve_conflict(self, target_folder, basename, destination=None):
         name, ext = basename.rsplit('.', 1)
         count = 0
         while True:
             count = count + 1
             newname = '{}_{:d}.{}'.format(name, count, ext)
-            if not os.path.exists(os.path.join(target_folder, newname)):
+            if not self.taken(target_folder, newname, destination):
                 return newname
 
 
+class DynamicUploadSet(UploadSet):
+    """
+    An upload set whose configuration is worked out per tenant, for example
+    one logical "documents" set whose destination, base URL and quota
+    differ for every customer. `save`, `url`, `path` and the `_uploads`
+    view all use the configuration of the tenant of the current request.
+    A configuration's `quota` caps the bytes stored under its destination,
+    and so what the tenant stores; `max_size` caps each file.
+
+    Resolved configurations are kept in a bounded LRU cache, so there is no
+    per-tenant registration and the resolver only runs for tenants that
+    have not been seen recently. For the same reason the sweepers cannot
+    find tenants' destinations, so the resolver may not return a `ttl`,
+    `cold_destination` or `replicas`; a `ValueError` is raised if it does.
+
+    :param name:       The name of the set
+    :param extensions: The extensions allowed by default
+    :param resolver:   A callable taking a tenant and returning its
+                       `UploadConfiguration`
+    :param tenant:     A callable taking the request and returning a
+                       hashable tenant key. There is no default: tenants
+                       pick where files are written and served from, so
+                       the key must come from something the client cannot
+                       choose, such as the logged in account, or a host
+                       name checked against a list of known hosts.
+    :param cache_size: How many resolved configurations to keep
+    """
+    def __init__(self, name='files', extensions=DEFAULTS, resolver=None,
+                 tenant=None, cache_size=128):
+        UploadSet.__init__(self, name, extensions)
+        if resolver is None:
+            raise ValueError("a dynamic set needs a resolver")
+        if tenant is None:
+            raise ValueError("a dynamic set needs a tenant function")
+        self.resolver = resolver
+        self.tenant = tenant
+        self.cache_size = cache_size
+        self._configs = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def config(self):
+        if self._config is not None:
+            return self._config
+        try:
+            key = self.tenant(request)
+        except RuntimeError:
+            raise RuntimeError("cannot access configuration outside request")
+        return self.config_for_tenant(key)
+
+    def config_for_tenant(self, key):
+        with self._lock:
+            try:
+                config = self._configs.pop(key)
+            except KeyError:
+                config = None
+            else:
+                self._configs[key] = config
+                return config
+        config = self.resolver(key)
+        if (config.ttl is not None or config.cold_destination is not None or
+                config.replicas):
+            raise ValueError("tenant {!r} of {}: expiry, tiering and "
+                             "replication need a static configuration"
+                             .format(key, self.name))
+        if has_app_context():
+            _flup.recover_once(config.destination)
+        with self._lock:
+            self._configs[key] = config
+            while len(self._configs) > self.cache_size:
+                self._configs.popitem(last=False)
+        return config
+
+    def for_tenant(self, key):
+        """
+        A copy of this set bound to `key`, for use outside of requests such
+        as in background jobs.
+        """
+        bound = UploadSet(self.name, self.extensions)
+        bound._config = self.config_for_tenant(key)
+        return bound
+
+    def invalidate(self, key=None):
+        """
+        Forget the cached configuration of `key`, or of every tenant.
+        """
+        with self._lock:
+            if key is None:
+                self._configs.clear()
+            else:
+                self._configs.pop(key, None)
+
+
 class TestingFileStorage(FileStorage):
     def __init__(self, stream=None, filename=None, name=None,
                  content_type='application/octet-stream', content_length=-1,
@@ -192,7 +1497,16 @@ class Flup(object):
                  upload_sets=None):
         self.app = app
         self.upload_sets = upload_sets
-        self.upload_sets_config = {}
+        self.sets = {}
+        self.upload_sets_config = UploadConfigurations(self)
+        self.recovered = set()
+        self.progress = None
+        self._replicator = None
+        self._scanner = None
+        self._throttle = None
+        self._group_commit = None
+        self.filesystem = LOCAL
+        self._uploads_blueprint = None
 
         if app is not None:
             self.app = app
@@ -201,20 +1515,376 @@ class Flup(object):
             self.app = None
 
     def init_app(self, app):
-        self.register_upload_sets(app, self.upload_sets)
+        """
+        Set up `app`. The first application becomes this instance's own.
+        Any later one, as with an application factory, gets a copy stored
+        in its ``app.extensions['flup']``, which is returned, so that what
+        is resolved and started for one application never serves another.
+        """
+        if self.app is not None and self.app is not app:
+            flup = type(self)(upload_sets=self.upload_sets)
+            flup.init_app(app)
+            return flup
+        self.app = app
+        self.filesystem = app.config.get('UPLOADS_FILESYSTEM') or LOCAL
+        self.register_upload_sets(app, self.upload_sets or ())
+
+        self.progress = progress.make_store(
+            app.config.get('UPLOADS_PROGRESS_STORE', None))
+        if self.progress is not None:
+            app.before_request(self.track_progress)
+            app.teardown_request(self.finish_progress)
+        app.teardown_request(self.flush_metadata)
+        app.teardown_request(self.settle_staged)
+        if hasattr(app, 'cli'):
+            from .cli import flup as flup_command
+            app.cli.add_command(flup_command)
 
-        should_serve = any(s.base_url is None
-                           for s in iter(self.upload_sets_config.values()))
+        should_serve = self.progress is not None or any(
+            self.serves(uset, app) for uset in self.sets.values())
 
         if '_uploads' not in app.blueprints and should_serve:
             app.register_blueprint(self._blueprint)
 
         app.extensions['flup'] = self
+        return self
 
     def register_upload_sets(self, app, upload_sets):
         for uset in upload_sets:
-            uset_config = self.config_for_set(uset, app)
-            self.upload_sets_config[uset.name] = uset_config
+            self.sets[uset.name] = uset
+
+    def register_set(self, uset):
+        """
+        Add `uset` to an application that is already set up. Its
+        configuration is read on first use like that of any other set.
+        """
+        self.sets[uset.name] = uset
+        self.upload_sets_config.pop(uset.name, None)
+        if '_uploads' not in self.app.blueprints and \
+                self.serves(uset, self.app):
+            self.app.register_blueprint(self._blueprint)
+
+    def unregister_set(self, name):
+        """
+        Remove the set called `name`; its files are no longer served.
+        """
+        self.upload_sets_config.pop(name, None)
+        return self.sets.pop(name)
+
+    def resolve_config(self, name):
+        uset = self.sets[name]
+        if isinstance(uset, DynamicUploadSet):
+            raise KeyError(name)
+        config = self.config_for_set(uset, self.app)
+        self.recover_once(config.destination)
+        if config.replicas:
+            self.resume_replication(config)
+        if config.scan is not None and config.scan_mode == 'async':
+            self.resume_scans(config)
+        return config
+
+    @property
+    def replicator(self):
+        """
+        This process's `replication.Replicator`, set up from
+        ``UPLOADS_REPLICATION_WORKERS``, ``UPLOADS_REPLICATION_ATTEMPTS``,
+        ``UPLOADS_REPLICATION_BACKOFF`` and ``UPLOADS_REPLICATION_LEASE``. A
+        forked process gets its own, which picks up the copies other
+        processes left pending for the sets resolved so far.
+        """
+        pid = os.getpid()
+        if self._replicator is None or self._replicator[0] != pid:
+            app_config = self.app.config
+            self._replicator = (pid, replication.Replicator(
+                app_config.get('UPLOADS_REPLICATION_WORKERS', 2),
+                app_config.get('UPLOADS_REPLICATION_ATTEMPTS', 5),
+                app_config.get('UPLOADS_REPLICATION_BACKOFF', 0.5),
+                lease=app_config.get('UPLOADS_REPLICATION_LEASE', 600)))
+            for config in self.upload_sets_config.resolved():
+                if config.replicas:
+                    self.resume_replication(config)
+        return self._replicator[1]
+
+    def resume_replication(self, config):
+        """
+        Queue the copies still pending for the set with configuration
+        `config` whose lease has run out, left by a crashed process.
+        """
+        self.replicator.resume(
+            replication.replication_log(state_path(config.destination)),
+            config.destination)
+
+    @property
+    def scanner(self):
+        """
+        This process's `scanning.ScanQueue` for sets scanning in
+        ``'async'`` mode, with ``UPLOADS_SCAN_WORKERS`` threads, set up
+        from ``UPLOADS_SCAN_ATTEMPTS`` and ``UPLOADS_SCAN_BACKOFF``. Like
+        the `replicator`, a forked process gets its own.
+        """
+        pid = os.getpid()
+        if self._scanner is None or self._scanner[0] != pid:
+            app_config = self.app.config
+            self._scanner = (pid, scanning.ScanQueue(
+                app_config.get('UPLOADS_SCAN_WORKERS', 1),
+                app_config.get('UPLOADS_SCAN_ATTEMPTS', 5),
+                app_config.get('UPLOADS_SCAN_BACKOFF', 1.0)))
+            for config in self.upload_sets_config.resolved():
+                if config.scan is not None and config.scan_mode == 'async':
+                    self.resume_scans(config)
+        return self._scanner[1]
+
+    def submit_scan(self, config, name):
+        """
+        Scan the file `name` of the set with configuration `config` in the
+        background.
+        """
+        verdicts = scanning.verdict_index(state_path(config.destination))
+        self.scanner.submit(
+            functools.partial(scan_upload, config, name,
+                              self.app.config.get('UPLOADS_SCAN_TIMEOUT',
+                                                  30)),
+            functools.partial(verdicts.failed, name))
+
+    def resume_scans(self, config):
+        """
+        Queue the scans still pending for the set with configuration
+        `config` whose claim has not been renewed for
+        ``UPLOADS_SCAN_LEASE`` seconds, left by a crashed process.
+        """
+        verdicts = scanning.verdict_index(state_path(config.destination))
+        lease = self.app.config.get('UPLOADS_SCAN_LEASE', 600)
+        for name in verdicts.claim(time.time() - lease):
+            self.submit_scan(config, name)
+
+    @property
+    def group_commit(self):
+        """
+        This process's `durability.GroupCommit`, set up from
+        ``UPLOADS_FSYNC_MAX_WAIT`` and ``UPLOADS_FSYNC_MAX_BATCH``.
+        """
+        pid = os.getpid()
+        if self._group_commit is None or self._group_commit[0] != pid:
+            app_config = self.app.config
+            self._group_commit = (pid, durability.GroupCommit(
+                app_config.get('UPLOADS_FSYNC_MAX_WAIT', 0.005),
+                app_config.get('UPLOADS_FSYNC_MAX_BATCH', 64)))
+        return self._group_commit[1]
+
+    @property
+    def throttle(self):
+        """
+        The `throttling` store named by ``UPLOADS_THROTTLE_STORE``.
+        """
+        if self._throttle is None:
+            self._throttle = throttling.make_store(
+                self.app.config.get('UPLOADS_THROTTLE_STORE'))
+        return self._throttle
+
+    def throttle_metrics(self):
+        """
+        For every throttled set, the downloads active and refused, the
+        bytes sent and the seconds responses were held back, keyed by set
+        name.
+        """
+        return self.throttle.get_metrics()
+
+    def replication_lag(self):
+        """
+        The copies pending and failed for every replicated set, and the age
+        in seconds of the oldest one, keyed by destination.
+        """
+        return dict((config.destination, replication.replication_log(
+            state_path(config.destination)).stats())
+            for config in self.static_configs() if config.replicas)
+
+    def retry_replication(self):
+        """
+        Queue the copies that failed too often again, in every replicated
+        set.
+
+        :returns: How many there were, keyed by destination.
+        """
+        retried = {}
+        for config in self.static_configs():
+            if config.replicas:
+                retried[config.destination] = replication.replication_log(
+                    state_path(config.destination)).retry()
+                self.resume_replication(config)
+        return retried
+
+    def resume_pending(self):
+        """
+        Take over the copies and background scans whose process died, in
+        every set, once their lease has run out.
+        """
+        for config in self.static_configs():
+            if config.replicas:
+                self.resume_replication(config)
+            if config.scan is not None and config.scan_mode == 'async':
+                self.resume_scans(config)
+
+    def recover_once(self, destination):
+        """
+        Clean up interrupted writes under `destination` the first time this
+        process uses it.
+        """
+        app_config = self.app.config
+        if app_config.get('UPLOADS_RECOVER_ON_START', True) and \
+                destination not in self.recovered:
+            self.recovered.add(destination)
+            WriteJournal(destination).recover(
+                app_config.get('UPLOADS_RECOVER_MAX_AGE', None))
+
+    def serves(self, uset, app):
+        """
+        Whether `uset` has no base URL of its own and so has its files
+        served by the `_uploads` blueprint. This only looks at the config
+        keys involved, without building the set's configuration.
+        """
+        if isinstance(uset, DynamicUploadSet):
+            return True
+        app_config = app.config
+        prefix = 'UPLOADED_{}_'.format(uset.name.upper())
+        if app_config.get(prefix + 'URL') is not None:
+            return False
+        return not (app_config.get(prefix + 'DEST') is None and
+                    app_config.get('UPLOADS_DEFAULT_DEST') and
+                    app_config.get('UPLOADS_DEFAULT_URL'))
+
+    def track_progress(self):
+        upload_id = progress.upload_id(request)
+        if not upload_id or request.method not in ('POST', 'PUT'):
+            return
+        self.progress.start(upload_id, request.content_length)
+        counter = progress.ProgressCounter(self.progress, upload_id,
+                                           'received')
+        environ = request.environ
+        environ['wsgi.input'] = progress.CountingStream(environ['wsgi.input'],
+                                                        counter)
+        environ['flup.progress'] = counter
+
+    def finish_progress(self, exc=None):
+        counter = request.environ.get('flup.progress')
+        if counter is not None:
+            counter.flush()
+            self.progress.finish(counter.upload_id,
+                                 'failed' if exc is not None else 'done')
+
+    def settle_staged(self, exc=None):
+        staged = request.environ.pop('flup.staged', ())
+        commit = exc is None and \
+            self.app.config.get('UPLOADS_STAGED_DEFAULT',
+                                'rollback') == 'commit'
+        for upload in staged:
+            if upload.state == 'staged':
+                if commit:
+                    upload.commit()
+                else:
+                    upload.rollback()
+
+    def flush_metadata(self, exc=None):
+        # registered before settle_staged so it runs after it, and also
+        # writes the records of uploads committed there
+        for index in request.environ.pop('flup.metadata', ()):
+            index.flush()
+
+    def recover(self, max_age=None):
+        """
+        Clean up writes interrupted by a crash in every configured set.
+        Interrupted writes are otherwise cleaned up when each set's
+        configuration is first resolved.
+        """
+        return dict((d, WriteJournal(d).recover(max_age))
+                    for d in self.destinations())
+
+    def sweep_staging(self, max_age=3600):
+        """
+        Remove stale staged uploads from every configured set. See
+        `sweep_staging`.
+        """
+        return dict((d, sweep_staging(d, max_age))
+                    for d in self.destinations())
+
+    def sweep_expired(self, batch_size=500):
+        """
+        Delete expired files from every set with a time to live.
+
+        :returns: The names of the deleted files, keyed by destination.
+        """
+        return dict((config.destination, sweep_expired(config, batch_size))
+                    for config in self.static_configs()
+                    if config.ttl is not None)
+
+    def migrate_cold(self, batch_size=100):
+        """
+        Move files that have gone cold in every tiered set.
+
+        :returns: The names of the moved files, keyed by destination.
+        """
+        return dict((config.destination, migrate_cold(config, batch_size))
+                    for config in self.static_configs()
+                    if config.cold_destination is not None)
+
+    def start_mover(self, interval=3600):
+        """
+        Move cold files every `interval` seconds in a background thread,
+        which is returned. Call this once per process, after any fork.
+        """
+        app = self.app
+
+        def migrate():
+            with app.app_context():
+                self.migrate_cold()
+
+        mover = retention.Sweeper(migrate, interval, name='flup-tier-mover')
+        mover.start()
+        return mover
+
+    def start_resumer(self, interval=60):
+        """
+        Call `resume_pending` every `interval` seconds in a background
+        thread, which is returned, so that work left by a crashed process
+        is picked up without waiting for the next process to start. Call
+        this once per process, after any fork.
+        """
+        app = self.app
+
+        def resume():
+            with app.app_context():
+                self.resume_pending()
+
+        resumer = retention.Sweeper(resume, interval, name='flup-resumer')
+        resumer.start()
+        return resumer
+
+    def start_sweeper(self, interval=600):
+        """
+        Sweep expired files every `interval` seconds in a background
+        thread, which is returned. Call this once per process, after any
+        fork.
+        """
+        app = self.app
+
+        def sweep():
+            with app.app_context():
+                self.sweep_expired()
+
+        sweeper = retention.Sweeper(sweep, interval)
+        sweeper.start()
+        return sweeper
+
+    def static_configs(self):
+        """
+        The configurations of all sets with a static configuration.
+        """
+        return self.upload_sets_config.values()
+
+    def destinations(self):
+        """
+        The destinations of all sets with a static configuration.
+        """
+        return set(config.destination for config in self.static_configs())
 
     def config_for_set(self, uset, app):
         app_config = app.config
@@ -228,6 +1898,30 @@ class Flup(object):
         deny_extns = tuple(app_config.get('{}{}'.format(prefix, 'DENY'), ()))
         destination = app_config.get('{}{}'.format(prefix, 'DEST'))
         base_url = app_config.get('{}{}'.format(prefix, 'URL'))
+        max_size = app_config.get('{}{}'.format(prefix, 'MAX_SIZE'))
+        digests = tuple(app_config.get('{}{}'.format(prefix, 'DIGESTS'), ()))
+        ttl = app_config.get('{}{}'.format(prefix, 'TTL'))
+        cold_destination = app_config.get('{}{}'.format(prefix, 'COLD_DEST'))
+        cold_after = app_config.get('{}{}'.format(prefix, 'COLD_AFTER'),
+                                    tiering.COLD_AFTER)
+        replicas = tuple(app_config.get('{}{}'.format(prefix, 'REPLICAS'),
+                                        ()))
+        replica_wait = app_config.get('{}{}'.format(prefix, 'REPLICA_WAIT'),
+                                      0)
+        encryption_key = app_config.get('{}{}'.format(prefix,
+                                                      'ENCRYPTION_KEY'))
+        if encryption_key is not None:
+            encryption_key = encryption.master_key(encryption_key)
+        scan = app_config.get('{}{}'.format(prefix, 'SCAN'))
+        scan_mode = app_config.get('{}{}'.format(prefix, 'SCAN_MODE'), 'sync')
+        keep_metadata = app_config.get('{}{}'.format(prefix, 'METADATA'),
+                                       False)
+        rate = app_config.get('{}{}'.format(prefix, 'RATE'))
+        burst = app_config.get('{}{}'.format(prefix, 'BURST'))
+        max_downloads = app_config.get('{}{}'.format(prefix,
+                                                     'MAX_DOWNLOADS'))
+        durable = app_config.get('{}{}'.format(prefix, 'DURABLE'), False)
+        quota = app_config.get('{}{}'.format(prefix, 'QUOTA'))
 
         if destination is None:
             if app_default_dest:
@@ -248,21 +1942,54 @@ class Flup(object):
 
         return UploadConfiguration(destination, base_url,
                                    allow_extns,
-                                   deny_extns)
+                                   deny_extns,
+                                   max_size,
+                                   digests,
+                                   ttl,
+                                   cold_destination,
+                                   cold_after,
+                                   replicas,
+                                   replica_wait,
+                                   encryption_key,
+                                   scan,
+                                   scan_mode,
+                                   keep_metadata,
+                                   rate,
+                                   burst,
+                                   max_downloads,
+                                   durable,
+                                   quota)
 
     @property
     def _blueprint(self):
+        if self._uploads_blueprint is None:
+            self._uploads_blueprint = self.make_blueprint()
+        return self._uploads_blueprint
+
+    def make_blueprint(self):
         uploads_blueprint = Blueprint('_uploads',
                                       __name__,
                                       url_prefix='/_uploads')
 
         def uploaded_file(setname, filename):
-            config = _flup.upload_sets_config.get(setname, None)
-            if config is None:
+            uset = _flup.sets.get(setname, None)
+            # normalize first, so ./.flup and x/../.flup are refused too
+            filename = posixpath.normpath(filename)
+            if uset is None or STATE_DIR in filename.split('/'):
+                abort(404)
+            return uset.serve(filename)
+
+        def upload_progress(upload_id):
+            status = None
+            if _flup.progress is not None:
+                status = _flup.progress.get(upload_id)
+            if status is None:
                 abort(404)
-            return send_from_directory(config.destination, filename)
+            return jsonify(status)
 
         uploads_blueprint.add_url_rule('/<setname>/<path:filename>',
                                        view_func=uploaded_file)
+        uploads_blueprint.add_url_rule('/_progress/<upload_id>',
+                                       view_func=upload_progress)
 
         return uploads_blueprint
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+flup.ingest
+===========
+Streams the file parts of a multipart request straight into an upload set's
+destination. Werkzeug normally spools every part into a temporary file that
+`UploadSet.save` then copies again; with `UploadSet.ingest` each accepted
+part is written once, to a temporary file next to its final location, and
+saving it is a rename. Parts the set would refuse are dropped as they are
+parsed and never reach the disk.
+"""
+import errno
+import os
+import uuid
+
+from .encryption import DecryptingReader, EncryptingWriter
+from .integrity import Digester
+
+
+class AlreadyPublished(RuntimeError):
+    """
+    Raised when an ingested part that was already saved is saved again. It
+    was moved to `path`, so there is nothing left to move.
+    """
+    def __init__(self, path):
+        RuntimeError.__init__(self, "ingested part already saved as {}"
+                              .format(path))
+        self.path = path
+
+
+class Discarded(object):
+    """
+    Stands in for the stream of a refused part; everything written to it is
+    thrown away.
+    """
+    def __init__(self, reason):
+        self.reason = reason
+
+    def write(self, data):
+        pass
+
+    def read(self, *args):
+        return b''
+
+    def seek(self, *args):
+        return 0
+
+    def tell(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+def create_part(directory):
+    """
+    Exclusively create a file for a part in `directory`. Unlike
+    `tempfile.mkstemp`, which makes it 0600, the file gets the permissions
+    the umask allows, as files written by `UploadSet.save` do, since it
+    becomes the saved file.
+
+    :returns: Its descriptor and path.
+    """
+    path = os.path.join(directory, 'ingest-' + uuid.uuid4().hex)
+    return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666), path
+
+
+class IngestFile(object):
+    """
+    A temporary file in the destination's state directory that a part is
+    parsed into. Size limits and digests are applied as the part streams
+    in; a part that grows past `max_size` is deleted and discarded.
+
+    :param destination: The destination of the set the part is for
+    :param directory:   Where to create the temporary file
+    :param max_size:    The largest allowed part, or None
+    :param algorithms:  hashlib algorithms to compute while writing
+    :param key:         The master key to encrypt the part with, or None.
+                        Reading still gives the plaintext.
+    """
+    def __init__(self, destination, directory, max_size=None, algorithms=(),
+                 key=None):
+        self.destination = destination
+        self.max_size = max_size
+        self.size = 0
+        self.reason = None
+        self.published = None
+        self.digester = Digester(algorithms)
+        try:
+            fd, self.path = create_part(directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, self.path = create_part(directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.key = key
+        if key is None:
+            self.sink = self.source = self.file
+        else:
+            self.sink, self.source = EncryptingWriter(self.file, key), None
+
+    @property
+    def digests(self):
+        return self.digester.hexdigests()
+
+    def write(self, data):
+        if self.reason is not None:
+            return
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.discard("upload exceeds {:d} bytes".format(self.max_size))
+            return
+        self.digester.update(data)
+        self.sink.write(data)
+
+    def discard(self, reason):
+        self.reason = reason
+        self.close()
+
+    def plaintext(self):
+        """
+        The file to read the part back from, once it is fully written.
+        """
+        if self.source is None:
+            self.sink.finish()
+            self.source = DecryptingReader(self.file, self.key)
+        return self.source
+
+    def read(self, *args):
+        if self.reason is not None:
+            return b''
+        return self.plaintext().read(*args)
+
+    def seek(self, *args):
+        if self.reason is not None:
+            return 0
+        return self.plaintext().seek(*args)
+
+    def tell(self):
+        if self.reason is not None:
+            return 0
+        if self.source is None:
+            return self.size
+        return self.source.tell()
+
+    def publish(self, target):
+        """
+        Move the part to `target`, which must be on the same filesystem.
+        A part can only be published once; save the file it was moved to
+        for another copy.
+        """
+        if self.published is not None:
+            raise AlreadyPublished(self.published)
+        if self.source is None:
+            self.sink.finish()
+        self.file.close()
+        os.rename(self.path, target)
+        self.path = None
+        self.published = target
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.path = None
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+flup.integrity
+==============
+Content digests for saved files. Digests are computed while `UploadSet.save`
+streams the file to disk, so nothing is read back, and are kept next to the
+file: in ``user.flup.<algorithm>`` extended attributes where the filesystem
+supports them, and otherwise in a JSON sidecar under the destination's state
+directory.
+"""
+import base64
+import binascii
+import errno
+import hashlib
+import io
+import json
+import os
+
+#: hashlib names and the names RFC 3230 gives them in `Digest` headers.
+HTTP_NAMES = {'md5': 'md5', 'sha1': 'sha', 'sha256': 'sha-256',
+              'sha512': 'sha-512'}
+ALGORITHMS = dict((v, k) for k, v in HTTP_NAMES.items())
+
+XATTR_PREFIX = 'user.flup.'
+
+
+class Digester(object):
+    """
+    A save observer that hashes every chunk with each of `algorithms`.
+    """
+    def __init__(self, algorithms):
+        self.hashes = dict((name, hashlib.new(name)) for name in algorithms)
+
+    def update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+
+    def hexdigests(self):
+        return dict((name, h.hexdigest()) for name, h in self.hashes.items())
+
+
+def stream_digests(stream, algorithms, buffer_size=65536):
+    digester = Digester(algorithms)
+    for chunk in iter(lambda: stream.read(buffer_size), b''):
+        digester.update(chunk)
+    return digester.hexdigests()
+
+
+def file_digests(path, algorithms, buffer_size=65536):
+    with io.open(path, 'rb') as f:
+        return stream_digests(f, algorithms, buffer_size)
+
+
+def expected_digests(headers):
+    """
+    The digests a client sent along with an upload, from `Content-MD5` and
+    RFC 3230 `Digest` headers, as hex strings keyed by hashlib name. Values
+    may be base64, as the RFCs have them, or hex.
+
+    :raises ValueError: If a value is neither.
+    """
+    expected = {}
+    values = []
+    if headers.get('Content-MD5'):
+        values.append(('md5', headers['Content-MD5']))
+    for item in (headers.get('Digest') or '').split(','):
+        name, _, value = item.strip().partition('=')
+        if name.lower() in ALGORITHMS and value:
+            values.append((ALGORITHMS[name.lower()], value))
+    for name, value in values:
+        expected[name] = decode_digest(name, value.strip())
+    return expected
+
+
+def decode_digest(name, value):
+    # hex digits are valid base64 too, so the decoded length decides
+    size = hashlib.new(name).digest_size
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (TypeError, ValueError, binascii.Error):
+        raw = None
+    if raw is not None and len(raw) == size:
+        return binascii.hexlify(raw).decode('ascii')
+    if len(value) == 2 * size:
+        try:
+            binascii.unhexlify(value)
+        except (TypeError, ValueError, binascii.Error):
+            pass
+        else:
+            return value.lower()
+    raise ValueError("malformed {} digest {!r}".format(name, value))
+
+
+def digest_header(digests):
+    return ','.join('{}={}'.format(HTTP_NAMES[name], base64.b64encode(
+        binascii.unhexlify(value)).decode('ascii'))
+        for name, value in sorted(digests.items()) if name in HTTP_NAMES)
+
+
+def sidecar_path(state_dir, filename):
+    return os.path.join(state_dir, 'digests', filename + '.json')
+
+
+def store_digests(path, state_dir, filename, digests):
+    """
+    Record `digests` for the file at `path`, saved as `filename` in a
+    destination whose state directory is `state_dir`.
+    """
+    if hasattr(os, 'setxattr'):
+        try:
+            for name, value in digests.items():
+                os.setxattr(path, XATTR_PREFIX + name, value.encode('ascii'))
+            return
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+                raise
+    sidecar = sidecar_path(state_dir, filename)
+    try:
+        os.makedirs(os.path.dirname(sidecar))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with io.open(sidecar, 'w') as f:
+        f.write(json.dumps(digests))
+
+
+def load_digests(path, state_dir, filename):
+    """
+    The digests recorded for a file by `store_digests`, or an empty dict.
+    """
+    if hasattr(os, 'listxattr'):
+        try:
+            digests = dict(
+                (attr[len(XATTR_PREFIX):], os.getxattr(path, attr)
+                 .decode('ascii'))
+                for attr in os.listxattr(path)
+                if attr.startswith(XATTR_PREFIX))
+        except OSError:
+            digests = None
+        if digests:
+            return digests
+    try:
+        with io.open(sidecar_path(state_dir, filename)) as f:
+            return json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def remove_digests(state_dir, filename):
+    try:
+        os.unlink(sidecar_path(state_dir, filename))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+flup.metadata
+=============
+A queryable record of the files saved to sets with
+``UPLOADED_<SET>_METADATA``, kept in an SQLite index in the destination's
+state directory. Records are buffered and written in batches: at the end of
+each request, and otherwise every `MetadataIndex.flush_every` records or
+`MetadataIndex.flush_interval` seconds.
+
+Queries return the newest files first, a page at a time. Each page comes
+with an opaque cursor for the next one, which stays valid while files are
+being added.
+"""
+import atexit
+import base64
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from .sqlite import SQLiteIndex, shared
+
+#: What is recorded about a saved file.
+Upload = namedtuple('Upload', ['name', 'original', 'owner', 'folder',
+                               'extension', 'content_type', 'size', 'digest',
+                               'saved'])
+
+
+def encode_cursor(upload):
+    return base64.urlsafe_b64encode(json.dumps(
+        [upload.saved, upload.name]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        saved, name = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("invalid cursor {!r}".format(cursor))
+    return saved, name
+
+
+class MetadataIndex(SQLiteIndex):
+    """
+    The records of the files under one destination.
+
+    :param path:           The index database file
+    :param flush_every:    Records buffered before they are written
+    :param flush_interval: Seconds records are buffered at most
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS uploads ('
+              'name TEXT PRIMARY KEY, original TEXT, owner TEXT, folder TEXT, '
+              'extension TEXT, content_type TEXT, size INTEGER, digest TEXT, '
+              'saved REAL NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS uploads_saved '
+              'ON uploads (saved, name)',
+              'CREATE INDEX IF NOT EXISTS uploads_owner '
+              'ON uploads (owner, saved, name)',
+              'CREATE INDEX IF NOT EXISTS uploads_extension '
+              'ON uploads (extension, saved, name)',
+              'CREATE INDEX IF NOT EXISTS uploads_content_type '
+              'ON uploads (content_type, saved, name)',
+              'CREATE INDEX IF NOT EXISTS uploads_folder '
+              'ON uploads (folder, saved, name)',
+              'CREATE INDEX IF NOT EXISTS uploads_size '
+              'ON uploads (size, saved, name)',
+              'CREATE INDEX IF NOT EXISTS uploads_digest ON uploads (digest)')
+
+    def __init__(self, path, flush_every=100, flush_interval=5):
+        SQLiteIndex.__init__(self, path)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffered = {}
+        self.flushed = time.time()
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def add(self, upload):
+        """
+        Buffer the `Upload` record `upload`.
+        """
+        now = time.time()
+        with self.lock:
+            self.buffered[upload.name] = upload
+            due = len(self.buffered) >= self.flush_every or \
+                now - self.flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records in one transaction.
+        """
+        with self.lock:
+            buffered, self.buffered = self.buffered, {}
+            self.flushed = time.time()
+        if buffered:
+            with self.connection as db:
+                db.executemany('INSERT OR REPLACE INTO uploads VALUES '
+                               '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               list(buffered.values()))
+
+    def get(self, name):
+        self.flush()
+        row = self.connection.execute('SELECT * FROM uploads WHERE name = ?',
+                                      (name,)).fetchone()
+        return Upload(*row) if row is not None else None
+
+    def remove(self, name):
+        with self.lock:
+            self.buffered.pop(name, None)
+        with self.connection as db:
+            db.execute('DELETE FROM uploads WHERE name = ?', (name,))
+
+    def query(self, owner=None, extension=None, content_type=None,
+              folder=None, digest=None, min_size=None, max_size=None,
+              since=None, until=None, limit=100, cursor=None):
+        """
+        The records matching every given filter, newest first.
+
+        :param since:  Only files saved at or after this timestamp
+        :param until:  Only files saved before this timestamp
+        :param limit:  Records per page
+        :param cursor: The cursor returned with the previous page
+        :returns: A list of `Upload` records, and the cursor of the next
+                  page, or None if this is the last.
+        """
+        self.flush()
+        clauses, args = [], []
+        for column, value in (('owner', owner), ('extension', extension),
+                              ('content_type', content_type),
+                              ('folder', folder), ('digest', digest)):
+            if value is not None:
+                clauses.append('{} = ?'.format(column))
+                args.append(value)
+        for clause, value in (('size >= ?', min_size),
+                              ('size <= ?', max_size),
+                              ('saved >= ?', since), ('saved < ?', until)):
+            if value is not None:
+                clauses.append(clause)
+                args.append(value)
+        if cursor is not None:
+            saved, name = decode_cursor(cursor)
+            clauses.append('(saved < ? OR (saved = ? AND name < ?))')
+            args.extend((saved, saved, name))
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        rows = self.connection.execute(
+            'SELECT * FROM uploads{} ORDER BY saved DESC, name DESC LIMIT ?'
+            .format(where), args + [limit + 1]).fetchall()
+        uploads = [Upload(*row) for row in rows[:limit]]
+        if len(rows) > limit:
+            return uploads, encode_cursor(uploads[-1])
+        return uploads, None
+
+
+def metadata_index(state_dir):
+    """
+    The shared `MetadataIndex` of the destination whose state directory is
+    `state_dir`.
+    """
+    return shared(MetadataIndex, os.path.join(state_dir, 'metadata.db'))
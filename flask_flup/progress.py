@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+flup.progress
+=============
+Progress reporting for long running uploads. A client picks an upload ID
+and sends it with the upload, either as an ``X-Upload-ID`` header or an
+``upload_id`` query argument, then polls ``/_uploads/_progress/<id>`` for
+the number of bytes received from the network and written by
+`UploadSet.save`.
+
+Counters are kept in a pluggable store: `MemoryProgressStore` for a single
+process, `SQLiteProgressStore` when several workers on one host serve the
+same clients.
+"""
+import sqlite3
+import threading
+import time
+
+
+class MemoryProgressStore(object):
+    """
+    Keeps progress in a dict, visible only to the current process.
+
+    :param ttl: Seconds after its last update that an upload is forgotten
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def start(self, upload_id, total=None):
+        now = time.time()
+        with self.lock:
+            for key in [k for k, v in self.uploads.items()
+                        if now - v['updated'] > self.ttl]:
+                del self.uploads[key]
+            self.uploads[upload_id] = dict(received=0, written=0,
+                                           total=total, state='receiving',
+                                           updated=now)
+
+    def add(self, upload_id, field, amount):
+        with self.lock:
+            progress = self.uploads.get(upload_id)
+            if progress is not None:
+                progress[field] += amount
+                progress['updated'] = time.time()
+
+    def finish(self, upload_id, state='done'):
+        with self.lock:
+            progress = self.uploads.get(upload_id)
+            if progress is not None:
+                progress['state'] = state
+                progress['updated'] = time.time()
+
+    def get(self, upload_id):
+        with self.lock:
+            progress = self.uploads.get(upload_id)
+            return dict(progress) if progress is not None else None
+
+
+class SQLiteProgressStore(object):
+    """
+    Keeps progress in an SQLite database so that every worker process on
+    the host sees every upload.
+
+    :param path: The database file
+    :param ttl:  Seconds after its last update that an upload is forgotten
+    """
+    fields = ('received', 'written', 'total', 'state', 'updated')
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        with self.connection as db:
+            db.execute('CREATE TABLE IF NOT EXISTS progress ('
+                       'upload_id TEXT PRIMARY KEY, received INTEGER, '
+                       'written INTEGER, total INTEGER, state TEXT, '
+                       'updated REAL)')
+
+    @property
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            self.local.db = db
+        return db
+
+    def start(self, upload_id, total=None):
+        now = time.time()
+        with self.connection as db:
+            db.execute('DELETE FROM progress WHERE updated < ?',
+                       (now - self.ttl,))
+            db.execute('INSERT OR REPLACE INTO progress VALUES '
+                       '(?, 0, 0, ?, ?, ?)',
+                       (upload_id, total, 'receiving', now))
+
+    def add(self, upload_id, field, amount):
+        if field not in ('received', 'written'):
+            raise ValueError(field)
+        with self.connection as db:
+            db.execute('UPDATE progress SET {0} = {0} + ?, updated = ? '
+                       'WHERE upload_id = ?'.format(field),
+                       (amount, time.time(), upload_id))
+
+    def finish(self, upload_id, state='done'):
+        with self.connection as db:
+            db.execute('UPDATE progress SET state = ?, updated = ? '
+                       'WHERE upload_id = ?',
+                       (state, time.time(), upload_id))
+
+    def get(self, upload_id):
+        row = self.connection.execute(
+            'SELECT received, written, total, state, updated FROM progress '
+            'WHERE upload_id = ?', (upload_id,)).fetchone()
+        return dict(zip(self.fields, row)) if row is not None else None
+
+
+def make_store(value):
+    """
+    The store for the ``UPLOADS_PROGRESS_STORE`` setting: ``'memory'``, the
+    path of an SQLite database, or a store instance.
+    """
+    if value is None or hasattr(value, 'add'):
+        return value
+    if value == 'memory':
+        return MemoryProgressStore()
+    return SQLiteProgressStore(value)
+
+
+def upload_id(request):
+    return (request.headers.get('X-Upload-ID') or
+            request.args.get('upload_id'))
+
+
+class ProgressCounter(object):
+    """
+    Adds the length of every chunk it sees to one counter of an upload.
+    Store updates are batched: the store is only written once `step` bytes
+    or `interval` seconds have accumulated, so counting adds next to
+    nothing to the copy loop.
+    """
+    def __init__(self, store, upload_id, field, step=256 * 1024,
+                 interval=0.5):
+        self.store = store
+        self.upload_id = upload_id
+        self.field = field
+        self.step = step
+        self.interval = interval
+        self.pending = 0
+        self.flushed = time.time()
+
+    def update(self, data):
+        self.update_size(len(data))
+
+    def update_size(self, size):
+        """
+        Count `size` bytes that were not seen as a chunk, such as those of
+        an ingested part that is moved into place.
+        """
+        self.pending += size
+        if self.pending >= self.step:
+            self.flush()
+        else:
+            now = time.time()
+            if now - self.flushed >= self.interval:
+                self.flush(now)
+
+    def flush(self, now=None):
+        if self.pending:
+            self.store.add(self.upload_id, self.field, self.pending)
+            self.pending = 0
+        self.flushed = now or time.time()
+
+    close = flush
+
+
+class CountingStream(object):
+    """
+    Wraps a WSGI input stream and counts the bytes read from it.
+    """
+    def __init__(self, stream, counter):
+        self.stream = stream
+        self.counter = counter
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        if data:
+            self.counter.update(data)
+        else:
+            self.counter.flush()
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        if data:
+            self.counter.update(data)
+        else:
+            self.counter.flush()
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
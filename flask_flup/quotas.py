@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+flup.quotas
+===========
+Limits on the bytes stored under a destination, for sets with
+``UPLOADED_<SET>_QUOTA`` and for the per-tenant configurations of a
+`DynamicUploadSet`. Each destination keeps, in an SQLite index in its state
+directory, the size of every file saved while it had a quota and their
+total, which a save is only allowed to grow up to the quota. Files removed
+through the set (expired, quarantined or deleted in bulk) are taken off
+again; files saved before the quota was set are not counted.
+"""
+import os
+
+from .sqlite import SQLiteIndex, shared
+
+
+class UsageIndex(SQLiteIndex):
+    """
+    The bytes stored under one destination.
+
+    :param path: The index database file
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS stored ('
+              'name TEXT PRIMARY KEY, size INTEGER NOT NULL)',
+              'CREATE TABLE IF NOT EXISTS usage ('
+              'id INTEGER PRIMARY KEY CHECK (id = 0), '
+              'bytes INTEGER NOT NULL)',
+              'INSERT OR IGNORE INTO usage VALUES (0, 0)')
+
+    def used(self):
+        """
+        The bytes stored so far.
+        """
+        return self.connection.execute(
+            'SELECT bytes FROM usage WHERE id = 0').fetchone()[0]
+
+    def charge(self, name, size, quota):
+        """
+        Count the `size` bytes of the file `name`, unless that would take
+        the total past `quota`.
+
+        :returns: Whether it was counted.
+        """
+        with self.connection as db:
+            # checked and added in one statement, so concurrent saves in
+            # other processes cannot both take the last bytes
+            if not db.execute('UPDATE usage SET bytes = bytes + ? '
+                              'WHERE id = 0 AND bytes + ? <= ?',
+                              (size, size, quota)).rowcount:
+                return False
+            old = db.execute('SELECT size FROM stored WHERE name = ?',
+                             (name,)).fetchone()
+            if old is not None:
+                db.execute('UPDATE usage SET bytes = bytes - ? WHERE id = 0',
+                           old)
+            db.execute('INSERT OR REPLACE INTO stored VALUES (?, ?)',
+                       (name, size))
+        return True
+
+    def release(self, name):
+        """
+        Stop counting the file `name`.
+        """
+        with self.connection as db:
+            row = db.execute('SELECT size FROM stored WHERE name = ?',
+                             (name,)).fetchone()
+            if row is not None:
+                db.execute('DELETE FROM stored WHERE name = ?', (name,))
+                db.execute('UPDATE usage SET bytes = bytes - ? WHERE id = 0',
+                           row)
+
+
+def usage_index(state_dir):
+    """
+    The shared `UsageIndex` of the destination whose state directory is
+    `state_dir`.
+    """
+    return shared(UsageIndex, os.path.join(state_dir, 'usage.db'))
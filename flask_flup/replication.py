@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+flup.replication
+================
+Asynchronous copies of saved uploads to the replica destinations of sets
+with ``UPLOADED_<SET>_REPLICAS``. Every copy to be made is first written to
+a log in the primary destination's state directory, then handed to worker
+threads. Copies that fail are retried with exponential backoff; entries
+still in the log after a crash are picked up again with `Replicator.resume`.
+
+Every process resumes the log when it starts, and again every so often
+with `Flup.start_resumer`, so each entry carries a lease: the process
+working on it renews it at each attempt, and other processes only take
+over entries whose lease has run out. Entries that failed too often stay
+in the log until `ReplicationLog.retry` (``flask flup replication
+--retry``) queues them again.
+"""
+import errno
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .sqlite import SQLiteIndex, shared
+from .tiering import copy
+
+
+class ReplicationLog(SQLiteIndex):
+    """
+    The copies still to be made from one primary destination.
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS pending ('
+              'id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, '
+              'replica TEXT NOT NULL, enqueued REAL NOT NULL, '
+              'attempts INTEGER NOT NULL DEFAULT 0, '
+              'failed INTEGER NOT NULL DEFAULT 0, '
+              'claimed REAL NOT NULL DEFAULT 0)',)
+
+    def add(self, name, replicas):
+        now = time.time()
+        with self.connection as db:
+            return [db.execute('INSERT INTO pending (name, replica, enqueued, '
+                               'claimed) VALUES (?, ?, ?, ?)',
+                               (name, replica, now, now))
+                    .lastrowid for replica in replicas]
+
+    def renew(self, entry):
+        with self.connection as db:
+            db.execute('UPDATE pending SET claimed = ? WHERE id = ?',
+                       (time.time(), entry))
+
+    def claim(self, before):
+        """
+        Take over the entries not failed whose lease was last renewed
+        before `before`.
+        """
+        now = time.time()
+        claimed = []
+        with self.connection as db:
+            for entry, name, replica, renewed in db.execute(
+                    'SELECT id, name, replica, claimed FROM pending '
+                    'WHERE failed = 0 AND claimed < ? ORDER BY id',
+                    (before,)).fetchall():
+                if db.execute('UPDATE pending SET claimed = ? '
+                              'WHERE id = ? AND claimed = ?',
+                              (now, entry, renewed)).rowcount:
+                    claimed.append((entry, name, replica))
+        return claimed
+
+    def done(self, entry):
+        with self.connection as db:
+            db.execute('DELETE FROM pending WHERE id = ?', (entry,))
+
+    def attempted(self, entry, failed=False):
+        with self.connection as db:
+            db.execute('UPDATE pending SET attempts = attempts + 1, '
+                       'failed = ?, claimed = ? WHERE id = ?',
+                       (int(failed), time.time(), entry))
+
+    def retry(self):
+        """
+        Make the failed entries pending again, for the next process that
+        resumes the log.
+
+        :returns: How many there were.
+        """
+        with self.connection as db:
+            return db.execute('UPDATE pending SET failed = 0, attempts = 0, '
+                              'claimed = 0 WHERE failed = 1').rowcount
+
+    def pending(self):
+        return self.connection.execute(
+            'SELECT id, name, replica FROM pending WHERE failed = 0 '
+            'ORDER BY id').fetchall()
+
+    def stats(self):
+        count, failed, oldest = self.connection.execute(
+            'SELECT count(*), coalesce(sum(failed), 0), min(enqueued) '
+            'FROM pending').fetchone()
+        return {'pending': count - failed, 'failed': failed,
+                'lag': time.time() - oldest if oldest is not None else 0.0}
+
+
+def replication_log(state_dir):
+    return shared(ReplicationLog, os.path.join(state_dir, 'replication.db'))
+
+
+class Replicas(object):
+    """
+    Lets a caller wait for the copies of one file.
+    """
+    def __init__(self):
+        self.copied = 0
+        self.condition = threading.Condition()
+
+    def add(self):
+        with self.condition:
+            self.copied += 1
+            self.condition.notify_all()
+
+    def wait(self, count, timeout=None):
+        """
+        Wait until `count` copies exist. Returns whether they do.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.copied < count:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+
+class Replicator(object):
+    """
+    Worker threads making the copies in replication logs.
+
+    :param workers:      Number of copying threads
+    :param max_attempts: Attempts before a copy is marked failed
+    :param backoff:      Seconds before the first retry; doubled each time
+    :param max_backoff:  Longest wait between retries
+    :param lease:        Seconds after which another process may take over
+                         an entry; longer than `max_backoff`
+    """
+    def __init__(self, workers=2, max_attempts=5, backoff=0.5,
+                 max_backoff=60, lease=600):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self.work,
+                                          name='flup-replicator-{}'.format(n))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, log, source, name, replicas):
+        """
+        Log and queue copies of the file `name` under the primary
+        destination `source` to each of `replicas`.
+        """
+        waiter = Replicas()
+        for entry, replica in zip(log.add(name, replicas), replicas):
+            self.queue.put((log, entry, os.path.join(source, name),
+                            os.path.join(replica, name), 0, waiter))
+        self.start()
+        return waiter
+
+    def resume(self, log, source):
+        """
+        Queue the copies left in `log` by a crashed process, or by any
+        process that has not renewed their lease in time.
+        """
+        for entry, name, replica in log.claim(time.time() - self.lease):
+            self.queue.put((log, entry, os.path.join(source, name),
+                            os.path.join(replica, name), 0, None))
+        self.start()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.replicate(*item)
+            except Exception:
+                logging.getLogger(__name__).exception("replication failed")
+            finally:
+                self.queue.task_done()
+
+    def replicate(self, log, entry, source, target, attempt, waiter):
+        log.renew(entry)
+        try:
+            copy(source, target)
+        except (IOError, OSError) as e:
+            attempt += 1
+            gave_up = attempt >= self.max_attempts or e.errno == errno.ENOENT
+            log.attempted(entry, failed=gave_up)
+            if not gave_up:
+                delay = min(self.backoff * 2 ** (attempt - 1),
+                            self.max_backoff)
+                timer = threading.Timer(delay, self.queue.put, ((
+                    log, entry, source, target, attempt, waiter),))
+                timer.daemon = True
+                timer.start()
+            return
+        log.done(entry)
+        if waiter is not None:
+            waiter.add()
+
+    def drain(self):
+        """
+        Block until every queued copy has been attempted once.
+        """
+        self.queue.join()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+flup.retention
+==============
+Expiry of uploads for sets with a ``UPLOADED_<SET>_TTL``. When a file is
+saved its expiry time is recorded in an SQLite index in the destination's
+state directory, ordered by expiry, so sweeping only ever reads the entries
+that are due and never has to walk the live files.
+"""
+import errno
+import logging
+import os
+import threading
+import time
+
+from .sqlite import SQLiteIndex, shared
+
+
+class ExpiryIndex(SQLiteIndex):
+    """
+    The expiry times of the files under one destination.
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS expiry ('
+              'name TEXT PRIMARY KEY, expires REAL NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS expiry_expires ON expiry (expires)')
+
+    def add(self, name, expires):
+        with self.connection as db:
+            db.execute('INSERT OR REPLACE INTO expiry VALUES (?, ?)',
+                       (name, expires))
+
+    def due(self, now, limit):
+        return [row[0] for row in self.connection.execute(
+            'SELECT name FROM expiry WHERE expires <= ? '
+            'ORDER BY expires LIMIT ?', (now, limit))]
+
+    def remove(self, names):
+        with self.connection as db:
+            db.executemany('DELETE FROM expiry WHERE name = ?',
+                           [(name,) for name in names])
+
+
+def expiry_index(state_dir):
+    """
+    The shared `ExpiryIndex` of the destination whose state directory is
+    `state_dir`.
+    """
+    return shared(ExpiryIndex, os.path.join(state_dir, 'expiry.db'))
+
+
+def sweep(index, remove, batch_size=500, now=None):
+    """
+    Delete the files in `index` whose expiry time has passed, in batches of
+    `batch_size`, by calling `remove` with each of their names.
+
+    :returns: The names of the deleted files.
+    """
+    now = time.time() if now is None else now
+    swept = []
+    while True:
+        names = index.due(now, batch_size)
+        if not names:
+            return swept
+        for name in names:
+            try:
+                remove(name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        index.remove(names)
+        swept.extend(names)
+
+
+class Sweeper(threading.Thread):
+    """
+    A daemon thread that calls `sweep` every `interval` seconds until
+    `stop` is called.
+    """
+    def __init__(self, sweep, interval=600, name='flup-expiry-sweeper'):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.sweep = sweep
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                logging.getLogger(__name__).exception("%s failed",
+                                                      self.name)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+flup.scanning
+=============
+Malware scanning for sets with ``UPLOADED_<SET>_SCAN``, the address of a
+clamd compatible daemon: the path of its unix socket, or a ``(host, port)``
+pair. Files are sent with the daemon's ``INSTREAM`` command.
+
+In the default ``'sync'`` mode a file is streamed to the daemon as it is
+written, so the scan runs alongside the disk write and `UploadSet.save`
+only waits for the verdict. In ``'async'`` mode files are scanned by a
+background worker after they are saved, and serving them waits for the
+verdict instead. Background scans that fail are retried until they get a
+verdict; once a file's scan has failed a few times it is marked failed,
+and serving answers 503 straight away rather than waiting.
+
+Verdicts are cached by the file's SHA-256, so a file whose contents were
+scanned before is not sent again.
+"""
+import errno
+import logging
+import os
+import shutil
+import socket
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .sqlite import SQLiteIndex, shared
+
+#: Largest chunk sent in one ``INSTREAM`` frame.
+FRAME_SIZE = 64 * 1024
+
+PENDING = 'pending'
+FAILED = 'failed'
+
+
+class ScanError(Exception):
+    """
+    Raised when the daemon cannot be reached or does not give a verdict.
+    """
+
+
+def connect(address, timeout):
+    try:
+        if isinstance(address, (tuple, list)):
+            return socket.create_connection(tuple(address), timeout)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        return sock
+    except (OSError, socket.error) as e:
+        raise ScanError("cannot reach scanner at {!r}: {}".format(address, e))
+
+
+class ClamdStream(object):
+    """
+    A save observer that streams every chunk to the daemon at `address`.
+    Call `verdict` once the file is written.
+    """
+    def __init__(self, address, timeout=30):
+        self.sock = connect(address, timeout)
+        self.error = None
+        self.send(b'zINSTREAM\0')
+
+    def send(self, data):
+        if self.error is None:
+            try:
+                self.sock.sendall(data)
+            except (OSError, socket.error) as e:
+                # the daemon hangs up on streams over its size limit, and
+                # says so in its reply
+                self.error = e
+
+    def update(self, data):
+        for i in range(0, len(data), FRAME_SIZE):
+            frame = data[i:i + FRAME_SIZE]
+            self.send(struct.pack('>I', len(frame)) + bytes(frame))
+
+    def verdict(self):
+        """
+        The name of the signature the file matched, or None if it is
+        clean.
+        """
+        try:
+            self.send(b'\0\0\0\0')
+            reply = b''
+            while not reply.endswith(b'\0'):
+                data = self.sock.recv(4096)
+                if not data:
+                    break
+                reply += data
+        except (OSError, socket.error) as e:
+            raise ScanError("no verdict from scanner: {}".format(e))
+        finally:
+            self.hangup()
+        reply = reply.rstrip(b'\0').decode('utf-8', 'replace').strip()
+        status = reply.partition(': ')[2]
+        if status == 'OK':
+            return None
+        if status.endswith(' FOUND'):
+            return status[:-len(' FOUND')]
+        raise ScanError("scanner said {!r}".format(reply or self.error))
+
+    def hangup(self):
+        self.sock.close()
+
+
+def scan_stream(address, stream, timeout=30, buffer_size=FRAME_SIZE):
+    """
+    Send the readable `stream` to the daemon at `address`.
+
+    :returns: The matched signature, or None.
+    """
+    scan = ClamdStream(address, timeout)
+    try:
+        for chunk in iter(lambda: stream.read(buffer_size), b''):
+            scan.update(chunk)
+    except BaseException:
+        scan.hangup()
+        raise
+    return scan.verdict()
+
+
+class VerdictIndex(SQLiteIndex):
+    """
+    The cached verdicts of one destination, by SHA-256, and the files
+    under it waiting for a background scan. A waiting file is claimed by
+    the process scanning it, which renews the claim on every attempt; see
+    `claim`.
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS verdicts ('
+              'digest TEXT PRIMARY KEY, signature TEXT, scanned REAL)',
+              'CREATE TABLE IF NOT EXISTS pending ('
+              'name TEXT PRIMARY KEY, queued REAL NOT NULL, '
+              'claimed REAL NOT NULL DEFAULT 0, '
+              'failed INTEGER NOT NULL DEFAULT 0)')
+
+    def cached(self, digest, max_age=None):
+        """
+        :returns: Whether a verdict for `digest` is known, and its
+                  signature.
+        """
+        row = self.connection.execute(
+            'SELECT signature, scanned FROM verdicts WHERE digest = ?',
+            (digest,)).fetchone()
+        if row is None or (max_age is not None and
+                           row[1] < time.time() - max_age):
+            return False, None
+        return True, row[0]
+
+    def record(self, digest, signature):
+        with self.connection as db:
+            db.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)',
+                       (digest, signature, time.time()))
+
+    def queue(self, name):
+        """
+        Record that `name` waits for a scan, claimed by the caller.
+        """
+        now = time.time()
+        with self.connection as db:
+            db.execute('INSERT OR REPLACE INTO pending VALUES (?, ?, ?, 0)',
+                       (name, now, now))
+
+    def state(self, name):
+        """
+        `PENDING` or `FAILED` while `name` waits for its scan, else None.
+        """
+        row = self.connection.execute(
+            'SELECT failed FROM pending WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return FAILED if row[0] else PENDING
+
+    def claim(self, before):
+        """
+        Take over the waiting files whose claim was last renewed before
+        `before`, left by a process that died. Each is handed to a single
+        caller.
+
+        :returns: Their names.
+        """
+        claimed = []
+        now = time.time()
+        rows = self.connection.execute(
+            'SELECT name, claimed FROM pending WHERE claimed < ? '
+            'ORDER BY queued', (before,)).fetchall()
+        for name, last in rows:
+            with self.connection as db:
+                if db.execute('UPDATE pending SET claimed = ? '
+                              'WHERE name = ? AND claimed = ?',
+                              (now, name, last)).rowcount:
+                    claimed.append(name)
+        return claimed
+
+    def renew(self, name):
+        with self.connection as db:
+            db.execute('UPDATE pending SET claimed = ? WHERE name = ?',
+                       (time.time(), name))
+
+    def failed(self, name):
+        """
+        Mark the scan of `name` as failing, so serving stops waiting for
+        it; it is still retried.
+        """
+        with self.connection as db:
+            db.execute('UPDATE pending SET failed = 1 WHERE name = ?',
+                       (name,))
+
+    def done(self, name):
+        with self.connection as db:
+            db.execute('DELETE FROM pending WHERE name = ?', (name,))
+
+
+def verdict_index(state_dir):
+    return shared(VerdictIndex, os.path.join(state_dir, 'scans.db'))
+
+
+def quarantine(path, state_dir, name):
+    """
+    Keep a copy of the infected file at `path`, saved as `name`, in the
+    state directory's quarantine area, where it is never served.
+    """
+    target = os.path.join(state_dir, 'quarantine', name)
+    try:
+        os.makedirs(os.path.dirname(target))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    try:
+        os.unlink(target)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copy2(path, target)
+    return target
+
+
+class ScanQueue(object):
+    """
+    Worker threads that call the scans handed to `submit`. A scan that
+    raises `ScanError` is tried again after `backoff` seconds, doubling up
+    to `max_backoff`, for as long as it fails, since its file cannot be
+    served without a verdict. After `attempts` failures the scan's
+    `exhausted` callback is called.
+    """
+    def __init__(self, workers=1, attempts=5, backoff=1.0, max_backoff=60):
+        self.workers = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, scan, exhausted=None, attempt=0):
+        self.queue.put((scan, exhausted, attempt))
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(
+                    target=self.work,
+                    name='flup-scanner-{:d}'.format(len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        log = logging.getLogger(__name__)
+        while True:
+            scan, exhausted, attempt = self.queue.get()
+            try:
+                scan()
+            except ScanError:
+                attempt += 1
+                log.warning("scan failed %d times, retrying", attempt,
+                            exc_info=True)
+                timer = threading.Timer(
+                    min(self.backoff * 2 ** (attempt - 1), self.max_backoff),
+                    self.submit, (scan, exhausted, attempt))
+                timer.daemon = True
+                timer.start()
+                if attempt == self.attempts and exhausted is not None:
+                    try:
+                        exhausted()
+                    except Exception:
+                        log.exception("could not mark the scan as failed")
+            except Exception:
+                log.exception("scan failed")
+            finally:
+                self.queue.task_done()
+
+    def drain(self):
+        """
+        Block until every queued scan has been tried once.
+        """
+        self.queue.join()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+flup.sqlite
+===========
+The small SQLite databases flup keeps in a destination's state directory.
+Each thread gets its own connection, and every process shares one index
+object per database file.
+"""
+import errno
+import os
+import sqlite3
+import threading
+
+
+class SQLiteIndex(object):
+    """
+    Base class for the indexes. Subclasses list the statements creating
+    their tables in `schema`.
+
+    :param path: The database file
+    """
+    schema = ()
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            db = sqlite3.connect(self.path, timeout=30)
+            with db:
+                for statement in self.schema:
+                    db.execute(statement)
+            self.local.db = db
+        return db
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def shared(cls, path):
+    """
+    The instance of `cls` for the database at `path` shared by the whole
+    process.
+    """
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = _indexes[path] = cls(path)
+    return index
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+flup.testing
+============
+Synthetic upload workloads, and a harness that drives them through an
+application with the Flask test client and reports throughput and latency
+percentiles. Set ``UPLOADS_FILESYSTEM`` to a `filesystem.MemoryFilesystem`
+to measure flup rather than the disk.
+"""
+import io
+import math
+import random
+import threading
+import time
+from collections import namedtuple
+
+Upload = namedtuple('Upload', ['filename', 'body'])
+
+
+def fixed(size):
+    """
+    A size distribution that always gives `size` bytes.
+    """
+    return lambda rng: size
+
+
+def uniform(low, high):
+    """
+    Sizes spread evenly between `low` and `high` bytes.
+    """
+    return lambda rng: rng.randint(low, high)
+
+
+def lognormal(median, sigma=1.0, maximum=None):
+    """
+    Mostly small files with a long tail of large ones, like most real
+    upload traffic.
+    """
+    def size(rng):
+        value = int(rng.lognormvariate(math.log(median), sigma))
+        return value if maximum is None else min(value, maximum)
+    return size
+
+
+class Workload(object):
+    """
+    A reproducible series of uploads.
+
+    :param count:      How many uploads
+    :param sizes:      A size distribution: a function of a `random.Random`
+    :param collisions: The fraction of uploads reusing an earlier filename
+    :param extensions: Extensions to pick filenames from
+    :param seed:       Seed for the random choices
+    """
+    def __init__(self, count, sizes=fixed(1024), collisions=0.0,
+                 extensions=('txt',), seed=0):
+        self.count = count
+        self.sizes = sizes
+        self.collisions = collisions
+        self.extensions = extensions
+        self.seed = seed
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        used = []
+        for n in range(self.count):
+            if used and rng.random() < self.collisions:
+                filename = rng.choice(used)
+            else:
+                filename = 'upload{:d}.{}'.format(n,
+                                                  rng.choice(self.extensions))
+                used.append(filename)
+            size = max(0, self.sizes(rng))
+            pattern = filename.encode('utf-8')
+            body = (pattern * (size // len(pattern) + 1))[:size]
+            yield Upload(filename, body)
+
+    def __len__(self):
+        return self.count
+
+
+def percentile(ordered, p):
+    """
+    The nearest-rank `p`-th percentile of the sorted list `ordered`.
+    """
+    if not ordered:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class Report(object):
+    """
+    The outcome of one kind of request in a load run.
+    """
+    def __init__(self, name, latencies, errors, elapsed, size):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.requests = len(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.size = size
+
+    @property
+    def throughput(self):
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bandwidth(self):
+        return self.size / self.elapsed if self.elapsed else 0.0
+
+    def percentiles(self, points=(50, 90, 99, 100)):
+        return dict((p, percentile(self.latencies, p)) for p in points)
+
+    def __str__(self):
+        lines = ['{}: {:d} requests, {:d} errors, {:.1f}/s, {:.2f} MB/s'
+                 .format(self.name, self.requests, self.errors,
+                         self.throughput, self.bandwidth / 1e6)]
+        for p, value in sorted(self.percentiles().items()):
+            if value is not None:
+                lines.append('  p{:<3d} {:8.2f} ms'.format(p, value * 1000))
+        return '\n'.join(lines)
+
+
+def run(app, url, workload, concurrency=4, field='file', fetch=None):
+    """
+    Post every upload of `workload` to `url` as the file field `field`,
+    from `concurrency` threads. If `fetch` is given, each upload is then
+    downloaded again from ``fetch(response)``.
+
+    :returns: The upload `Report`, and the download `Report` or None.
+    """
+    uploads = list(workload)
+    lock = threading.Lock()
+    results = {'upload': ([], [0], [0]), 'download': ([], [0], [0])}
+
+    def record(kind, latency, failed, size):
+        latencies, errors, total = results[kind]
+        with lock:
+            latencies.append(latency)
+            errors[0] += int(failed)
+            total[0] += size
+
+    def work():
+        client = app.test_client()
+        while True:
+            with lock:
+                if not uploads:
+                    return
+                upload = uploads.pop()
+            started = time.perf_counter()
+            res = client.post(url, data={
+                field: (io.BytesIO(upload.body), upload.filename)})
+            record('upload', time.perf_counter() - started,
+                   res.status_code >= 400, len(upload.body))
+            if fetch is not None and res.status_code < 400:
+                started = time.perf_counter()
+                got = client.get(fetch(res))
+                data = got.data
+                got.close()
+                record('download', time.perf_counter() - started,
+                       got.status_code >= 400, len(data))
+            res.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    reports = [Report(kind, results[kind][0], results[kind][1][0], elapsed,
+                      results[kind][2][0]) for kind in ('upload', 'download')]
+    return reports[0], reports[1] if fetch is not None else None
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+flup.throttling
+===============
+Bandwidth limits for serving the files of sets with ``UPLOADED_<SET>_RATE``
+(bytes per second per client) and caps on concurrent downloads for sets
+with ``UPLOADED_<SET>_MAX_DOWNLOADS``.
+
+Each client of a set has a token bucket holding up to
+``UPLOADED_<SET>_BURST`` bytes. Sending a chunk takes its length from the
+bucket, which may run into debt; the response then sleeps until the debt is
+paid off before sending the next chunk. Concurrent downloads by one client
+therefore share its rate, and everyone else is unaffected. Clients are told
+apart by ``UPLOADS_THROTTLE_KEY``, a function of the request, or by their
+address.
+
+Buckets, download slots and metrics live in a pluggable store, like
+upload progress: `MemoryThrottleStore` for a single process, or
+`SQLiteThrottleStore` to share limits between the worker processes on a
+host. A bucket that has refilled to its burst is the same as no bucket,
+so stores drop those every `PRUNE_INTERVAL` seconds, and clients that
+come and go do not pile up. Download slots in the SQLite store are leased:
+a download renews its slot while it is sent, and the slot of a worker that
+was killed mid-download is taken back once `SLOT_LEASE` seconds pass.
+
+Pacing sleeps in the thread sending the response, so a throttled download
+holds its worker for as long as it lasts. Serve throttled sets from
+threaded or cooperative (gevent, eventlet) workers, not from a few
+synchronous ones, or let the front end pace the body: with
+``UPLOADS_THROTTLE_ACCEL`` set, responses carry the rate in an
+``X-Accel-Limit-Rate`` header for nginx to enforce, and are not paced
+here. Only the rate per connection holds then, not the rate per client.
+"""
+import itertools
+import sqlite3
+import threading
+import time
+
+#: Bytes taken from a bucket at a time.
+QUANTUM = 64 * 1024
+
+METRICS = ('active', 'bytes', 'delayed', 'rejected')
+
+#: Seconds between removals of full buckets.
+PRUNE_INTERVAL = 60
+
+#: Seconds a download slot is kept without being renewed.
+SLOT_LEASE = 120
+
+
+def refill(tokens, updated, now, amount, rate, burst):
+    """
+    The bucket left after taking `amount` from a bucket with `tokens` at
+    `updated`, the seconds to wait before its tokens are positive, and the
+    time at which it will be full again.
+    """
+    tokens = min(burst, tokens + (now - updated) * rate) - amount
+    return tokens, max(0.0, -tokens / rate), now + (burst - tokens) / rate
+
+
+class MemoryThrottleStore(object):
+    """
+    Keeps buckets and counts in dicts, visible only to the current process.
+    """
+    #: Downloads of this store's process die with it, so slots need no
+    #: renewing.
+    lease = None
+
+    def __init__(self, prune_interval=PRUNE_INTERVAL):
+        self.buckets = {}
+        self.metrics = {}
+        self.slots = {}
+        self.slot_ids = itertools.count(1)
+        self.prune_interval = prune_interval
+        self.pruned = time.time()
+        self.lock = threading.Lock()
+
+    def counters(self, name):
+        return self.metrics.setdefault(name, dict.fromkeys(METRICS, 0))
+
+    def reserve(self, name, key, amount, rate, burst):
+        """
+        Take `amount` bytes from the bucket `key` of set `name`.
+
+        :returns: Seconds to wait before sending them.
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.pruned >= self.prune_interval:
+                self.pruned = now
+                for bucket in [b for b, (_, _, full) in self.buckets.items()
+                               if full <= now]:
+                    del self.buckets[bucket]
+            tokens, updated, _ = self.buckets.get((name, key),
+                                                  (burst, now, now))
+            tokens, delay, full = refill(tokens, updated, now, amount, rate,
+                                         burst)
+            self.buckets[(name, key)] = (tokens, now, full)
+            counters = self.counters(name)
+            counters['bytes'] += amount
+            counters['delayed'] += delay
+        return delay
+
+    def acquire(self, name, limit):
+        """
+        Count a download from set `name` if fewer than `limit` are active.
+
+        :returns: The download's slot, or None.
+        """
+        with self.lock:
+            counters = self.counters(name)
+            if limit is not None and counters['active'] >= limit:
+                counters['rejected'] += 1
+                return None
+            counters['active'] += 1
+            slot = next(self.slot_ids)
+            self.slots[slot] = name
+            return slot
+
+    def renew(self, name, slot):
+        pass
+
+    def release(self, name, slot):
+        with self.lock:
+            if self.slots.pop(slot, None) is not None:
+                self.counters(name)['active'] -= 1
+
+    def get_metrics(self):
+        with self.lock:
+            return dict((name, dict(counters))
+                        for name, counters in self.metrics.items())
+
+
+class SQLiteThrottleStore(object):
+    """
+    Keeps buckets and counts in an SQLite database so that limits hold
+    across every worker process on the host.
+
+    :param path:           The database file
+    :param prune_interval: Seconds between removals of full buckets
+    :param lease:          Seconds a download slot is kept without being
+                           renewed
+    """
+    def __init__(self, path, prune_interval=PRUNE_INTERVAL,
+                 lease=SLOT_LEASE):
+        self.path = path
+        self.prune_interval = prune_interval
+        self.lease = lease
+        self.pruned = time.time()
+        self.local = threading.local()
+        with self.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                       'name TEXT, key TEXT, tokens REAL, updated REAL, '
+                       'full REAL, PRIMARY KEY (name, key))')
+            db.execute('CREATE INDEX IF NOT EXISTS buckets_full '
+                       'ON buckets (full)')
+            db.execute('CREATE TABLE IF NOT EXISTS slots ('
+                       'id INTEGER PRIMARY KEY, name TEXT, renewed REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS slots_name '
+                       'ON slots (name, renewed)')
+            db.execute('CREATE TABLE IF NOT EXISTS metrics ('
+                       'name TEXT PRIMARY KEY, bytes INTEGER DEFAULT 0, '
+                       'delayed REAL DEFAULT 0, rejected INTEGER DEFAULT 0)')
+
+    @property
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            self.local.db = db
+        return db
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def reserve(self, name, key, amount, rate, burst):
+        now = time.time()
+        with self.transaction() as db:
+            if now - self.pruned >= self.prune_interval:
+                self.pruned = now
+                db.execute('DELETE FROM buckets WHERE full <= ?', (now,))
+            row = db.execute('SELECT tokens, updated FROM buckets '
+                             'WHERE name = ? AND key = ?',
+                             (name, key)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens, delay, full = refill(tokens, updated, now, amount, rate,
+                                         burst)
+            db.execute('INSERT OR REPLACE INTO buckets '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (name, key, tokens, now, full))
+            db.execute('INSERT OR IGNORE INTO metrics (name) VALUES (?)',
+                       (name,))
+            db.execute('UPDATE metrics SET bytes = bytes + ?, '
+                       'delayed = delayed + ? WHERE name = ?',
+                       (amount, delay, name))
+        return delay
+
+    def acquire(self, name, limit):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO metrics (name) VALUES (?)',
+                       (name,))
+            # slots of downloads whose worker died are never released
+            db.execute('DELETE FROM slots WHERE name = ? AND renewed < ?',
+                       (name, now - self.lease))
+            active, = db.execute('SELECT COUNT(*) FROM slots '
+                                 'WHERE name = ?', (name,)).fetchone()
+            if limit is not None and active >= limit:
+                db.execute('UPDATE metrics SET rejected = rejected + 1 '
+                           'WHERE name = ?', (name,))
+                return None
+            return db.execute('INSERT INTO slots (name, renewed) '
+                              'VALUES (?, ?)', (name, now)).lastrowid
+
+    def renew(self, name, slot):
+        with self.transaction() as db:
+            db.execute('UPDATE slots SET renewed = ? WHERE id = ?',
+                       (time.time(), slot))
+
+    def release(self, name, slot):
+        with self.transaction() as db:
+            db.execute('DELETE FROM slots WHERE id = ?', (slot,))
+
+    def get_metrics(self):
+        return dict((row[0], dict(zip(METRICS, row[1:])))
+                    for row in self.connection.execute(
+                        'SELECT name, (SELECT COUNT(*) FROM slots '
+                        'WHERE slots.name = metrics.name), '
+                        'bytes, delayed, rejected FROM metrics'))
+
+
+class Transaction(object):
+    """
+    Holds the database's write lock from the start, so a bucket is read
+    and updated atomically.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.db.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+
+
+def make_store(value):
+    """
+    The store for the ``UPLOADS_THROTTLE_STORE`` setting: ``'memory'`` (the
+    default), the path of an SQLite database, or a store instance.
+    """
+    if hasattr(value, 'reserve'):
+        return value
+    if value is None or value == 'memory':
+        return MemoryThrottleStore()
+    return SQLiteThrottleStore(value)
+
+
+def client_key(request, key=None):
+    """
+    The bucket key of the client making `request`: what `key` returns for
+    it if given, otherwise its address.
+    """
+    if key is not None:
+        return str(key(request))
+    return request.remote_addr or ''
+
+
+class PacedResponse(object):
+    """
+    Wraps a response body so that it is sent at no more than the rate of
+    the client's bucket, or unpaced if `rate` is None. The download's
+    `slot` is renewed while the body is sent, and released when it is
+    closed, which the WSGI server does even if the client goes away.
+    """
+    def __init__(self, iterable, store, name, slot, key, rate, burst,
+                 quantum=QUANTUM, sleep=time.sleep):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.store = store
+        self.name = name
+        self.slot = slot
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.quantum = quantum
+        self.sleep = sleep
+        self.renewed = time.time()
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = b''
+        for data in self.iterator:
+            chunk += data
+            if len(chunk) >= self.quantum:
+                break
+        if not chunk:
+            raise StopIteration
+        lease = getattr(self.store, 'lease', None)
+        if lease is not None and time.time() - self.renewed > lease / 4.0:
+            self.renewed = time.time()
+            self.store.renew(self.name, self.slot)
+        if self.rate is not None:
+            delay = self.store.reserve(self.name, self.key, len(chunk),
+                                       self.rate, self.burst)
+            if delay:
+                self.sleep(delay)
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.store.release(self.name, self.slot)
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
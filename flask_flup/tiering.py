@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+flup.tiering
+============
+Hot/cold placement of uploads for sets with a ``UPLOADED_<SET>_COLD_DEST``.
+Files are saved to the set's destination and moved to the cold destination
+once they have not been served for ``UPLOADED_<SET>_COLD_AFTER`` seconds.
+
+Where each file lives is kept in a location index in the hot destination's
+state directory, which `UploadSet.path` and the `_uploads` view consult
+instead of probing the disks. Accesses are counted in memory and written to
+the index in batches, at the latest a few seconds after they happen, and
+when the process exits.
+
+Several movers may run at once, from `Flup.start_mover` in each process and
+from ``flask flup tier``. A mover claims a file by marking it as moving
+before copying it, so each file is copied by one of them. A claim that is
+not finished within `MOVE_LEASE` seconds, because its mover died, can be
+taken over.
+"""
+import atexit
+import errno
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from .sqlite import SQLiteIndex, shared
+
+HOT, COLD, MOVING = 'hot', 'cold', 'moving'
+
+#: Seconds without access after which a file is cold by default.
+COLD_AFTER = 7 * 24 * 3600
+
+#: Seconds after which an unfinished move may be claimed again.
+MOVE_LEASE = 3600
+
+
+class TierIndex(SQLiteIndex):
+    """
+    The tier, last access time and access count of the files under one hot
+    destination.
+
+    :param path:           The index database file
+    :param flush_every:    Accesses buffered before they are written
+    :param flush_interval: Seconds accesses are buffered at most
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS tiers ('
+              'name TEXT PRIMARY KEY, tier TEXT NOT NULL, '
+              'last_access REAL NOT NULL, hits INTEGER NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS tiers_access '
+              'ON tiers (tier, last_access)')
+
+    def __init__(self, path, flush_every=100, flush_interval=5):
+        SQLiteIndex.__init__(self, path)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.accesses = {}
+        self.flushed = time.time()
+        self.timer = None
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def add(self, name, now=None):
+        with self.connection as db:
+            db.execute('INSERT OR REPLACE INTO tiers VALUES (?, ?, ?, 0)',
+                       (name, HOT, time.time() if now is None else now))
+
+    def location(self, name):
+        row = self.connection.execute('SELECT tier FROM tiers '
+                                      'WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else HOT
+
+    def touch(self, name):
+        """
+        Count an access to `name`.
+        """
+        now = time.time()
+        with self.lock:
+            hits, _ = self.accesses.get(name, (0, now))
+            self.accesses[name] = (hits + 1, now)
+            due = len(self.accesses) >= self.flush_every or \
+                now - self.flushed >= self.flush_interval
+            if not due and (self.timer is None or
+                            not self.timer.is_alive()):
+                # a process that goes idle still writes what it counted
+                self.timer = threading.Timer(self.flush_interval,
+                                             self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            accesses, self.accesses = self.accesses, {}
+            self.flushed = time.time()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if accesses:
+            with self.connection as db:
+                db.executemany('UPDATE tiers SET hits = hits + ?, '
+                               'last_access = max(last_access, ?) '
+                               'WHERE name = ?',
+                               [(hits, last, name) for name, (hits, last)
+                                in accesses.items()])
+
+    def cold_candidates(self, before, limit, now=None):
+        """
+        Up to `limit` hot files last accessed before `before`, and files
+        whose move has outlived its lease, as ``(name, tier, last_access)``.
+        """
+        now = time.time() if now is None else now
+        return self.connection.execute(
+            'SELECT name, tier, last_access FROM tiers '
+            'WHERE (tier = ? AND last_access < ?) '
+            'OR (tier = ? AND last_access < ?) '
+            'ORDER BY last_access LIMIT ?',
+            (HOT, before, MOVING, now - MOVE_LEASE, limit)).fetchall()
+
+    def claim(self, name, tier, last_access):
+        """
+        Mark `name` as moving, provided it is still in `tier` and was last
+        accessed at `last_access`. The time of the claim is kept as its
+        last access, which starts the lease.
+
+        :returns: Whether the file was claimed.
+        """
+        with self.connection as db:
+            return db.execute('UPDATE tiers SET tier = ?, last_access = ? '
+                              'WHERE name = ? AND tier = ? '
+                              'AND last_access = ?',
+                              (MOVING, time.time(), name, tier,
+                               last_access)).rowcount == 1
+
+    def release(self, name, last_access):
+        """
+        Give up the claim on `name`, which stays hot.
+        """
+        with self.connection as db:
+            db.execute('UPDATE tiers SET tier = ?, last_access = ? '
+                       'WHERE name = ? AND tier = ?',
+                       (HOT, last_access, name, MOVING))
+
+    def moved(self, name):
+        """
+        Mark the claimed file `name` as cold.
+
+        :returns: False if it was removed from the index meanwhile.
+        """
+        with self.connection as db:
+            return db.execute('UPDATE tiers SET tier = ? '
+                              'WHERE name = ? AND tier = ?',
+                              (COLD, name, MOVING)).rowcount == 1
+
+    def remove(self, name):
+        with self.connection as db:
+            db.execute('DELETE FROM tiers WHERE name = ?', (name,))
+
+
+def tier_index(state_dir):
+    """
+    The shared `TierIndex` of the hot destination whose state directory is
+    `state_dir`.
+    """
+    return shared(TierIndex, os.path.join(state_dir, 'tiers.db'))
+
+
+def copy(source, target):
+    """
+    Copy a file to another filesystem without exposing a partial copy at
+    `target`.
+    """
+    directory = os.path.dirname(target)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # unique, so that two processes copying the same file do not write
+    # to the same partial copy
+    partial = os.path.join(directory, '.{}.{}.part'.format(
+        os.path.basename(target), uuid.uuid4().hex))
+    try:
+        shutil.copy2(source, partial)
+        os.rename(partial, target)
+    except BaseException:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+
+
+def migrate(index, hot, cold, cold_after, batch_size=100, now=None):
+    """
+    Move files of the hot destination `hot` that have not been accessed for
+    `cold_after` seconds to the cold destination `cold`. A file is claimed,
+    copied and marked cold before its hot copy is removed, so it can be
+    served throughout.
+
+    :returns: The names of the files this call moved.
+    """
+    now = time.time() if now is None else now
+    index.flush()
+    moved = []
+    while True:
+        candidates = index.cold_candidates(now - cold_after, batch_size,
+                                            now)
+        if not candidates:
+            return moved
+        for name, tier, last_access in candidates:
+            if not index.claim(name, tier, last_access):
+                # moved, removed or accessed since we looked
+                continue
+            source, target = os.path.join(hot, name), os.path.join(cold, name)
+            try:
+                copy(source, target)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    index.release(name, last_access)
+                    raise
+                # the hot copy is gone, and was not moved by anyone else
+                if index.location(name) == MOVING:
+                    index.remove(name)
+                continue
+            if not index.moved(name):
+                # deleted while we copied it
+                os.unlink(target)
+                continue
+            try:
+                os.unlink(source)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            moved.append(name)
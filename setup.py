@@ -21,6 +21,9 @@ setup(
     install_requires=[
         'Flask>=0.9'
     ],
+    extras_require={
+        'encryption': ['cryptography']
+    },
     test_suite='tests',
     classifiers=[
         'Development Status :: 4 - Beta',
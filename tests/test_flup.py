@@ -7,12 +7,35 @@ NOTE: All the filenames in this testing file are in the POSIX style.
 """
 
 from __future__ import with_statement
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
 import os.path
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
-from flask import Flask, url_for
-from flask.ext.flup import Flup
-from flask.ext.flup.flup import (UploadSet, UploadConfiguration, extension,
-                                 TestingFileStorage, addslash, ALL, AllExcept)
+from flask import Flask, abort, url_for, request
+from flask.ext.flup.flup import (Flup, UploadSet, UploadConfiguration,
+                                 extension, TestingFileStorage, addslash, ALL,
+                                 AllExcept, WriteJournal, state_path,
+                                 DynamicUploadSet, UploadNotAllowed,
+                                 DigestMismatch, ReplicationTimeout,
+                                 UploadInfected, sweep_expired, remove_upload,
+                                 saved_name)
+from flask.ext.flup import (bulk, durability, encryption, ingest,
+                            integrity, metadata, progress, replication,
+                            retention, scanning, testing, throttling, tiering)
+from flask.ext.flup.filesystem import MemoryFilesystem
+import flask_flup
+from werkzeug import FileStorage
 
 
 class TestTestingCase(unittest.TestCase):
@@ -128,6 +151,83 @@ class ConfigurationCase(unittest.TestCase):
                                              'http://localhost:6002/'))
 
 
+class LazyConfigurationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['UPLOADS_DEFAULT_DEST'] = '/var/uploads'
+        self.resolved = []
+
+        class CountingFlup(Flup):
+            def config_for_set(flup, uset, app):
+                self.resolved.append(uset.name)
+                return Flup.config_for_set(flup, uset, app)
+
+        self.CountingFlup = CountingFlup
+
+    def test_resolved_once_on_use(self):
+        sets = [UploadSet('set%d' % n) for n in range(100)]
+        flup = self.CountingFlup(self.app, sets)
+        self.assertEqual(self.resolved, [])
+        self.assertEqual(flup.upload_sets_config['set7'],
+                         UploadConfiguration('/var/uploads/set7'))
+        flup.upload_sets_config['set7']
+        self.assertEqual(self.resolved, ['set7'])
+        self.assertIsNone(flup.upload_sets_config.get('missing'))
+
+    def test_mapping(self):
+        flup = self.CountingFlup(self.app, [UploadSet('files')])
+        flup.register_set(DynamicUploadSet(
+            'documents', resolver=UploadConfiguration,
+            tenant=lambda request: request.host))
+        configs = flup.upload_sets_config
+        self.assertEqual((len(configs), list(configs)), (1, ['files']))
+        self.assertNotIn('documents', configs)
+        self.assertEqual(configs.resolved(), [])
+        files = UploadConfiguration('/var/uploads/files')
+        self.assertEqual(configs.items(), [('files', files)])
+        self.assertEqual(len(configs.resolved()), 1)
+
+    def test_app_factory(self):
+        flup = Flup(upload_sets=[UploadSet('files')])
+        apps = []
+        for destination in ('/tmp/a1', '/tmp/a2'):
+            app = Flask(__name__)
+            app.config['UPLOADED_FILES_DEST'] = destination
+            flup.init_app(app)
+            apps.append(app)
+        self.assertIs(apps[0].extensions['flup'], flup)
+        for app, destination in zip(apps, ('/tmp/a1', '/tmp/a2')):
+            with app.test_request_context():
+                self.assertEqual(app.extensions['flup'].upload_sets_config[
+                    'files'].destination, destination)
+                self.assertEqual(flask_flup.UploadSet('files').path('a.txt'),
+                                 os.path.join(destination, 'a.txt'))
+
+    def test_blueprint_memoized(self):
+        flup = Flup(self.app, [UploadSet('files')])
+        self.assertIs(flup._blueprint, flup._blueprint)
+        self.assertIs(self.app.blueprints['_uploads'], flup._blueprint)
+
+    def test_runtime_registration(self):
+        self.app.config['UPLOADS_DEFAULT_URL'] = 'http://localhost:6000/'
+        flup = self.CountingFlup(self.app, [UploadSet('files')])
+        self.assertNotIn('_uploads', self.app.blueprints)
+
+        self.app.config['UPLOADED_PHOTOS_DEST'] = '/mnt/photos'
+        photos = UploadSet('photos')
+        flup.register_set(photos)
+        self.assertIn('_uploads', self.app.blueprints)
+        self.assertIn('photos', flup.upload_sets_config)
+        self.assertEqual(flup.upload_sets_config['photos'],
+                         UploadConfiguration('/mnt/photos'))
+
+        self.assertIs(flup.unregister_set('photos'), photos)
+        self.assertNotIn('photos', flup.upload_sets_config)
+        with self.app.test_client() as client:
+            self.assertEqual(client.get('/_uploads/photos/a.jpg').status_code,
+                             404)
+
+
 class PreconditionsCase(unittest.TestCase):
 
     def test_filenames(self):
@@ -152,117 +252,1931 @@ class PreconditionsCase(unittest.TestCase):
 
 class SavingCase(unittest.TestCase):
     def setUp(self):
-        self.old_makedirs = os.makedirs
-        os.makedirs = lambda v: None
+        self.dest = tempfile.mkdtemp()
 
-    def teardown(self):
-        os.makedirs = self.old_makedirs
-        del self.old_makedirs
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def target(self, *parts):
+        return os.path.join(self.dest, *parts)
 
     def test_saved(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='foo.txt')
         res = uset.save(tfs)
         self.assertEqual(res, 'foo.txt')
-        self.assertEqual(tfs.saved, '/uploads/foo.txt')
+        self.assertEqual(tfs.saved, self.target('foo.txt'))
 
     def test_save_folders(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='foo.txt')
         res = uset.save(tfs, folder='someguy')
         self.assertEqual(res, 'someguy/foo.txt')
-        self.assertEqual(tfs.saved, '/uploads/someguy/foo.txt')
+        self.assertEqual(tfs.saved, self.target('someguy/foo.txt'))
 
     def test_save_named(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='foo.txt')
         res = uset.save(tfs, name='file_123.txt')
         self.assertEqual(res, 'file_123.txt')
-        self.assertEqual(tfs.saved, '/uploads/file_123.txt')
+        self.assertEqual(tfs.saved, self.target('file_123.txt'))
 
     def test_save_namedext(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='boat.jpg')
         res = uset.save(tfs, name='photo_123.')
         self.assertEqual(res, 'photo_123.jpg')
-        self.assertEqual(tfs.saved, '/uploads/photo_123.jpg')
+        self.assertEqual(tfs.saved, self.target('photo_123.jpg'))
 
     def test_folder_namedext(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='boat.jpg')
         res = uset.save(tfs, folder='someguy', name='photo_123.')
         self.assertEqual(res, 'someguy/photo_123.jpg')
-        self.assertEqual(tfs.saved, '/uploads/someguy/photo_123.jpg')
+        self.assertEqual(tfs.saved, self.target('someguy/photo_123.jpg'))
 
     def test_implicit_folder(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='boat.jpg')
         res = uset.save(tfs, name='someguy/photo_123.')
         self.assertEqual(res, 'someguy/photo_123.jpg')
-        self.assertEqual(tfs.saved, '/uploads/someguy/photo_123.jpg')
+        self.assertEqual(tfs.saved, self.target('someguy/photo_123.jpg'))
+
+    def test_digests_per_name(self):
+        first = saved_name(None, 'foo.txt')
+        first.digests['sha256'] = 'abc'
+        self.assertEqual(saved_name('someguy', 'foo.txt').digests, {})
 
     def test_secured_filename(self):
         uset = UploadSet('files', ALL)
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs1 = TestingFileStorage(filename='/etc/passwd')
         tfs2 = TestingFileStorage(filename='../../myapp.wsgi')
         res1 = uset.save(tfs1)
         self.assertEqual(res1, 'etc_passwd')
-        self.assertEqual(tfs1.saved, '/uploads/etc_passwd')
+        self.assertEqual(tfs1.saved, self.target('etc_passwd'))
         res2 = uset.save(tfs2)
         self.assertEqual(res2, 'myapp.wsgi')
-        self.assertEqual(tfs2.saved, '/uploads/myapp.wsgi')
+        self.assertEqual(tfs2.saved, self.target('myapp.wsgi'))
 
 
 class ConflictResolutionCase(unittest.TestCase):
     def setUp(self):
-        self.extant_files = []
-        self.old_exists = os.path.exists
-        os.path.exists = self.exists
-        self.old_makedirs = os.makedirs
-        os.makedirs = lambda v: None
+        self.dest = tempfile.mkdtemp()
 
     def tearDown(self):
-        os.path.exists = self.old_exists
-        del self.extant_files, self.old_exists
-        os.makedirs = self.old_makedirs
-        del self.old_makedirs
+        shutil.rmtree(self.dest)
 
     def extant(self, *files):
-        self.extant_files.extend(files)
-
-    def exists(self, fname):
-        return fname in self.extant_files
+        for fname in files:
+            open(os.path.join(self.dest, fname), 'w').close()
 
     def test_self(self):
-        self.assertFalse(os.path.exists('/uploads/foo.txt'))
-        self.extant('/uploads/foo.txt')
-        self.assertTrue(os.path.exists('/uploads/foo.txt'))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'foo.txt')))
+        self.extant('foo.txt')
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'foo.txt')))
 
     def test_conflict(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='foo.txt')
-        self.extant('/uploads/foo.txt')
+        self.extant('foo.txt')
         res = uset.save(tfs)
         self.assertEqual(res, 'foo_1.txt')
 
     def test_multi_conflict(self):
         uset = UploadSet('files')
-        uset._config = UploadConfiguration('/uploads')
+        uset._config = UploadConfiguration(self.dest)
         tfs = TestingFileStorage(filename='foo.txt')
-        self.extant('/uploads/foo.txt',
-                    *('/uploads/foo_%d.txt' % n for n in range(1, 6)))
+        self.extant('foo.txt', *('foo_%d.txt' % n for n in range(1, 6)))
         res = uset.save(tfs)
         self.assertEqual(res, 'foo_6.txt')
 
 
+def _hammer(dest, worker, count, results):
+    uset = UploadSet('files')
+    uset._config = UploadConfiguration(dest)
+    for n in range(count):
+        body = ('%d-%d' % (worker, n)).encode('ascii') * 512
+        fs = FileStorage(io.BytesIO(body), filename='foo.txt')
+        results.put((uset.save(fs), body))
+
+
+class ConcurrentSaveCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def test_many_processes_one_name(self):
+        workers, count = 8, 25
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_hammer,
+                                         args=(self.dest, w, count, results))
+                 for w in range(workers)]
+        for p in procs:
+            p.start()
+        saved = [results.get(timeout=30) for _ in range(workers * count)]
+        for p in procs:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        names = [name for name, _ in saved]
+        self.assertEqual(len(set(names)), workers * count)
+        for name, body in saved:
+            with open(os.path.join(self.dest, name), 'rb') as f:
+                self.assertEqual(f.read(), body)
+        self.assertEqual(os.listdir(state_path(self.dest, 'journal')), [])
+
+    def test_racing_folder_creation(self):
+        results = multiprocessing.Queue()
+        nested = os.path.join(self.dest, 'a', 'b')
+        procs = [multiprocessing.Process(target=_hammer,
+                                         args=(nested, w, 1, results))
+                 for w in range(8)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+
+class JournalCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.journal = WriteJournal(self.dest)
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def interrupted(self, name, **record):
+        open(os.path.join(self.dest, name), 'w').close()
+        entry = self.journal.begin(os.path.join(self.dest, name))
+        self.journal.active.discard(entry)
+        if record:
+            with open(entry, 'w') as f:
+                f.write(json.dumps(dict(path=name, **record)))
+        return entry
+
+    def test_failed_save_is_removed(self):
+        uset = UploadSet('files')
+        uset._config = UploadConfiguration(self.dest)
+
+        class Broken(TestingFileStorage):
+            def save(self, dst, buffer_size=16384):
+                raise IOError('disk full')
+
+        self.assertRaises(IOError, uset.save, Broken(filename='foo.txt'))
+        self.assertEqual(sorted(os.listdir(self.dest)), ['.flup'])
+        self.assertEqual(list(self.journal.entries()), [])
+
+    def test_recover_own_host(self):
+        self.interrupted('foo.txt')
+        self.assertEqual(self.journal.recover(), ['foo.txt'])
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'foo.txt')))
+        self.assertEqual(list(self.journal.entries()), [])
+
+    def test_recover_keeps_live_writes(self):
+        entry = self.journal.begin(os.path.join(self.dest, 'foo.txt'))
+        self.interrupted('bar.txt', host='elsewhere', pid=1)
+        self.assertEqual(self.journal.recover(), [])
+        self.assertEqual(self.journal.recover(max_age=-1), ['bar.txt'])
+        self.journal.end(entry)
+
+    def test_recover_on_start(self):
+        self.interrupted('foo.txt')
+        app = Flask(__name__)
+        app.config['UPLOADED_FILES_DEST'] = self.dest
+        flup = Flup(app, [UploadSet('files')])
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'foo.txt')))
+        flup.upload_sets_config['files']
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'foo.txt')))
+
+    def test_state_not_served(self):
+        app = Flask(__name__)
+        app.config['UPLOADED_FILES_DEST'] = self.dest
+        Flup(app, [UploadSet('files')])
+        os.makedirs(state_path(self.dest))
+        with open(state_path(self.dest, 'state.txt'), 'w') as f:
+            f.write('private')
+        client = app.test_client()
+        for path in ('.flup/state.txt', './.flup/state.txt',
+                     'x/../.flup/state.txt', 'x/.flup/state.txt'):
+            res = client.get('/_uploads/files/' + path)
+            self.assertEqual(res.status_code, 404, path)
+
+
+class SizeLimitCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.uset = UploadSet('files')
+        self.uset._config = UploadConfiguration(self.dest, max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def test_declared_length(self):
+        tfs = TestingFileStorage(filename='foo.txt', content_length=11)
+        self.assertRaises(UploadNotAllowed, self.uset.save, tfs)
+        self.assertIsNone(tfs.saved)
+
+    def test_streamed_length(self):
+        fs = FileStorage(io.BytesIO(b'x' * 11), filename='foo.txt')
+        self.assertRaises(UploadNotAllowed, self.uset.save, fs)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'foo.txt')))
+        fs = FileStorage(io.BytesIO(b'x' * 10), filename='foo.txt')
+        self.assertEqual(self.uset.save(fs), 'foo.txt')
+
+    def test_configured(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST=self.dest,
+                          UPLOADED_FILES_MAX_SIZE=1024)
+        flup = Flup(app, [UploadSet('files')])
+        self.assertEqual(flup.upload_sets_config['files'].max_size, 1024)
+
+
+class DynamicSetCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.resolved = []
+        self.quota = None
+        self.app = Flask(__name__)
+        self.documents = DynamicUploadSet('documents', resolver=self.resolve,
+                                          tenant=self.tenant, cache_size=2)
+        Flup(self.app, [self.documents])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def tenant(self, request):
+        if request.host not in ('acme', 'initech'):
+            abort(404)
+        return request.host
+
+    def resolve(self, tenant):
+        self.resolved.append(tenant)
+        return UploadConfiguration(os.path.join(self.root, tenant),
+                                   quota=self.quota)
+
+    def save(self, tenant, filename):
+        with self.app.test_request_context(base_url='http://%s/' % tenant):
+            fs = FileStorage(io.BytesIO(tenant.encode('ascii')),
+                             filename=filename)
+            return (self.documents.save(fs), self.documents.url(filename),
+                    self.documents.path(filename))
+
+    def test_routes_per_tenant(self):
+        name, url, path = self.save('acme', 'foo.txt')
+        self.assertEqual(url, 'http://acme/_uploads/documents/foo.txt')
+        self.assertEqual(path, os.path.join(self.root, 'acme', 'foo.txt'))
+        self.assertEqual(self.save('initech', 'foo.txt')[0], 'foo.txt')
+        with self.app.test_client() as client:
+            res = client.get('/_uploads/documents/foo.txt',
+                             base_url='http://initech/')
+            self.assertEqual(res.data, b'initech')
+            res = client.get('/_uploads/documents/foo.txt',
+                             base_url='http://acme/')
+            self.assertEqual(res.data, b'acme')
+
+    def test_quota(self):
+        self.quota = 10
+        self.save('acme', 'a.txt')
+        self.save('acme', 'b.txt')
+        self.assertRaises(UploadNotAllowed, self.save, 'acme', 'c.txt')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root, 'acme', 'c.txt')))
+        self.save('initech', 'c.txt')
+        remove_upload(self.documents.config_for_tenant('acme'), 'a.txt')
+        self.assertEqual(self.save('acme', 'c.txt')[0], 'c.txt')
+
+    def test_bounded_cache(self):
+        for tenant in ('a', 'b', 'a', 'c', 'a', 'b'):
+            self.documents.config_for_tenant(tenant)
+        self.assertEqual(self.resolved, ['a', 'b', 'c', 'b'])
+        self.assertEqual(list(self.documents._configs), ['a', 'b'])
+
+    def test_for_tenant(self):
+        bound = self.documents.for_tenant('acme')
+        self.assertEqual(bound.path('foo.txt'),
+                         os.path.join(self.root, 'acme', 'foo.txt'))
+        self.assertRaises(RuntimeError, lambda: self.documents.config)
+
+    def test_static_features_rejected(self):
+        for options in ({'ttl': 60}, {'replicas': [self.root]},
+                        {'cold_destination': self.root}):
+            documents = DynamicUploadSet(
+                'documents', tenant=self.tenant,
+                resolver=lambda tenant: UploadConfiguration(
+                    os.path.join(self.root, tenant), **options))
+            self.assertRaises(ValueError, documents.for_tenant, 'acme')
+
+    def test_tenant_required(self):
+        self.assertRaises(ValueError, DynamicUploadSet, 'documents',
+                          resolver=self.resolve)
+        with self.app.test_client() as client:
+            res = client.get('/_uploads/documents/foo.txt',
+                             base_url='http://evil/')
+            self.assertEqual(res.status_code, 404)
+        self.assertEqual(self.resolved, [])
+
+
+class ProgressCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_URL='http://localhost:5001/',
+                               UPLOADS_PROGRESS_STORE='memory')
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            return self.files.save(request.files['file'])
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def test_tracked(self):
+        body = b'x' * (1024 * 1024)
+        with self.app.test_client() as client:
+            res = client.post('/upload', headers={'X-Upload-ID': 'abc'},
+                              data={'file': (io.BytesIO(body), 'foo.txt')})
+            self.assertEqual(res.data, b'foo.txt')
+            res = client.get('/_uploads/_progress/abc')
+            status = json.loads(res.data.decode('utf-8'))
+            self.assertEqual(status['state'], 'done')
+            self.assertEqual(status['written'], len(body))
+            self.assertEqual(status['received'], status['total'])
+            self.assertGreater(status['received'], len(body))
+            res = client.get('/_uploads/_progress/unknown')
+            self.assertEqual(res.status_code, 404)
+
+    def test_throttled(self):
+        updates = []
+
+        class Store(progress.MemoryProgressStore):
+            def add(self, upload_id, field, amount):
+                updates.append(amount)
+
+        counter = progress.ProgressCounter(Store(), 'abc', 'written',
+                                           step=1024, interval=60)
+        for _ in range(100):
+            counter.update(b'x' * 100)
+        counter.close()
+        self.assertEqual(updates, [1100] * 9 + [100])
+
+    def test_sqlite_store(self):
+        store = progress.SQLiteProgressStore(os.path.join(self.dest, 'p.db'))
+        store.start('abc', 10)
+        store.add('abc', 'received', 4)
+        store.add('abc', 'received', 6)
+        store.finish('abc')
+        other = progress.SQLiteProgressStore(os.path.join(self.dest, 'p.db'))
+        status = other.get('abc')
+        self.assertEqual((status['received'], status['total'],
+                          status['state']), (10, 10, 'done'))
+        self.assertIsNone(other.get('xyz'))
+
+
+class IntegrityCase(unittest.TestCase):
+    body = b'integrity matters'
+    md5 = '0d8b1a8e2bb1a1fbd06b5e9a00fbbbc5'
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_DIGESTS=('sha256',))
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def storage(self, **headers):
+        fs = FileStorage(io.BytesIO(self.body), filename='foo.txt')
+        fs.headers.extend(headers)
+        return fs
+
+    def test_computed_while_saving(self):
+        with self.app.test_request_context():
+            saved = self.files.save(self.storage())
+        self.assertEqual(saved, 'foo.txt')
+        self.assertEqual(saved.digests,
+                         {'sha256': hashlib.sha256(self.body).hexdigest()})
+
+    def test_verified(self):
+        md5 = base64.b64encode(hashlib.md5(self.body).digest())
+        with self.app.test_request_context():
+            saved = self.files.save(self.storage(**{'Content-MD5': md5}))
+            self.assertIn('md5', saved.digests)
+            bad = base64.b64encode(hashlib.sha256(b'other').digest())
+            self.assertRaises(DigestMismatch, self.files.save,
+                              self.storage(Digest='sha-256=' +
+                                           bad.decode('ascii')))
+        self.assertEqual(sorted(os.listdir(self.dest)), ['.flup', 'foo.txt'])
+
+    def test_expected_hex_or_base64(self):
+        md5 = hashlib.md5(self.body)
+        for value in (md5.hexdigest(), md5.hexdigest().upper(),
+                      base64.b64encode(md5.digest()).decode('ascii')):
+            self.assertEqual(integrity.expected_digests(
+                {'Content-MD5': value}), {'md5': md5.hexdigest()})
+        sha = hashlib.sha256(self.body)
+        self.assertEqual(integrity.expected_digests(
+            {'Digest': 'sha-256=' + sha.hexdigest()}),
+            {'sha256': sha.hexdigest()})
+        for value in ('abc', md5.hexdigest()[:-2] + 'zz'):
+            self.assertRaises(ValueError, integrity.expected_digests,
+                              {'Content-MD5': value})
+        with self.app.test_request_context():
+            saved = self.files.save(self.storage(**{
+                'Content-MD5': md5.hexdigest()}))
+            self.assertEqual(saved.digests['md5'], md5.hexdigest())
+            self.assertRaises(DigestMismatch, self.files.save,
+                              self.storage(**{'Content-MD5': 'abc'}))
+
+    def test_served_without_rehashing(self):
+        with self.app.test_request_context():
+            saved = self.files.save(self.storage())
+        with self.app.test_client() as client:
+            res = client.get('/_uploads/files/foo.txt')
+            self.assertEqual(res.data, self.body)
+            self.assertEqual(res.headers['ETag'],
+                             '"%s"' % saved.digests['sha256'])
+            self.assertTrue(res.headers['Digest'].startswith('sha-256='))
+            res = client.get('/_uploads/files/foo.txt',
+                             headers={'If-None-Match': res.headers['ETag']})
+            self.assertEqual(res.status_code, 304)
+
+    def test_sidecar_fallback(self):
+        path = os.path.join(self.dest, 'foo.txt')
+        open(path, 'w').close()
+        setxattr = os.setxattr
+
+        def unsupported(*args):
+            raise OSError(95, 'Operation not supported')
+
+        os.setxattr = unsupported
+        try:
+            integrity.store_digests(path, state_path(self.dest), 'foo.txt',
+                                    {'md5': self.md5})
+        finally:
+            os.setxattr = setxattr
+        self.assertTrue(os.path.exists(integrity.sidecar_path(
+            state_path(self.dest), 'foo.txt')))
+        self.assertEqual(integrity.load_digests(path, state_path(self.dest),
+                                                'foo.txt'),
+                         {'md5': self.md5})
+
+
+class IngestCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_MAX_SIZE=1024,
+                               UPLOADED_FILES_DIGESTS=('sha256',),
+                               UPLOADS_PROGRESS_STORE='memory')
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+        self.seen = {}
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            storage = self.files.ingest()['file']
+            self.seen['stream'] = storage.stream
+            if storage.stream.reason is None:
+                self.seen['inode'] = os.fstat(
+                    storage.stream.file.fileno()).st_ino
+            try:
+                return self.files.save(storage)
+            except UploadNotAllowed as e:
+                return str(e), 400
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def post(self, body, filename):
+        with self.app.test_client() as client:
+            return client.post('/upload', data={
+                'file': (io.BytesIO(body), filename)})
+
+    def ingested(self):
+        return os.listdir(state_path(self.dest, 'ingest'))
+
+    def test_moved_not_copied(self):
+        res = self.post(b'x' * 1000, 'foo.txt')
+        self.assertEqual(res.data, b'foo.txt')
+        final = os.path.join(self.dest, 'foo.txt')
+        self.assertEqual(os.stat(final).st_ino, self.seen['inode'])
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(final).st_mode & 0o777, 0o666 & ~umask)
+        with open(final, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 1000)
+        self.assertEqual(self.ingested(), [])
+        self.assertEqual(integrity.load_digests(final, state_path(self.dest),
+                                                'foo.txt'),
+                         {'sha256': hashlib.sha256(b'x' * 1000).hexdigest()})
+
+    def test_saved_twice(self):
+        @self.app.route('/twice', methods=['POST'])
+        def twice():
+            storage = self.files.ingest()['file']
+            self.files.save(storage)
+            try:
+                self.files.save(storage, name='bar.txt')
+            except ingest.AlreadyPublished as e:
+                return e.path
+        with self.app.test_client() as client:
+            res = client.post('/twice', data={
+                'file': (io.BytesIO(b'x' * 10), 'foo.txt')})
+        self.assertEqual(res.data.decode('utf-8'),
+                         os.path.join(self.dest, 'foo.txt'))
+        self.assertEqual(sorted(os.listdir(self.dest)), ['.flup', 'foo.txt'])
+
+    def test_progress_counted(self):
+        with self.app.test_client() as client:
+            client.post('/upload', headers={'X-Upload-ID': 'abc'},
+                        data={'file': (io.BytesIO(b'x' * 1000), 'foo.txt')})
+            status = json.loads(client.get(
+                '/_uploads/_progress/abc').data.decode('utf-8'))
+        self.assertEqual(status['written'], 1000)
+
+    def test_refused_extension_never_written(self):
+        res = self.post(b'MZ' * 100, 'warez.exe')
+        self.assertEqual(res.status_code, 400)
+        self.assertIsInstance(self.seen['stream'], ingest.Discarded)
+        self.assertFalse(os.path.exists(state_path(self.dest, 'ingest')))
+
+    def test_too_large_discarded(self):
+        res = self.post(b'x' * 1025, 'foo.txt')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.ingested(), [])
+        self.assertEqual(sorted(os.listdir(self.dest)), ['.flup'])
+
+    def test_unsaved_parts_removed(self):
+        @self.app.route('/ignore', methods=['POST'])
+        def ignore():
+            self.files.ingest()
+            return 'ignored'
+
+        with self.app.test_client() as client:
+            client.post('/ignore', data={
+                'file': (io.BytesIO(b'data'), 'foo.txt')})
+        self.assertEqual(self.ingested(), [])
+
+
+class StagingCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest)
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def storage(self, body=b'staged'):
+        return FileStorage(io.BytesIO(body), filename='foo.txt')
+
+    def listing(self):
+        return sorted(os.listdir(self.dest))
+
+    def staged(self):
+        return os.listdir(state_path(self.dest, 'staging'))
+
+    def test_commit(self):
+        with self.app.test_request_context():
+            staged = self.files.stage(self.storage())
+            self.assertEqual(staged.name, 'foo.txt')
+            self.assertFalse(os.path.exists(staged.target))
+            self.assertEqual(self.files.save(self.storage()), 'foo_1.txt')
+            client = self.app.test_client()
+            self.assertEqual(client.get('/_uploads/files/foo.txt')
+                             .status_code, 404)
+            self.assertEqual(staged.commit(), 'foo.txt')
+        with open(os.path.join(self.dest, 'foo.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'staged')
+        self.assertEqual(self.staged(), [])
+        self.assertEqual(os.listdir(state_path(self.dest, 'journal')), [])
+
+    def test_rollback(self):
+        with self.app.test_request_context():
+            staged = self.files.stage(self.storage())
+            staged.rollback()
+            self.assertRaises(RuntimeError, staged.commit)
+        self.assertEqual(self.listing(), ['.flup'])
+        self.assertEqual(self.staged(), [])
+
+    def test_context_manager(self):
+        uset = UploadSet('files')
+        uset._config = UploadConfiguration(self.dest)
+        with uset.stage(self.storage()) as staged:
+            pass
+        self.assertEqual(staged.state, 'committed')
+        try:
+            with uset.stage(self.storage()) as staged:
+                raise ValueError('database down')
+        except ValueError:
+            pass
+        self.assertEqual(staged.state, 'rolled back')
+        self.assertEqual(self.listing(), ['.flup', 'foo.txt'])
+
+    def test_settled_by_teardown(self):
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            self.files.stage(request.files['file'])
+            if request.args.get('fail'):
+                raise ValueError('database down')
+            return 'ok'
+
+        client = self.app.test_client()
+        client.post('/upload', data={'file': (io.BytesIO(b'a'), 'a.txt')})
+        self.assertEqual(self.listing(), ['.flup'])
+        self.app.config['UPLOADS_STAGED_DEFAULT'] = 'commit'
+        client.post('/upload', data={'file': (io.BytesIO(b'b'), 'b.txt')})
+        self.assertEqual(self.listing(), ['.flup', 'b.txt'])
+        res = client.post('/upload?fail=1',
+                          data={'file': (io.BytesIO(b'c'), 'c.txt')})
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(self.listing(), ['.flup', 'b.txt'])
+
+    def test_interrupted_commit_finished(self):
+        with self.app.test_request_context():
+            staged = self.files.stage(self.storage())
+            interrupted = self.files.stage(self.storage(b'interrupted'))
+            request.environ.pop('flup.staged')
+        os.rename(staged.path, staged.target)
+        for upload in (staged, interrupted):
+            WriteJournal.active.discard(upload.entry)
+        with self.app.app_context():
+            removed = self.flup.recover()[self.dest]
+        self.assertEqual(removed, [os.path.relpath(interrupted.path,
+                                                   self.dest)])
+        self.assertEqual(self.listing(), ['.flup', 'foo.txt'])
+        self.assertEqual(self.staged(), [])
+        self.assertEqual(os.listdir(state_path(self.dest, 'claims')), [])
+        self.assertEqual(os.listdir(state_path(self.dest, 'journal')), [])
+
+    def test_publish_failure(self):
+        class Failing(UploadSet):
+            def published(self, config, path, saved):
+                raise IOError('index unavailable')
+
+        uset = Failing('files')
+        uset._config = UploadConfiguration(self.dest)
+        staged = uset.stage(self.storage())
+        self.assertRaises(IOError, staged.commit)
+        self.assertEqual(staged.state, 'rolled back')
+        self.assertEqual(self.listing(), ['.flup'])
+        self.assertFalse(os.path.exists(staged.claim))
+        self.assertEqual(os.listdir(state_path(self.dest, 'journal')), [])
+
+    def test_sweep(self):
+        uset = UploadSet('files')
+        uset._config = UploadConfiguration(self.dest)
+        staged = uset.stage(self.storage())
+        self.assertEqual(self.flup.sweep_staging(max_age=60),
+                         {self.dest: 0})
+        self.assertTrue(os.path.exists(staged.claim))
+        WriteJournal.active.discard(staged.entry)
+        old = time.time() - 120
+        os.utime(staged.path, (old, old))
+        self.assertEqual(uset.sweep_staging(max_age=60), 1)
+        self.assertEqual(self.listing(), ['.flup'])
+        self.assertFalse(os.path.exists(staged.claim))
+        self.assertEqual(uset.save(self.storage()), 'foo.txt')
+
+
+class RetentionCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_TTL=3600,
+                               UPLOADED_FILES_DIGESTS=('md5',))
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def save(self, count):
+        with self.app.test_request_context():
+            return [self.files.save(FileStorage(io.BytesIO(b'x'),
+                                                filename='foo.txt'))
+                    for _ in range(count)]
+
+    def test_sweep_in_batches(self):
+        names = self.save(5)
+        index = retention.expiry_index(state_path(self.dest))
+        self.assertEqual(index.due(time.time(), 10), [])
+        self.assertEqual(self.flup.sweep_expired(), {self.dest: []})
+
+        due = []
+        due_at = index.due
+        index.due = lambda now, limit: due.append(limit) or due_at(now,
+                                                                   limit)
+        try:
+            swept = retention.sweep(index, lambda name: os.unlink(
+                os.path.join(self.dest, name)), batch_size=2,
+                now=time.time() + 3601)
+        finally:
+            del index.due
+        self.assertEqual(sorted(swept), sorted(names))
+        self.assertEqual(len(due), 4)
+        self.assertEqual(os.listdir(self.dest), ['.flup'])
+
+    def test_sweep_removes_sidecars(self):
+        name, = self.save(1)
+        sidecar = integrity.sidecar_path(state_path(self.dest), name)
+        os.makedirs(os.path.dirname(sidecar))
+        open(sidecar, 'w').close()
+        config = self.flup.upload_sets_config['files']
+        self.assertEqual(sweep_expired(config, now=time.time() + 3601),
+                         [name])
+        self.assertFalse(os.path.exists(sidecar))
+
+    def test_staged_expire_from_commit(self):
+        with self.app.test_request_context():
+            staged = self.files.stage(FileStorage(io.BytesIO(b'x'),
+                                                  filename='foo.txt'))
+            index = retention.expiry_index(state_path(self.dest))
+            self.assertEqual(index.due(time.time() + 3601, 10), [])
+            staged.commit()
+            self.assertEqual(index.due(time.time() + 3601, 10), ['foo.txt'])
+
+    def test_cli(self):
+        from click.testing import CliRunner
+        from flask.cli import ScriptInfo
+        self.save(2)
+        index = retention.expiry_index(state_path(self.dest))
+        with index.connection as db:
+            db.execute('UPDATE expiry SET expires = 0')
+        result = CliRunner().invoke(
+            self.app.cli, ['flup', 'sweep'],
+            obj=ScriptInfo(create_app=lambda info: self.app))
+        self.assertEqual(result.output.strip(),
+                         '{}: 2 expired'.format(self.dest))
+
+    def test_background_sweeper(self):
+        self.save(1)
+        index = retention.expiry_index(state_path(self.dest))
+        with index.connection as db:
+            db.execute('UPDATE expiry SET expires = 0')
+        sweeper = self.flup.start_sweeper(interval=0.01)
+        try:
+            for _ in range(200):
+                if os.listdir(self.dest) == ['.flup']:
+                    break
+                time.sleep(0.01)
+        finally:
+            sweeper.stop()
+            sweeper.join()
+        self.assertEqual(os.listdir(self.dest), ['.flup'])
+
+
+class TieringCase(unittest.TestCase):
+    def setUp(self):
+        self.hot, self.cold = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.hot,
+                               UPLOADED_FILES_COLD_DEST=self.cold,
+                               UPLOADED_FILES_COLD_AFTER=60,
+                               UPLOADED_FILES_DIGESTS=('sha256',),
+                               UPLOADED_FILES_TTL=3600)
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+        self.index = tiering.tier_index(state_path(self.hot))
+
+    def tearDown(self):
+        self.index.flush()
+        shutil.rmtree(self.hot)
+        shutil.rmtree(self.cold)
+
+    def save(self, name, body=b'tiered'):
+        with self.app.test_request_context():
+            return self.files.save(FileStorage(io.BytesIO(body),
+                                               filename=name),
+                                   folder='someguy')
+
+    def migrate(self, after):
+        with self.app.test_request_context():
+            return self.files.migrate_cold() if after is None else \
+                tiering.migrate(self.index, self.hot, self.cold, 60,
+                                now=time.time() + after)
+
+    def test_idle_accesses_flushed(self):
+        index = tiering.TierIndex(os.path.join(self.hot, 'tiers.db'),
+                                  flush_interval=0.05)
+        index.add('a.txt', now=0)
+        index.touch('a.txt')
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            last_access, hits = index.connection.execute(
+                'SELECT last_access, hits FROM tiers').fetchone()
+            if hits:
+                break
+            time.sleep(0.01)
+        self.assertEqual(hits, 1)
+        self.assertGreater(last_access, 0)
+
+    def test_cold_files_move_and_still_resolve(self):
+        name = self.save('old.txt')
+        self.save('new.txt')
+        self.assertEqual(self.migrate(None), [])
+        with self.index.connection as db:
+            db.execute('UPDATE tiers SET last_access = 0 WHERE name = ?',
+                       (name,))
+        self.assertEqual(self.migrate(None), [name])
+        self.assertFalse(os.path.exists(os.path.join(self.hot, name)))
+        with self.app.test_request_context():
+            self.assertEqual(self.files.path('old.txt', folder='someguy'),
+                             os.path.join(self.cold, name))
+            self.assertEqual(self.files.path('someguy/new.txt'),
+                             os.path.join(self.hot, 'someguy/new.txt'))
+        with self.app.test_client() as client:
+            res = client.get('/_uploads/files/' + name)
+            self.assertEqual(res.data, b'tiered')
+            self.assertEqual(res.headers['ETag'],
+                             '"%s"' % name.digests['sha256'])
+
+    def test_access_keeps_files_hot(self):
+        name = self.save('foo.txt')
+        with self.app.test_client() as client:
+            for _ in range(3):
+                client.get('/_uploads/files/' + name)
+        self.index.flush()
+        hits, = self.index.connection.execute(
+            'SELECT hits FROM tiers WHERE name = ?', (name,)).fetchone()
+        self.assertEqual(hits, 3)
+        self.assertEqual(self.migrate(30), [])
+        self.assertEqual(self.migrate(61), [name])
+
+    def test_served_while_moving(self):
+        name = self.save('foo.txt')
+        answers = [tiering.HOT]
+        location = self.index.location
+        self.index.location = lambda name: (answers.pop() if answers
+                                            else location(name))
+        try:
+            self.migrate(61)
+            with self.app.test_client() as client:
+                res = client.get('/_uploads/files/' + name)
+                self.assertEqual(res.data, b'tiered')
+        finally:
+            del self.index.location
+
+    def test_concurrent_movers(self):
+        name = self.save('foo.txt')
+        stale = [self.index.cold_candidates(time.time() + 1, 10)]
+        self.assertEqual(self.migrate(61), [name])
+        self.index.cold_candidates = lambda *args: (stale.pop() if stale
+                                                    else [])
+        try:
+            self.assertEqual(self.migrate(61), [])
+        finally:
+            del self.index.cold_candidates
+        self.assertEqual(self.index.location(name), tiering.COLD)
+        with self.app.test_client() as client:
+            res = client.get('/_uploads/files/' + name)
+            self.assertEqual(res.data, b'tiered')
+
+    def test_abandoned_move_taken_over(self):
+        name = self.save('foo.txt')
+        (_, tier, last_access), = self.index.cold_candidates(
+            time.time() + 1, 10)
+        self.assertTrue(self.index.claim(name, tier, last_access))
+        self.assertFalse(self.index.claim(name, tier, last_access))
+        self.assertEqual(self.migrate(61), [])
+        self.assertEqual(self.migrate(tiering.MOVE_LEASE + 1), [name])
+
+    def test_expiry_removes_cold_copy(self):
+        name = self.save('foo.txt')
+        self.migrate(61)
+        config = self.flup.upload_sets_config['files']
+        self.assertEqual(sweep_expired(config, now=time.time() + 3601),
+                         [name])
+        self.assertFalse(os.path.exists(os.path.join(self.cold, name)))
+        self.assertEqual(self.index.location(name), tiering.HOT)
+
+
+class ReplicationCase(unittest.TestCase):
+    def setUp(self):
+        self.primary = tempfile.mkdtemp()
+        self.replicas = (tempfile.mkdtemp(), tempfile.mkdtemp())
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.primary,
+                               UPLOADED_FILES_REPLICAS=self.replicas,
+                               UPLOADED_FILES_REPLICA_WAIT=2,
+                               UPLOADS_REPLICATION_ATTEMPTS=3,
+                               UPLOADS_REPLICATION_BACKOFF=0.01,
+                               UPLOADS_REPLICA_TIMEOUT=5)
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+
+    def tearDown(self):
+        for d in (self.primary,) + self.replicas:
+            shutil.rmtree(d)
+
+    def save(self, name, body=b'replicated'):
+        with self.app.test_request_context():
+            return self.files.save(FileStorage(io.BytesIO(body),
+                                               filename=name),
+                                   folder='someguy')
+
+    def lag(self):
+        with self.app.app_context():
+            return self.flup.replication_lag()[self.primary]
+
+    def test_save_waits_for_replicas(self):
+        name = self.save('foo.txt')
+        for replica in self.replicas:
+            with open(os.path.join(replica, name), 'rb') as f:
+                self.assertEqual(f.read(), b'replicated')
+        self.assertEqual(self.lag(), {'pending': 0, 'failed': 0, 'lag': 0.0})
+
+    def test_serves_from_replica_when_primary_missing(self):
+        name = self.save('foo.txt')
+        os.unlink(os.path.join(self.primary, name))
+        with self.app.test_client() as client:
+            self.assertEqual(client.get('/_uploads/files/' + name).data,
+                             b'replicated')
+        os.unlink(os.path.join(self.replicas[0], name))
+        os.unlink(os.path.join(self.replicas[1], name))
+        with self.app.test_client() as client:
+            self.assertEqual(client.get('/_uploads/files/' + name)
+                             .status_code, 404)
+
+    def test_failing_replica_retries_then_gives_up(self):
+        broken = os.path.join(self.replicas[1], 'not-a-directory')
+        open(broken, 'w').close()
+        self.app.config.update(UPLOADED_FILES_REPLICAS=(self.replicas[0],
+                                                        broken),
+                               UPLOADED_FILES_REPLICA_WAIT=1)
+        name = self.save('foo.txt')
+        self.assertTrue(os.path.exists(os.path.join(self.replicas[0], name)))
+        deadline = time.time() + 5
+        while self.lag()['failed'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.lag()['failed'], 1)
+        self.assertEqual(self.lag()['pending'], 0)
+        os.unlink(broken)
+        os.makedirs(broken)
+        from click.testing import CliRunner
+        from flask.cli import ScriptInfo
+        from flask_flup.cli import flup as command
+        result = CliRunner().invoke(
+            command, ['replication', '--retry'],
+            obj=ScriptInfo(create_app=lambda info: self.app))
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('{}: 1 retried'.format(self.primary), result.output)
+        with self.app.app_context():
+            self.flup.replicator.drain()
+        self.assertTrue(os.path.exists(os.path.join(broken, name)))
+        self.assertEqual(self.lag(), {'pending': 0, 'failed': 0, 'lag': 0.0})
+
+    def test_timeout(self):
+        broken = os.path.join(self.replicas[1], 'not-a-directory')
+        open(broken, 'w').close()
+        self.app.config.update(UPLOADED_FILES_REPLICAS=(broken,),
+                               UPLOADS_REPLICA_TIMEOUT=0.05)
+        with self.assertRaises(ReplicationTimeout) as caught:
+            self.save('foo.txt')
+        self.assertEqual(caught.exception.copied, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.primary,
+                                                    caught.exception.name)))
+
+    def test_pending_copies_resume(self):
+        os.makedirs(os.path.join(self.primary, 'someguy'))
+        with open(os.path.join(self.primary, 'someguy/foo.txt'), 'wb') as f:
+            f.write(b'left behind')
+        log = replication.replication_log(state_path(self.primary))
+        log.add('someguy/foo.txt', self.replicas)
+        self.app.config['UPLOADS_REPLICATION_LEASE'] = 0.3
+        with self.app.app_context():
+            # another live process may still be making these copies
+            self.flup.upload_sets_config['files']
+            self.flup.replicator.drain()
+            self.assertEqual(self.lag()['pending'], 2)
+        # until its lease runs out, when this one takes them over
+        resumer = self.flup.start_resumer(0.05)
+        deadline = time.time() + 5
+        while self.lag()['pending'] and time.time() < deadline:
+            time.sleep(0.02)
+        resumer.stop()
+        for replica in self.replicas:
+            with open(os.path.join(replica, 'someguy/foo.txt'), 'rb') as f:
+                self.assertEqual(f.read(), b'left behind')
+        self.assertEqual(self.lag()['pending'], 0)
+
+    def test_concurrent_copies(self):
+        source = os.path.join(self.primary, 'foo.txt')
+        with open(source, 'wb') as f:
+            f.write(b'x' * 1024 * 1024)
+        target = os.path.join(self.replicas[0], 'foo.txt')
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def copy():
+            barrier.wait()
+            try:
+                tiering.copy(source, target)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=copy) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.replicas[0]), ['foo.txt'])
+        self.assertEqual(os.path.getsize(target), 1024 * 1024)
+
+    def test_expiry_removes_replicas(self):
+        self.app.config['UPLOADED_FILES_TTL'] = 60
+        name = self.save('foo.txt')
+        config = self.flup.upload_sets_config['files']
+        sweep_expired(config, now=time.time() + 61)
+        for replica in self.replicas:
+            self.assertFalse(os.path.exists(os.path.join(replica, name)))
+
+
+class EncryptionCase(unittest.TestCase):
+    key = b'k' * 32
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(
+            UPLOADED_FILES_DEST=self.dest,
+            UPLOADED_FILES_DIGESTS=('sha256',),
+            UPLOADED_FILES_ENCRYPTION_KEY=base64.b64encode(self.key))
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+        self.body = os.urandom(3 * encryption.CHUNK_SIZE + 1000)
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            return self.files.save(self.files.ingest()['file'])
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def stored(self, name):
+        with open(os.path.join(self.dest, name), 'rb') as f:
+            return f.read()
+
+    def roundtrip(self, body, chunk_size):
+        f = io.BytesIO()
+        writer = encryption.EncryptingWriter(f, self.key, chunk_size)
+        for i in range(0, len(body), 7):
+            writer.write(body[i:i + 7])
+        writer.finish()
+        path = os.path.join(self.dest, 'roundtrip')
+        with open(path, 'wb') as out:
+            out.write(f.getvalue())
+        return encryption.DecryptingReader(io.open(path, 'rb'), self.key)
+
+    def test_saved_encrypted_and_served_plain(self):
+        with self.app.test_request_context():
+            name = self.files.save(FileStorage(io.BytesIO(self.body),
+                                               filename='doc.txt'))
+        stored = self.stored(name)
+        self.assertTrue(stored.startswith(encryption.MAGIC))
+        self.assertNotIn(self.body[:64], stored)
+        with self.app.test_client() as client:
+            res = client.get('/_uploads/files/' + name)
+            self.assertEqual(res.data, self.body)
+            self.assertTrue(res.headers['Content-Type']
+                            .startswith('text/plain'))
+            self.assertEqual(res.headers['ETag'], '"%s"' %
+                             hashlib.sha256(self.body).hexdigest())
+
+    def test_range_requests(self):
+        with self.app.test_request_context():
+            name = self.files.save(FileStorage(io.BytesIO(self.body),
+                                               filename='doc.txt'))
+        with self.app.test_client() as client:
+            res = client.get('/_uploads/files/' + name,
+                             headers={'Range': 'bytes=65530-131080'})
+            self.assertEqual(res.status_code, 206)
+            self.assertEqual(res.data, self.body[65530:131081])
+            res = client.get('/_uploads/files/' + name,
+                             headers={'Range': 'bytes=-10'})
+            self.assertEqual(res.data, self.body[-10:])
+
+    def test_ingested_parts_encrypted(self):
+        with self.app.test_client() as client:
+            name = client.post('/upload', data={
+                'file': (io.BytesIO(self.body), 'doc.txt')}).data.decode()
+        self.assertTrue(self.stored(name).startswith(encryption.MAGIC))
+        with self.app.test_client() as client:
+            self.assertEqual(client.get('/_uploads/files/' + name).data,
+                             self.body)
+
+    def test_chunk_boundaries(self):
+        for size in (0, 1, 15, 16, 17, 48, 49):
+            body = os.urandom(size)
+            reader = self.roundtrip(body, 16)
+            self.assertEqual(reader.size, size)
+            self.assertEqual(reader.read(), body)
+            reader.seek(size // 2)
+            self.assertEqual(reader.read(5), body[size // 2:size // 2 + 5])
+            reader.close()
+
+    def test_tampering_detected(self):
+        body = os.urandom(64)
+        self.roundtrip(body, 16).close()
+        path = os.path.join(self.dest, 'roundtrip')
+        with open(path, 'rb') as f:
+            stored = f.read()
+        frame = 16 + encryption.TAG_SIZE
+        for damaged in (stored[:-frame],
+                        stored[:-1] + bytes([stored[-1] ^ 1])):
+            with open(path, 'wb') as f:
+                f.write(damaged)
+            reader = encryption.DecryptingReader(io.open(path, 'rb'),
+                                                 self.key)
+            self.assertRaises(encryption.DecryptionError, reader.read)
+            reader.close()
+        with open(path, 'wb') as f:
+            f.write(stored)
+        self.assertRaises(encryption.DecryptionError,
+                          encryption.DecryptingReader, io.open(path, 'rb'),
+                          b'x' * 32)
+
+    def test_bad_key(self):
+        self.assertRaises(ValueError, encryption.master_key, b'short')
+        self.assertEqual(encryption.master_key(
+            base64.b64encode(self.key).decode('ascii')), self.key)
+
+
+class FakeClamd(object):
+    """
+    Answers clamd INSTREAM scans on a unix socket, finding anything that
+    contains ``EICAR``.
+    """
+    def __init__(self, path, delay=0):
+        self.path = path
+        self.delay = delay
+        self.scans = 0
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(8)
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.answer, args=(conn,)).start()
+
+    def read(self, conn, n):
+        data = b''
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def answer(self, conn):
+        try:
+            command = b''
+            while not command.endswith(b'\0'):
+                command += self.read(conn, 1)
+            assert command == b'zINSTREAM\0'
+            body = b''
+            while True:
+                size, = struct.unpack('>I', self.read(conn, 4))
+                if not size:
+                    break
+                body += self.read(conn, size)
+            self.scans += 1
+            time.sleep(self.delay)
+            if b'EICAR' in body:
+                conn.sendall(b'stream: Eicar-Test-Signature FOUND\0')
+            else:
+                conn.sendall(b'stream: OK\0')
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class ScanningCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.clamd = FakeClamd(os.path.join(self.dest, 'clamd.sock'))
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_SCAN=self.clamd.path,
+                               UPLOADS_SCAN_WAIT=5)
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            try:
+                return self.files.save(self.files.ingest()['file'])
+            except UploadInfected as e:
+                return e.signature, 400
+
+    def tearDown(self):
+        self.clamd.close()
+        shutil.rmtree(self.dest)
+
+    def save(self, body, name='foo.txt', headers=None):
+        with self.app.test_request_context():
+            return self.files.save(FileStorage(io.BytesIO(body),
+                                               filename=name,
+                                               headers=headers))
+
+    def quarantined(self):
+        try:
+            return os.listdir(state_path(self.dest, 'quarantine'))
+        except OSError:
+            return []
+
+    def test_clean_files_saved(self):
+        name = self.save(b'harmless' * 10000)
+        self.assertTrue(os.path.exists(os.path.join(self.dest, name)))
+        self.assertEqual(self.clamd.scans, 1)
+
+    def test_infected_files_quarantined(self):
+        body = b'X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR'
+        with self.assertRaises(UploadInfected) as caught:
+            self.save(body)
+        self.assertEqual(caught.exception.signature, 'Eicar-Test-Signature')
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'foo.txt')))
+        digest = hashlib.sha256(body).hexdigest()
+        self.assertEqual(self.quarantined(), [digest])
+        res = self.app.test_client().post('/upload', data={
+            'file': (io.BytesIO(body), 'bar.txt')})
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'bar.txt')))
+
+    def test_verdicts_cached_by_content(self):
+        body = b'the same bytes'
+        self.save(body, 'foo.txt')
+        digest = base64.b64encode(hashlib.sha256(body).digest()).decode()
+        self.save(body, 'bar.txt', {'Digest': 'sha-256=' + digest})
+        res = self.app.test_client().post('/upload', data={
+            'file': (io.BytesIO(body), 'baz.txt')})
+        self.assertEqual(res.data, b'baz.txt')
+        self.assertEqual(self.clamd.scans, 1)
+
+    def test_daemon_down_refuses_saves(self):
+        self.clamd.close()
+        os.unlink(self.clamd.path)
+        self.assertRaises(scanning.ScanError, self.save, b'data')
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'foo.txt')))
+
+    def test_async_scans_block_serving(self):
+        self.app.config['UPLOADED_FILES_SCAN_MODE'] = 'async'
+        self.clamd.delay = 0.2
+        clean = self.save(b'harmless', 'clean.txt')
+        infected = self.save(b'EICAR', 'infected.txt')
+        client = self.app.test_client()
+        self.assertEqual(client.get('/_uploads/files/' + clean).data,
+                         b'harmless')
+        self.assertEqual(client.get('/_uploads/files/' + infected)
+                         .status_code, 404)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, infected)))
+        self.assertEqual(len(self.quarantined()), 1)
+
+    def test_async_verdict_timeout(self):
+        self.app.config.update(UPLOADED_FILES_SCAN_MODE='async',
+                               UPLOADS_SCAN_WAIT=0.1)
+        self.clamd.delay = 1
+        name = self.save(b'harmless')
+        res = self.app.test_client().get('/_uploads/files/' + name)
+        self.assertEqual(res.status_code, 503)
+
+
+    def test_failing_scans_retried(self):
+        self.app.config.update(UPLOADED_FILES_SCAN_MODE='async',
+                               UPLOADS_SCAN_ATTEMPTS=2,
+                               UPLOADS_SCAN_BACKOFF=0.05)
+        self.clamd.close()
+        os.unlink(self.clamd.path)
+        name = self.save(b'harmless')
+        verdicts = scanning.verdict_index(state_path(self.dest))
+        deadline = time.time() + 5
+        while verdicts.state(name) != scanning.FAILED and \
+                time.time() < deadline:
+            time.sleep(0.02)
+        client = self.app.test_client()
+        started = time.time()
+        self.assertEqual(client.get('/_uploads/files/' + name).status_code,
+                         503)
+        self.assertLess(time.time() - started, 1)
+        self.clamd = FakeClamd(self.clamd.path)
+        while verdicts.state(name) is not None and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(client.get('/_uploads/files/' + name).data,
+                         b'harmless')
+
+    def test_pending_scans_claimed_once(self):
+        verdicts = scanning.verdict_index(state_path(self.dest))
+        verdicts.queue('a.txt')
+        self.assertEqual(verdicts.claim(time.time() - 600), [])
+        self.assertEqual(verdicts.claim(time.time() + 1), ['a.txt'])
+        self.assertEqual(verdicts.claim(time.time() - 600), [])
+
+
+class MetadataCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_METADATA=True,
+                               UPLOADED_FILES_TTL=60)
+        self.files = UploadSet('files', ALL)
+        self.flup = Flup(self.app, [self.files])
+        self.index = metadata.metadata_index(state_path(self.dest))
+        self.seen = {}
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            for storage in request.files.getlist('file'):
+                self.files.save(storage, folder='docs', owner='someguy')
+            self.seen['rows'] = self.rows()
+            return 'ok'
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def rows(self):
+        return self.index.connection.execute(
+            'SELECT count(*) FROM uploads').fetchone()[0]
+
+    def save(self, name, body=b'data', owner=None):
+        with self.app.test_request_context():
+            return self.files.save(FileStorage(io.BytesIO(body),
+                                               filename=name,
+                                               content_type='text/plain'),
+                                   owner=owner)
+
+    def query(self, **filters):
+        with self.app.test_request_context():
+            return self.files.query(**filters)
+
+    def test_recorded(self):
+        name = self.save('Report.PDF', b'x' * 100, owner='someguy')
+        (upload,), cursor = self.query()
+        self.assertIsNone(cursor)
+        self.assertEqual(upload.name, name)
+        self.assertEqual(upload.original, 'Report.PDF')
+        self.assertEqual(upload.owner, 'someguy')
+        self.assertEqual(upload.extension, 'pdf')
+        self.assertEqual(upload.content_type, 'text/plain')
+        self.assertEqual(upload.size, 100)
+        self.assertEqual(upload.digest,
+                         hashlib.sha256(b'x' * 100).hexdigest())
+
+    def test_filters(self):
+        self.save('a.pdf', b'x' * 10, owner='someguy')
+        self.save('b.pdf', b'x' * 1000, owner='someguy')
+        self.save('c.txt', b'x' * 10, owner='someguy')
+        self.save('d.pdf', b'x' * 10, owner='otherguy')
+        names = lambda uploads: sorted(u.name for u in uploads[0])
+        self.assertEqual(names(self.query(owner='someguy', extension='pdf')),
+                         ['a.pdf', 'b.pdf'])
+        self.assertEqual(names(self.query(min_size=100)), ['b.pdf'])
+        self.assertEqual(names(self.query(since=time.time() - 60,
+                                          owner='otherguy')), ['d.pdf'])
+        self.assertEqual(names(self.query(until=time.time() - 60)), [])
+
+    def test_cursor_pagination(self):
+        for n in range(5):
+            self.save('{:d}.txt'.format(n))
+        seen, cursor = [], None
+        while True:
+            uploads, cursor = self.query(limit=2, cursor=cursor)
+            seen.extend(u.name for u in uploads)
+            if len(seen) == 2:
+                self.save('new.txt')
+            if cursor is None:
+                break
+        self.assertEqual(sorted(seen), ['{:d}.txt'.format(n)
+                                        for n in range(5)])
+        self.assertRaises(ValueError, self.query, cursor='nonsense')
+
+    def test_batched_per_request(self):
+        self.app.test_client().post('/upload', data={'file': [
+            (io.BytesIO(b'one'), 'one.txt'), (io.BytesIO(b'two'), 'two.txt'),
+            (io.BytesIO(b'three'), 'three.txt')]})
+        self.assertEqual(self.seen['rows'], 0)
+        self.assertEqual(self.rows(), 3)
+        uploads, _ = self.query(folder='docs')
+        self.assertEqual(set(u.owner for u in uploads), set(['someguy']))
+
+    def test_removed_with_file(self):
+        name = self.save('foo.txt')
+        config = self.flup.upload_sets_config['files']
+        sweep_expired(config, now=time.time() + 61)
+        self.assertIsNone(self.index.get(name))
+
+
+class ThrottlingCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_RATE=4 * 1024 * 1024,
+                               UPLOADED_FILES_BURST=64 * 1024,
+                               UPLOADED_FILES_MAX_DOWNLOADS=1)
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+        self.body = os.urandom(1024 * 1024)
+        with open(os.path.join(self.dest, 'big.txt'), 'wb') as f:
+            f.write(self.body)
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def test_paced(self):
+        started = time.time()
+        res = self.app.test_client().get('/_uploads/files/big.txt')
+        self.assertEqual(res.data, self.body)
+        res.close()
+        self.assertGreater(time.time() - started, 0.15)
+        metrics = self.flup.throttle_metrics()['files']
+        self.assertEqual(metrics['bytes'], len(self.body))
+        self.assertGreater(metrics['delayed'], 0)
+        self.assertEqual(metrics['active'], 0)
+
+    def test_download_cap(self):
+        client = self.app.test_client()
+        first = client.get('/_uploads/files/big.txt', buffered=False)
+        self.assertEqual(first.status_code, 200)
+        second = client.get('/_uploads/files/big.txt')
+        self.assertEqual(second.status_code, 503)
+        self.assertEqual(second.headers['Retry-After'], '5')
+        first.close()
+        metrics = self.flup.throttle_metrics()['files']
+        self.assertEqual((metrics['active'], metrics['rejected']), (0, 1))
+        self.assertEqual(client.get('/_uploads/files/big.txt',
+                                    headers={'Range': 'bytes=0-9'}).data,
+                         self.body[:10])
+
+    def test_not_modified_releases(self):
+        client = self.app.test_client()
+        res = client.get('/_uploads/files/big.txt')
+        res.close()
+        etag = res.headers['ETag']
+        res = client.get('/_uploads/files/big.txt',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(self.flup.throttle_metrics()['files']['active'], 0)
+
+    def test_stores(self):
+        for store in (throttling.MemoryThrottleStore(),
+                      throttling.SQLiteThrottleStore(
+                          os.path.join(self.dest, 'throttle.db'))):
+            self.assertEqual(store.reserve('files', 'a', 1000, 1000, 1000),
+                             0)
+            self.assertAlmostEqual(
+                store.reserve('files', 'a', 500, 1000, 1000), 0.5, 1)
+            self.assertEqual(store.reserve('files', 'b', 1000, 1000, 1000),
+                             0)
+            slot = store.acquire('files', 2)
+            self.assertIsNotNone(slot)
+            self.assertIsNotNone(store.acquire('files', 2))
+            self.assertIsNone(store.acquire('files', 2))
+            store.release('files', slot)
+            store.release('files', slot)
+            self.assertIsNotNone(store.acquire('files', None))
+            metrics = store.get_metrics()['files']
+            self.assertEqual((metrics['active'], metrics['bytes'],
+                              metrics['rejected']), (2, 2500, 1))
+
+    def test_lost_slots_expire(self):
+        store = throttling.SQLiteThrottleStore(
+            os.path.join(self.dest, 'throttle.db'), lease=0.05)
+        kept = store.acquire('files', 2)
+        store.acquire('files', 2)
+        self.assertIsNone(store.acquire('files', 2))
+        time.sleep(0.1)
+        store.renew('files', kept)
+        self.assertIsNotNone(store.acquire('files', 2))
+        self.assertIsNone(store.acquire('files', 2))
+        self.assertEqual(store.get_metrics()['files']['active'], 2)
+
+    def test_accel(self):
+        self.app.config['UPLOADS_THROTTLE_ACCEL'] = True
+        started = time.time()
+        res = self.app.test_client().get('/_uploads/files/big.txt')
+        self.assertEqual(res.data, self.body)
+        res.close()
+        self.assertLess(time.time() - started, 0.15)
+        self.assertEqual(res.headers['X-Accel-Limit-Rate'],
+                         str(4 * 1024 * 1024))
+        self.assertEqual(self.flup.throttle_metrics()['files']['active'], 0)
+
+    def test_full_buckets_pruned(self):
+        memory = throttling.MemoryThrottleStore(prune_interval=0)
+        database = throttling.SQLiteThrottleStore(
+            os.path.join(self.dest, 'throttle.db'), prune_interval=0)
+        for store in (memory, database):
+            store.reserve('files', 'a', 1000, 100000, 1000)
+            store.reserve('files', 'b', 1000, 1, 1000)
+            time.sleep(0.05)
+            store.reserve('files', 'c', 10, 100000, 1000)
+        self.assertEqual(sorted(key for _, key in memory.buckets),
+                         ['b', 'c'])
+        with database.transaction() as db:
+            self.assertEqual(sorted(row[0] for row in db.execute(
+                'SELECT key FROM buckets')), ['b', 'c'])
+
+    def test_client_key(self):
+        self.app.config['UPLOADS_THROTTLE_KEY'] = \
+            lambda request: request.headers.get('X-User')
+        with self.app.test_request_context(headers={'X-User': 'someguy'}):
+            self.assertEqual(throttling.client_key(
+                request, self.app.config['UPLOADS_THROTTLE_KEY']), 'someguy')
+        with self.app.test_request_context(
+                environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            self.assertEqual(throttling.client_key(request), '10.0.0.1')
+
+
+class DurabilityCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_DURABLE=True,
+                               UPLOADS_FSYNC_MAX_WAIT=0.05)
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+        self.synced = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def fsync(self, path):
+        self.synced.append(path)
+
+    def concurrently(self, target, count):
+        barrier = threading.Barrier(count)
+        errors = []
+
+        def run(n):
+            barrier.wait()
+            try:
+                target(n)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(n,))
+                   for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_grouped(self):
+        group = durability.GroupCommit(0.1, fsync=self.fsync)
+        paths = [os.path.join(self.dest, 'd{:d}'.format(n % 2), str(n))
+                 for n in range(8)]
+        self.assertEqual(self.concurrently(
+            lambda n: group.sync(paths[n]), 8), [])
+        self.assertEqual(group.synced, 8)
+        self.assertLess(group.batches, 8)
+        directories = set(os.path.dirname(p) for p in paths)
+        self.assertEqual(set(self.synced), set(paths) | directories)
+        self.assertLessEqual(len(self.synced), 8 + 2 * group.batches)
+
+    def test_full_batch_closes_early(self):
+        group = durability.GroupCommit(10, max_batch=2, fsync=self.fsync)
+        started = time.time()
+        self.concurrently(lambda n: group.sync(str(n)), 2)
+        self.assertLess(time.time() - started, 5)
+
+    def test_errors_reach_every_save(self):
+        def fail(path):
+            raise OSError(5, 'Input/output error')
+        group = durability.GroupCommit(0.1, fsync=fail)
+        errors = self.concurrently(lambda n: group.sync(str(n)), 4)
+        self.assertEqual(len(errors), 4)
+
+    def test_created_folders_synced(self):
+        self.flup._group_commit = (os.getpid(), durability.GroupCommit(
+            0, fsync=self.fsync))
+        with self.app.test_request_context():
+            self.files.save(FileStorage(io.BytesIO(b'durable'),
+                                        filename='a.txt'),
+                            folder='u1/2026')
+            self.files.save(FileStorage(io.BytesIO(b'durable'),
+                                        filename='b.txt'),
+                            folder='u1/2026')
+        u1 = os.path.join(self.dest, 'u1')
+        folder = os.path.join(u1, '2026')
+        journal = state_path(self.dest, 'journal')
+        self.assertEqual(set(self.synced[:4]),
+                         set([os.path.join(folder, 'a.txt'), u1, folder,
+                              self.dest]))
+        self.assertEqual(self.synced[4:], [journal,
+                                           os.path.join(folder, 'b.txt'),
+                                           folder, journal])
+
+    def test_finished_entry_survives(self):
+        journal = WriteJournal(self.dest)
+        finished = []
+
+        def fsync(path):
+            # what a power loss right after the sync would leave
+            if path == journal.directory:
+                for entry in journal.entries():
+                    with open(entry) as f:
+                        finished.append((entry, f.read()))
+
+        self.flup._group_commit = (os.getpid(), durability.GroupCommit(
+            0, fsync=fsync))
+        with self.app.test_request_context():
+            self.files.save(FileStorage(io.BytesIO(b'durable'),
+                                        filename='a.txt'))
+            staged = self.files.stage(FileStorage(io.BytesIO(b'staged'),
+                                                  filename='b.txt'))
+            staged.commit()
+        self.assertEqual(len(finished), 2)
+        self.assertEqual(list(journal.entries()), [])
+        for entry, record in finished:
+            with open(entry, 'w') as f:
+                f.write(record)
+        with self.app.app_context():
+            self.assertEqual(self.flup.recover(), {self.dest: []})
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ['.flup', 'a.txt', 'b.txt'])
+        self.assertEqual(list(journal.entries()), [])
+
+    def test_saves_synced(self):
+        def save(n):
+            with self.app.test_request_context():
+                self.files.save(FileStorage(io.BytesIO(b'durable'),
+                                            filename='{:d}.txt'.format(n)))
+        with self.app.app_context():
+            group = self.flup.group_commit
+        self.assertEqual(self.concurrently(save, 6), [])
+        self.assertEqual(group.synced, 6)
+        self.assertLess(group.batches, 6)
+        self.assertEqual(len(os.listdir(self.dest)), 7)
+
+
+class MemoryFilesystemCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = MemoryFilesystem()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST='/uploads',
+                               UPLOADS_FILESYSTEM=self.fs)
+        self.files = UploadSet('files')
+        self.flup = Flup(self.app, [self.files])
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            return self.files.url(self.files.save(request.files['file']))
+
+    def storage(self, body=b'in memory', filename='foo.txt'):
+        return FileStorage(io.BytesIO(body), filename=filename)
+
+    def test_operations(self):
+        fs = self.fs
+        self.assertRaises(OSError, fs.open, '/missing/a', 'wb')
+        fs.makedirs('/a/b')
+        with fs.open('/a/b/c', 'xb') as f:
+            f.write(b'data')
+        self.assertRaises(OSError, fs.open, '/a/b/c', 'xb')
+        self.assertEqual(fs.read('/a//b/c'), b'data')
+        fs.rename('/a/b/c', '/a/c')
+        self.assertEqual(fs.listdir('/a'), ['b', 'c'])
+        fs.unlink('/a/c')
+        self.assertFalse(fs.exists('/a/c'))
+        self.assertRaises(OSError, fs.unlink, '/a/c')
+
+    def test_save_and_serve(self):
+        self.assertFalse(os.path.exists('/uploads'))
+        with self.app.test_request_context():
+            self.assertEqual(self.files.save(self.storage()), 'foo.txt')
+            self.assertEqual(self.files.save(self.storage(b'second')),
+                             'foo_1.txt')
+            self.assertEqual(self.files.save(self.storage(), folder='x'),
+                             'x/foo.txt')
+        self.assertEqual(self.fs.read('/uploads/foo_1.txt'), b'second')
+        self.assertFalse(os.path.exists('/uploads'))
+        client = self.app.test_client()
+        res = client.get('/_uploads/files/foo.txt')
+        self.assertEqual(res.data, b'in memory')
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        res = client.get('/_uploads/files/foo.txt',
+                         headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        res = client.get('/_uploads/files/foo.txt',
+                         headers={'Range': 'bytes=3-'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.data, b'memory')
+        self.assertEqual(client.get('/_uploads/files/bar.txt').status_code,
+                         404)
+
+    def test_stage(self):
+        with self.app.test_request_context():
+            staged = self.files.stage(self.storage())
+            self.assertEqual(self.files.save(self.storage()), 'foo_1.txt')
+            self.assertEqual(staged.commit(), 'foo.txt')
+            self.files.stage(self.storage(filename='bar.txt')).rollback()
+        self.assertEqual(self.fs.read('/uploads/foo.txt'), b'in memory')
+        self.assertEqual(self.fs.listdir('/uploads'),
+                         ['.flup', 'foo.txt', 'foo_1.txt'])
+
+    def test_load(self):
+        workload = testing.Workload(40, testing.uniform(0, 4096),
+                                    collisions=0.5)
+        self.assertEqual([u.filename for u in workload],
+                         [u.filename for u in workload])
+        uploads, downloads = testing.run(
+            self.app, '/upload', workload, concurrency=4,
+            fetch=lambda res: res.data.decode('utf-8'))
+        self.assertEqual((uploads.requests, uploads.errors), (40, 0))
+        self.assertEqual((downloads.requests, downloads.errors), (40, 0))
+        self.assertEqual(uploads.size, sum(len(u.body) for u in workload))
+        self.assertEqual(downloads.size, uploads.size)
+        self.assertEqual(len(self.fs.listdir('/uploads')), 41)
+        p = uploads.percentiles()
+        self.assertTrue(p[50] <= p[90] <= p[99] <= p[100])
+        self.assertIn('p99', str(uploads))
+
+    def test_percentile(self):
+        self.assertIsNone(testing.percentile([], 50))
+        values = list(range(1, 101))
+        self.assertEqual(testing.percentile(values, 50), 50)
+        self.assertEqual(testing.percentile(values, 99), 99)
+        self.assertEqual(testing.percentile(values, 0), 1)
+        sizes = testing.lognormal(1000, maximum=5000)
+        rng = random.Random(0)
+        self.assertTrue(all(0 <= sizes(rng) <= 5000 for _ in range(100)))
+
+
+class BulkCase(unittest.TestCase):
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+        self.other = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_ARCHIVE_DEST=self.other)
+        # flask.ext loads its own copy of flask_flup.flup, and the bulk
+        # commands catch the exceptions of the real one
+        self.files = flask_flup.UploadSet('files')
+        self.archive = flask_flup.UploadSet('archive')
+        self.flup = flask_flup.Flup(self.app, [self.files, self.archive])
+        for name, body in (('a.txt', b'a'), ('Sub Dir/B.TXT', b'b'),
+                           ('nested/deep/c.txt', b'c'), ('evil.exe', b'x'),
+                           ('.flup/state.db', b'')):
+            self.write(self.source, name, body)
+
+    def tearDown(self):
+        for directory in (self.source, self.dest, self.other):
+            shutil.rmtree(directory)
+
+    def write(self, root, name, body):
+        path = os.path.join(root, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(body)
+
+    def read(self, root, name):
+        with open(os.path.join(root, *name.split('/')), 'rb') as f:
+            return f.read()
+
+    def copy(self, source, target, **options):
+        with self.app.app_context():
+            return bulk.run(self.app, source, target, workers=3, **options)
+
+    def test_walk(self):
+        self.assertEqual(sorted(bulk.walk(self.source)),
+                         ['Sub Dir/B.TXT', 'a.txt', 'evil.exe',
+                          'nested/deep/c.txt'])
+
+    def test_import(self):
+        self.write(self.dest, 'a.txt', b'already here')
+        source = bulk.Directory(self.source)
+        with self.app.app_context():
+            target = bulk.SetEndpoint(self.files)
+        counts = self.copy(source, target, verify='digest')
+        self.assertEqual(counts, {'copied': 3, 'skipped': 1, 'failed': 0,
+                                  'resumed': 0})
+        self.assertEqual(self.read(self.dest, 'a_1.txt'), b'a')
+        self.assertEqual(self.read(self.dest, 'Sub_Dir/B.txt'), b'b')
+        self.assertEqual(self.read(self.dest, 'nested/deep/c.txt'), b'c')
+        self.assertFalse(os.path.exists(os.path.join(self.dest,
+                                                     'evil.exe')))
+        self.write(self.source, 'd.txt', b'd')
+        bulk.LOOKUP_EVERY = 2
+        try:
+            counts = self.copy(source, target)
+        finally:
+            bulk.LOOKUP_EVERY = 500
+        self.assertEqual((counts['copied'], counts['resumed']), (1, 4))
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ['.flup', 'Sub_Dir', 'a.txt', 'a_1.txt', 'd.txt',
+                          'nested'])
+        with self.app.app_context():
+            checkpoint = bulk.open_checkpoint(source, target)
+            names = dict((c.source, c.name) for c in checkpoint.copies())
+        self.assertEqual(names['Sub Dir/B.TXT'], 'Sub_Dir/B.txt')
+
+    def test_resume_unrecorded(self):
+        self.write(self.dest, 'a.txt', b'already here')
+        source = bulk.Directory(self.source)
+        with self.app.app_context():
+            target = bulk.SetEndpoint(self.files)
+            checkpoint = bulk.open_checkpoint(source, target)
+
+        class Crashed(bulk.Checkpoint):
+            # loses every outcome, as a run killed before its first flush
+            def record(self, copies):
+                bulk.Checkpoint.record(self, [c for c in copies
+                                              if c.status == bulk.STARTED])
+
+        self.copy(source, target, checkpoint=Crashed(checkpoint.path))
+        listing = sorted(bulk.walk(self.dest))
+        counts = self.copy(source, target)
+        self.assertEqual(counts, {'copied': 3, 'skipped': 1, 'failed': 0,
+                                  'resumed': 0})
+        self.assertEqual(sorted(bulk.walk(self.dest)), listing)
+        with self.app.app_context():
+            names = dict((c.source, c.name) for c in checkpoint.copies())
+        self.assertEqual(names['a.txt'], 'a_1.txt')
+        self.assertEqual(names['Sub Dir/B.TXT'], 'Sub_Dir/B.txt')
+
+    def test_export_and_verify(self):
+        self.write(self.dest, 'a.txt', b'a')
+        self.write(self.dest, 'x/b.txt', b'b')
+        with self.app.app_context():
+            source = bulk.SetEndpoint(self.files)
+            target = bulk.Directory(os.path.join(self.other, 'export'))
+            counts = self.copy(source, target)
+            self.assertEqual(counts['copied'], 2)
+            self.assertEqual(self.read(target.root, 'x/b.txt'), b'b')
+            self.assertEqual(bulk.verify(self.app, source, target,
+                                         digest=True), [])
+            self.write(target.root, 'x/b.txt', b'B')
+            self.assertEqual(bulk.verify(self.app, source, target), [])
+            failed = bulk.verify(self.app, source, target, digest=True)
+            self.assertEqual([c.source for c in failed], ['x/b.txt'])
+            os.unlink(os.path.join(target.root, 'a.txt'))
+            self.assertEqual(len(bulk.verify(self.app, source, target)), 1)
+
+    def test_migrate(self):
+        self.write(self.dest, 'a.txt', b'a')
+        self.write(self.dest, 'x/b.txt', b'b')
+        self.write(self.dest, 'x/.c.txt.0123.part', b'partial')
+        with self.app.app_context():
+            source = bulk.SetEndpoint(self.files)
+            target = bulk.SetEndpoint(self.archive)
+        counts = self.copy(source, target, delete=True)
+        self.assertEqual(counts['copied'], 2)
+        self.assertEqual(self.read(self.other, 'x/b.txt'), b'b')
+        self.assertEqual(list(bulk.walk(self.dest)), ['x/.c.txt.0123.part'])
+
+    def test_command(self):
+        from click.testing import CliRunner
+        from flask.cli import ScriptInfo
+        from flask_flup.cli import flup as command
+        info = ScriptInfo(create_app=lambda info: self.app)
+        result = CliRunner().invoke(command, ['import', self.source, 'files',
+                                              '--workers', '2'], obj=info)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('3 copied, 1 skipped, 0 failed', result.output)
+        result = CliRunner().invoke(command, ['verify', self.source, 'files',
+                                              '--digest'], obj=info)
+        self.assertEqual(result.exit_code, 0, result.output)
+        result = CliRunner().invoke(command, ['import', self.source, 'none'],
+                                    obj=info)
+        self.assertEqual(result.exit_code, 2)
+
+
 class PathsUrlsCase(unittest.TestCase):
     def setUp(self):
         self.app = Flask(__name__)
@@ -304,8 +2218,14 @@ class PathsUrlsCase(unittest.TestCase):
 
 def suite():
     suite = unittest.TestSuite()
-    for t in [TestTestingCase, ConfigurationCase, PreconditionsCase,
-              SavingCase, ConflictResolutionCase, PathsUrlsCase]:
+    for t in [TestTestingCase, ConfigurationCase, LazyConfigurationCase,
+              PreconditionsCase,
+              SavingCase, ConflictResolutionCase, ConcurrentSaveCase,
+              JournalCase, SizeLimitCase, DynamicSetCase, ProgressCase,
+              IntegrityCase, IngestCase, StagingCase, RetentionCase,
+              TieringCase, ReplicationCase, EncryptionCase, ScanningCase,
+              MetadataCase, ThrottlingCase, DurabilityCase,
+              MemoryFilesystemCase, BulkCase, PathsUrlsCase]:
         suite.addTest(unittest.makeSuite(t))
     return suite
 